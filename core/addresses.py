@@ -0,0 +1,64 @@
+import hashlib
+
+from django.db import transaction
+
+# Address book. Every address is stored once per user and type: rows carry
+# a unique fingerprint of their normalized fields, and at most one row per
+# user and type is the default (the unique_default_address constraint).
+
+
+def normalize(value):
+    # trim and collapse runs of whitespace, which is what the form gets wrong most
+    return ' '.join(str(value or '').split())
+
+
+def address_fingerprint(user_id, street_address, apartment_address, country, zip_code, address_type):
+    parts = [
+        str(user_id),
+        normalize(street_address).casefold(),
+        normalize(apartment_address).casefold(),
+        str(country).upper(),
+        normalize(zip_code).replace(' ', '').upper(),
+        address_type,
+    ]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def prepare_address(address):
+    """Normalize ``address`` in place and set its fingerprint."""
+    address.street_address = normalize(address.street_address)
+    address.apartment_address = normalize(address.apartment_address)
+    address.zip = normalize(address.zip)
+    address.fingerprint = address_fingerprint(
+        address.user_id, address.street_address, address.apartment_address,
+        address.country, address.zip, address.address_type)
+    return address
+
+
+def save_address_book(user, addresses):
+    """
+    Store unsaved ``addresses`` in the user's address book, reusing rows
+    that already hold the same address. Addresses flagged ``default``
+    become the default for their type. Returns the stored rows in order.
+    """
+    from .models import Address
+    for address in addresses:
+        address.user = user
+        prepare_address(address)
+    defaults = {address.address_type: address.fingerprint for address in addresses if address.default}
+
+    with transaction.atomic():
+        if defaults:
+            # clear the old defaults first, the partial unique index allows one at a time
+            Address.objects.filter(user=user, default=True, address_type__in=defaults).exclude(
+                fingerprint__in=defaults.values()).update(default=False)
+        # rows we already have are skipped, then every row is read back by fingerprint
+        Address.objects.bulk_create(addresses, ignore_conflicts=True)
+        stored = Address.objects.in_bulk([address.fingerprint for address in addresses],
+                                         field_name='fingerprint')
+        promote = [stored[fp] for fp in defaults.values() if not stored[fp].default]
+        if promote:
+            Address.objects.filter(pk__in=[address.pk for address in promote]).update(default=True)
+            for address in promote:
+                address.default = True
+    return [stored[address.fingerprint] for address in addresses]
@@ -1,73 +1,212 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.utils.functional import cached_property
 
 from .models import Item, OrderItem, Order, Payment, Coupon, Address, Refund
 
+# bulk actions update this many orders per statement
+ACTION_CHUNK_SIZE = 1000
+# below this many rows an exact COUNT(*) is cheap enough
+ESTIMATE_THRESHOLD = 10000
+
+
+def estimated_count(model, using):
+    """
+    The row count the database keeps in its statistics for ``model``'s
+    table, or None when it has none (on SQLite, until ANALYZE has run).
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            # stat is "<rows> <rows per key>...", the first number is the table's row count
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    count = int(str(row[0]).split()[0])
+    return count if count > 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    # unfiltered changelists of big tables are counted from the statistics
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
+
+
+def pk_chunks(queryset, chunk_size=ACTION_CHUNK_SIZE):
+    # walk the selection by pk, so updating rows out of a filter doesn't skip any
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        chunk = list((pks if last_pk is None else pks.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def update_orders(queryset, accept_refunds=False, **changes):
+    """
+    Apply ``changes`` to the selected orders, one UPDATE per chunk. With
+    ``accept_refunds`` their refund requests are accepted in the same
+    transaction. Returns the number of orders updated.
+    """
+    updated = 0
+    for pks in pk_chunks(queryset):
+        with transaction.atomic():
+            updated += Order.objects.filter(pk__in=pks).update(**changes)
+            if accept_refunds:
+                Refund.objects.filter(order__in=pks, accepted=False).update(accepted=True)
+    return updated
+
+
+def make_being_delivered(modeladmin, request, queryset):
+    updated = update_orders(queryset, being_delivered=True)
+    modeladmin.message_user(request, f"{updated} orders marked as being delivered")
+
+make_being_delivered.short_description = "Mark orders as being delivered"
+
+
+def make_received(modeladmin, request, queryset):
+    updated = update_orders(queryset, being_delivered=False, received=True)
+    modeladmin.message_user(request, f"{updated} orders marked as received")
+
+make_received.short_description = "Mark orders as received"
+
+
 # function which make changes in actions of admin pannel
 def make_refund_accepted(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
+    updated = update_orders(queryset, accept_refunds=True, refund_requested=False, refund_granted=True)
+    modeladmin.message_user(request, f"{updated} orders updated to refund granted")
 
 # text for action in admin pannel
 make_refund_accepted.short_description = "Update orders to refund granted"
 
 
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['user', 
+    list_display = ['user',
                     'ordered',
-                    'being_delivered', 
+                    'being_delivered',
                     'received',
-                    'refund_requested', 
+                    'refund_requested',
                     'refund_granted',
                     'billing_address',
-                    'shipping_address', 
-                    'payment', 
-                    'coupon']
+                    'shipping_address',
+                    'payment',
+                    'coupon',
+                    'total']
 
 
     list_display_links = [
-        'user', 
-        'billing_address', 
-        'shipping_address', 
-        'payment', 
+        'user',
+        'billing_address',
+        'shipping_address',
+        'payment',
         'coupon']
 
+    # the addresses and the payment print their user's name
+    list_select_related = [
+        'user',
+        'billing_address__user',
+        'shipping_address__user',
+        'payment__user',
+        'coupon']
+
+    # orders are found by user through the search box, a user filter lists every user
     list_filter = [
-        'user', 
-        'ordered', 
-        'being_delivered', 
+        'ordered',
+        'being_delivered',
         'received',
-        'refund_requested', 
+        'refund_requested',
         'refund_granted']
 
     search_fields = [
-        'user__username', 
+        'user__username',
         'ref_code',
     ]
 
-    actions = [make_refund_accepted]
+    autocomplete_fields = ['user', 'billing_address', 'shipping_address', 'coupon']
+    raw_id_fields = ['items', 'payment']
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    actions = [make_being_delivered, make_received, make_refund_accepted]
+
+
+class OrderItemAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'user', 'ordered', 'line_total']
+    list_select_related = ['user', 'item']
+    list_filter = ['ordered']
+    search_fields = ['user__username', 'item__title']
+    autocomplete_fields = ['user']
+    raw_id_fields = ['item']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class AddressAdmin(admin.ModelAdmin):
     list_display =  [
-        'user', 
-        'street_address', 
-        'apartment_address', 
-        'country', 
-        'zip', 
-        'address_type', 
+        'user',
+        'street_address',
+        'apartment_address',
+        'country',
+        'zip',
+        'address_type',
         'default',
     ]
 
+    list_select_related = ['user']
+
     list_filter = ['default', 'address_type', 'country']
-    
-    search_fields = ['user', 'street_address', 'apartment_address', 'zip']
+
+    search_fields = ['user__username', 'street_address', 'apartment_address', 'zip']
+
+    autocomplete_fields = ['user']
+
+
+class PaymentAdmin(admin.ModelAdmin):
+    list_display = ['user', 'stripe_charge_id', 'amount', 'timestamp']
+    list_select_related = ['user']
+    search_fields = ['user__username', 'stripe_charge_id']
+    autocomplete_fields = ['user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class CouponAdmin(admin.ModelAdmin):
+    list_display = ['code', 'kind', 'amount', 'min_spend', 'redemptions', 'max_redemptions', 'active']
+    list_filter = ['active', 'kind']
+    search_fields = ['code']
+
+
+class RefundAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'order', 'accepted']
+    list_select_related = ['order__user']
+    list_filter = ['accepted']
+    search_fields = ['order__user__username', 'order__ref_code']
+    raw_id_fields = ['order']
 
 
 admin.site.register(Item)
-admin.site.register(OrderItem)
+admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(Payment)
-admin.site.register(Coupon)
-admin.site.register(Refund)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(Coupon, CouponAdmin)
+admin.site.register(Refund, RefundAdmin)
 admin.site.register(Address, AddressAdmin)
-
-
@@ -0,0 +1,146 @@
+import json
+
+from django.db import transaction
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views.generic import View
+
+from . import cart, coupons
+from .context_processors import invalidate_cart
+from .coupons import CouponError
+from .inventory import OutOfStock
+from .models import Item, Order
+from .pricing import OrderTotals, order_lines_prefetch
+from .routers import use_primary
+
+
+# well inside the quantity column, so a huge number is a 400 rather than a database error
+MAX_QUANTITY = 1000
+
+
+class CartAPIError(Exception):
+    pass
+
+
+def serialize_cart(order):
+    totals = order.totals if order is not None else OrderTotals([])
+    return {
+        'items': [
+            {
+                'slug': line.item.slug,
+                'title': line.item.title,
+                'quantity': line.quantity,
+                'price': line.item.price,
+                'discount_price': line.item.discount_price,
+                'total': line.get_final_price(),
+            }
+            for line in totals.lines
+        ],
+        'item_count': totals.item_count,
+        'quantity': totals.quantity,
+        'subtotal': totals.subtotal,
+        'savings': totals.savings,
+        'coupon': totals.coupon.code if totals.coupon else None,
+        'coupon_amount': totals.coupon_amount,
+        'total': totals.total,
+    }
+
+
+def load_cart(user):
+    return Order.objects.select_related('coupon').prefetch_related(
+        order_lines_prefetch()).filter(user=user, ordered=False).first()
+
+
+def parse_quantity(op, minimum):
+    try:
+        quantity = int(op.get('quantity', 1))
+    except (TypeError, ValueError):
+        raise CartAPIError("quantity must be an integer")
+    if quantity < minimum:
+        raise CartAPIError(f"quantity must be at least {minimum}")
+    if quantity > MAX_QUANTITY:
+        raise CartAPIError(f"quantity must be at most {MAX_QUANTITY}")
+    return quantity
+
+
+def apply_coupon(user, code):
+    order = cart.get_open_order(user)
+    if order is None:
+        raise CartAPIError("you don't have an active order")
+    try:
+        coupons.apply_coupon(order, code)
+    except CouponError as e:
+        raise CartAPIError(str(e))
+
+
+def apply_operations(user, operations):
+    if not isinstance(operations, list):
+        raise CartAPIError("operations must be a list")
+
+    slugs = {op.get('slug') for op in operations if isinstance(op, dict) and op.get('slug')}
+    items = {item.slug: item for item in Item.objects.filter(slug__in=slugs)}
+
+    for op in operations:
+        if not isinstance(op, dict):
+            raise CartAPIError("every operation must be an object")
+        kind = op.get('op')
+        if kind == 'coupon':
+            apply_coupon(user, op.get('code', ''))
+            continue
+
+        item = items.get(op.get('slug'))
+        if item is None:
+            raise CartAPIError(f"unknown item {op.get('slug')!r}")
+        try:
+            if kind == 'add':
+                cart.add_item(user, item, parse_quantity(op, 1))
+            elif kind == 'set':
+                cart.set_quantity(user, item, parse_quantity(op, 0))
+            elif kind == 'remove':
+                cart.remove_item(user, item)
+            else:
+                raise CartAPIError(f"unknown operation {kind!r}")
+        except OutOfStock as e:
+            raise CartAPIError(str(e))
+
+
+@method_decorator(use_primary(), name='dispatch')
+class CartAPIView(View):
+    """
+    GET returns the cart. POST applies a batch of operations atomically and
+    returns the recomputed cart:
+
+        {"operations": [
+            {"op": "add", "slug": "a", "quantity": 2},
+            {"op": "set", "slug": "b", "quantity": 3},
+            {"op": "remove", "slug": "c"},
+            {"op": "coupon", "code": "SPRING"}
+        ]}
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': "authentication required"}, status=401)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return JsonResponse(serialize_cart(load_cart(self.request.user)))
+
+    def post(self, *args, **kwargs):
+        try:
+            payload = json.loads(self.request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'error': "invalid JSON body"}, status=400)
+        if not isinstance(payload, dict):
+            return JsonResponse({'error': "invalid JSON body"}, status=400)
+
+        try:
+            with transaction.atomic():
+                apply_operations(self.request.user, payload.get('operations', []))
+        except CartAPIError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except cart.CartLocked:
+            return JsonResponse({'error': "a payment for this cart is in progress"}, status=409)
+
+        invalidate_cart(self.request)
+        return JsonResponse(serialize_cart(load_cart(self.request.user)))
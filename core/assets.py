@@ -0,0 +1,115 @@
+import gzip
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.contrib.staticfiles import finders
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip copies are always written
+    brotli = None
+
+# Bundles built by collectstatic, in load order. Each bundle sits next to its
+# sources so relative url() references in the CSS keep working.
+BUNDLES = {
+    'core/css/site.bundle.css': (
+        'core/css/bootstrap.min.css',
+        'core/css/mdb.min.css',
+        'core/css/style.min.css',
+        'core/css/site.css',
+    ),
+    'core/js/site.bundle.js': (
+        'core/js/jquery-3.4.1.min.js',
+        'core/js/popper.min.js',
+        'core/js/bootstrap.min.js',
+        'core/js/mdb.min.js',
+        'core/js/site.js',
+    ),
+}
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map', '.eot', '.ttf')
+# skip files too small for compression to pay for the extra request header
+COMPRESS_MIN_SIZE = 256
+
+
+def minify_css(text):
+    text = re.sub(r'/\*(?!!).*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    # a space before ':' can be a descendant combinator, only the one after goes
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    # conservative: drops whole-line comments and indentation only
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+def minify(name, text):
+    if '.min.' in name:
+        return text
+    if name.endswith('.css'):
+        return minify_css(text)
+    return minify_js(text)
+
+
+def build_bundle(sources):
+    parts = []
+    for source in sources:
+        with open(finders.find(source), encoding='utf-8') as f:
+            parts.append(minify(source, f.read()))
+    # a leading ';' guards against sources that don't end their last statement
+    separator = '\n' if sources[0].endswith('.css') else '\n;'
+    return separator.join(parts) + '\n'
+
+
+def bundle_is_built(bundle):
+    # bundles only exist in STATIC_ROOT, the dev server serves the sources
+    return not settings.DEBUG and bundle in getattr(staticfiles_storage, 'hashed_files', {})
+
+
+class StaticAssetStorage(ManifestStaticFilesStorage):
+    """
+    collectstatic storage that concatenates BUNDLES, fingerprints every file
+    through the manifest and writes .gz (and .br, with brotli installed)
+    copies of the hashed files next to them for the web server to send.
+
+    Until collectstatic has been run there is no manifest, and the {% static %}
+    tag falls back to the unhashed names so tests and fresh checkouts work.
+    """
+
+    def stored_name(self, name):
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def save_file(self, name, content):
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(content))
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            for bundle, sources in BUNDLES.items():
+                self.save_file(bundle, build_bundle(sources).encode('utf-8'))
+                paths[bundle] = (self, bundle)
+
+        yield from super().post_process(paths, dry_run, **options)
+
+        if not dry_run:
+            for hashed_name in set(self.hashed_files.values()):
+                if hashed_name.endswith(COMPRESSIBLE):
+                    self.compress(hashed_name)
+
+    def compress(self, name):
+        with self.open(name) as f:
+            data = f.read()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return
+        self.save_file(name + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            self.save_file(name + '.br', brotli.compress(data))
@@ -0,0 +1,517 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .addresses import prepare_address
+from .models import (
+    Item, Order, OrderItem, Address, Coupon, Payment,
+    CATEGORY_CHOICES, LABEL_CHOICES,
+)
+
+SEED_PREFIX = 'bench'
+
+
+def inserted_pks(model, before):
+    # Django can't read back bulk-inserted pks on SQLite, but rowids are sequential
+    return list(model.objects.filter(pk__gt=before).order_by('pk').values_list('pk', flat=True))
+
+
+def max_pk(model):
+    last = model.objects.order_by('-pk').values_list('pk', flat=True).first()
+    return last or 0
+
+
+def bulk_insert(model, objects, batch_size):
+    before = max_pk(model)
+    model.objects.bulk_create(objects, batch_size=batch_size)
+    return inserted_pks(model, before)
+
+
+def seed(order_items=100000, users=1000, items=1000, coupons=100, lines_per_order=5,
+         batch_size=5000, rng=None, log=print):
+    """
+    Bulk-generate a storefront: items, users with default addresses, one open
+    cart per user, paid orders with payments for the remaining lines, and coupons.
+    """
+    rng = rng or random.Random(0)
+    User = get_user_model()
+    now = timezone.now()
+    categories = [code for code, _ in CATEGORY_CHOICES]
+    labels = [code for code, _ in LABEL_CHOICES]
+    run = f"{SEED_PREFIX}{int(time.time())}"
+
+    with transaction.atomic():
+        user_pks = bulk_insert(User, [
+            User(username=f"{run}-user{n}", password='!', email=f"{run}-user{n}@example.com")
+            for n in range(users)
+        ], batch_size)
+        log(f"users: {len(user_pks)}")
+
+        item_objs = []
+        for n in range(items):
+            price = Decimal(rng.randrange(500, 20000)) / 100
+            discount = (price * Decimal('0.8')).quantize(Decimal('0.01')) if rng.random() < 0.3 else None
+            item_objs.append(Item(
+                title=f"Product {n}", price=price, discount_price=discount,
+                category=rng.choice(categories), label=rng.choice(labels),
+                slug=f"{run}-item-{n}", description=f"Generated product number {n}",
+                image='12.jpg'))
+        item_pks = bulk_insert(Item, item_objs, batch_size)
+        prices = {pk: obj.discount_price or obj.price for pk, obj in zip(item_pks, item_objs)}
+        log(f"items: {len(item_pks)}")
+
+        Coupon.objects.bulk_create([
+            Coupon(code=f"B{run[-6:]}{n}"[:15], amount=Decimal(rng.randrange(1, 20)))
+            for n in range(coupons)
+        ], batch_size=batch_size)
+        log(f"coupons: {coupons}")
+
+        Address.objects.bulk_create([
+            prepare_address(Address(
+                user_id=pk, street_address=f"{n} Main Street", apartment_address='',
+                country='US', zip=f"{10000 + n % 90000}", address_type=kind, default=True))
+            for n, pk in enumerate(user_pks) for kind in ('S', 'B')
+        ], batch_size=batch_size)
+        log(f"addresses: {2 * len(user_pks)}")
+
+        # every user gets an open cart, the rest of the lines go into paid orders.
+        # lines are planned first so order and payment totals can be inserted with them
+        order_count = max(len(user_pks), order_items // lines_per_order)
+        line_items = [rng.choice(item_pks) for _ in range(order_items)]
+        line_quantities = [rng.randint(1, 3) for _ in range(order_items)]
+        subtotals = [Decimal('0.00')] * order_count
+        for n in range(order_items):
+            subtotals[n // lines_per_order % order_count] += prices[line_items[n]] * line_quantities[n]
+
+        paid = range(len(user_pks), order_count)
+        payment_pks = bulk_insert(Payment, [
+            Payment(stripe_charge_id=f"ch_{run}_{n}", user_id=user_pks[n % len(user_pks)],
+                    amount=subtotals[n])
+            for n in paid
+        ], batch_size)
+        log(f"payments: {len(payment_pks)}")
+
+        order_objs = []
+        for n in range(order_count):
+            ordered = n >= len(user_pks)
+            order_objs.append(Order(
+                user_id=user_pks[n % len(user_pks)], ordered=ordered, ordered_date=now,
+                ref_code=f"{run[-10:]}{n:010d}" if ordered else '',
+                payment_id=payment_pks[n - len(user_pks)] if ordered else None,
+                payment_status='C' if ordered else '',
+                subtotal=subtotals[n], total=subtotals[n]))
+        order_pks = bulk_insert(Order, order_objs, batch_size)
+        log(f"orders: {len(order_pks)}")
+
+        created = 0
+        while created < order_items:
+            chunk = min(batch_size, order_items - created)
+            lines, owners = [], []
+            for n in range(created, created + chunk):
+                order_index = n // lines_per_order % order_count
+                order = order_objs[order_index]
+                item_pk, quantity = line_items[n], line_quantities[n]
+                lines.append(OrderItem(
+                    user_id=order.user_id, item_id=item_pk, ordered=order.ordered,
+                    quantity=quantity, unit_price=prices[item_pk],
+                    line_total=prices[item_pk] * quantity))
+                owners.append(order_pks[order_index])
+            line_pks = bulk_insert(OrderItem, lines, batch_size)
+            Order.items.through.objects.bulk_create([
+                Order.items.through(order_id=order_pk, orderitem_id=line_pk)
+                for order_pk, line_pk in zip(owners, line_pks)
+            ], batch_size=batch_size)
+            created += chunk
+            log(f"order items: {created}/{order_items}")
+
+    return {'run': run, 'users': user_pks, 'items': item_pks, 'orders': order_pks}
+
+
+def hot_queries():
+    """The lookups every storefront request makes, as (name, queryset factory)."""
+    order = Order.objects.filter(ordered=True).exclude(ref_code='').order_by('-pk').first()
+    line = OrderItem.objects.order_by('-pk').first()
+    item = Item.objects.order_by('-pk').first()
+    coupon = Coupon.objects.order_by('-pk').first()
+    if not (order and line and item and coupon):
+        return []
+    user_id = line.user_id
+    return [
+        ("open order by user", lambda: Order.objects.filter(user_id=user_id, ordered=False)),
+        ("cart line by item/user/ordered", lambda: OrderItem.objects.filter(
+            item_id=line.item_id, user_id=user_id, ordered=False)),
+        ("default address by user/type", lambda: Address.objects.filter(
+            user_id=user_id, address_type='S', default=True)),
+        ("item by slug", lambda: Item.objects.filter(slug=item.slug)),
+        ("coupon by code", lambda: Coupon.objects.filter(code=coupon.code)),
+        ("order by ref_code", lambda: Order.objects.filter(ref_code=order.ref_code)),
+    ]
+
+
+def time_query(factory, repeat=50):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(factory())
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def explain(queryset):
+    if connection.vendor == 'postgresql':
+        return queryset.explain(analyze=True)
+    return queryset.explain()
+
+
+class StubCharge:
+    # stands in for stripe.Charge while benchmarking PaymentView
+    calls = 0
+
+    @classmethod
+    def create(cls, **kwargs):
+        cls.calls += 1
+        return {'id': f"ch_stub_{cls.calls}", 'object': 'charge', 'amount': kwargs.get('amount')}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StorefrontBenchmark:
+    """
+    Drives the storefront views through the Django test client and records
+    latency and query counts per endpoint. It writes to the configured
+    database (carts are filled and paid for), so point it at a scratch copy.
+    """
+
+    def __init__(self, users, items):
+        from django.test import Client
+        self.client = Client()
+        self.users = users
+        self.items = items
+        self.samples = {}
+
+    def request(self, name, method, url, data=None):
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = getattr(self.client, method)(url, data or {})
+            elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            raise RuntimeError(f"{name} returned {response.status_code}")
+        self.samples.setdefault(name, []).append((elapsed, len(queries)))
+        return response
+
+    def iteration(self, user, item):
+        from django.urls import reverse
+        self.client.force_login(user)
+        slug = {'slug': item.slug}
+        self.request('add_to_cart', 'get', reverse('core:add-to-cart', kwargs=slug))
+        self.request('home', 'get', reverse('core:home'))
+        self.request('product', 'get', reverse('core:product', kwargs=slug))
+        self.request('order_summary', 'get', reverse('core:order-summary'))
+        self.request('checkout_get', 'get', reverse('core:checkout'))
+        self.request('checkout_post', 'post', reverse('core:checkout'), {
+            'use_default_shipping': 'on', 'use_default_billing': 'on', 'payment_option': 'S'})
+        self.request('payment_get', 'get', reverse('core:payment', kwargs={'payment_option': 'stripe'}))
+        self.request('remove_single_item', 'get', reverse('core:remove-single-item-from-cart', kwargs=slug))
+        self.request('add_to_cart', 'get', reverse('core:add-to-cart', kwargs=slug))
+        self.request('payment_post', 'post', reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                     {'stripeToken': 'tok_visa'})
+        self.client.logout()
+
+    def run(self, iterations):
+        from unittest import mock
+        from django.conf import settings
+        from django.test.utils import override_settings
+        import stripe
+
+        allowed_hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+        with override_settings(PAYMENT_CHARGE_ASYNC=False, ALLOWED_HOSTS=allowed_hosts), \
+                mock.patch.object(stripe, 'Charge', StubCharge):
+            for n in range(iterations):
+                self.iteration(self.users[n % len(self.users)], self.items[n % len(self.items)])
+        return self.report()
+
+    def report(self):
+        rows = []
+        for name, samples in self.samples.items():
+            latencies = [elapsed for elapsed, _ in samples]
+            queries = [count for _, count in samples]
+            rows.append({
+                'endpoint': name,
+                'requests': len(samples),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'queries_p50': percentile(queries, 50),
+                'queries_max': max(queries),
+            })
+        return rows
+
+
+URL_VIEWS = ('core:product', 'core:add-to-cart', 'core:remove-from-cart')
+
+
+def url_benchmark(items=100, repeat=200):
+    """
+    Time building the three item URLs for an ``items``-card page with
+    reverse(), with core.links.slug_url and with the memoized Item properties.
+    Returns {strategy: median ms per page}.
+    """
+    from django.urls import reverse
+    from .links import slug_url
+
+    slugs = [f"bench-item-{n}" for n in range(items)]
+
+    def with_reverse():
+        for slug in slugs:
+            for name in URL_VIEWS:
+                reverse(name, kwargs={'slug': slug})
+
+    def with_prefixes():
+        for slug in slugs:
+            for name in URL_VIEWS:
+                slug_url(name, slug)
+
+    page = [Item(slug=slug) for slug in slugs]
+
+    def with_properties():
+        # after the first page render every read is an attribute lookup
+        for item in page:
+            item.get_absolute_url()
+            item.get_add_to_cart_url()
+            item.get_remove_from_cart_url()
+
+    results = {}
+    for name, run in [('reverse', with_reverse), ('prefix cache', with_prefixes),
+                      ('item properties', with_properties)]:
+        # the first pass fills the caches, like the first render of a page
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = statistics.median(timings)
+    return results
+
+
+def journal_mode():
+    if connection.vendor != 'sqlite':
+        return connection.vendor
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        return f"sqlite ({cursor.fetchone()[0]})"
+
+
+def stock_benchmark(buyers=400, threads=16, stock=100, log=print):
+    """
+    Flash sale on one item: ``buyers`` open carts holding one unit each
+    start their payment from ``threads`` threads at once, against ``stock``
+    units. Returns throughput, latency and how the sale ended. It writes to
+    the configured database, so point it at a scratch copy.
+    """
+    import threading
+    from django.db import connections, OperationalError
+    from .inventory import OutOfStock
+    from . import payments
+
+    User = get_user_model()
+    run = f"{SEED_PREFIX}{int(time.time())}"
+    now = timezone.now()
+    with transaction.atomic():
+        item = Item.objects.create(
+            title="Flash sale", price=Decimal('10.00'), category=CATEGORY_CHOICES[0][0],
+            label=LABEL_CHOICES[0][0], slug=f"{run}-flash-sale", description="Hot item",
+            image='12.jpg', stock=stock)
+        user_pks = bulk_insert(User, [
+            User(username=f"{run}-buyer{n}", password='!') for n in range(buyers)], 1000)
+        order_pks = bulk_insert(Order, [
+            Order(user_id=pk, ordered_date=now, subtotal=item.price, total=item.price)
+            for pk in user_pks], 1000)
+        line_pks = bulk_insert(OrderItem, [
+            OrderItem(user_id=pk, item=item, quantity=1, unit_price=item.price, line_total=item.price)
+            for pk in user_pks], 1000)
+        Order.items.through.objects.bulk_create([
+            Order.items.through(order_id=order_pk, orderitem_id=line_pk)
+            for order_pk, line_pk in zip(order_pks, line_pks)], batch_size=1000)
+    log(f"{buyers} carts for {stock} units on {journal_mode()}")
+
+    queue = list(order_pks)
+    lock = threading.Lock()
+    outcomes = {'sold': 0, 'out_of_stock': 0, 'errors': 0}
+    latencies = []
+
+    def checkout():
+        try:
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    order_pk = queue.pop()
+                order = Order.objects.select_related('coupon').get(pk=order_pk)
+                start = time.perf_counter()
+                try:
+                    outcome = 'sold' if payments.begin_payment(order) else 'errors'
+                except OutOfStock:
+                    outcome = 'out_of_stock'
+                except OperationalError:
+                    # SQLite gave up waiting for the write lock
+                    outcome = 'errors'
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    outcomes[outcome] += 1
+                    latencies.append(elapsed)
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=checkout) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    item.refresh_from_db()
+    return {
+        **outcomes,
+        'database': journal_mode(),
+        'threads': threads,
+        'checkouts_per_s': buyers / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'stock_left': item.stock,
+        'oversold': outcomes['sold'] + item.stock != stock,
+    }
+
+
+# Django's stock SQLite setup: rollback journal, full fsyncs, no retries
+SQLITE_BASELINE = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+
+def sqlite_writer(user_pk, item_pks, writes, seed):
+    # one writer process, like a gunicorn worker: its own connection, pragmas and retries
+    from django.db import connections, OperationalError
+    from . import cart
+
+    connections.close_all()
+    rng = random.Random(seed)
+    user = get_user_model().objects.get(pk=user_pk)
+    items = list(Item.objects.filter(pk__in=item_pks))
+    latencies, errors = [], 0
+    try:
+        for _ in range(writes):
+            start = time.perf_counter()
+            try:
+                cart.add_item(user, rng.choice(items))
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        connections.close_all()
+    return latencies, errors
+
+
+def sqlite_reader(user_pks, stop, results, seed):
+    # one reader process serving storefront reads until the writers are done
+    from django.db import connections, OperationalError
+
+    connections.close_all()
+    rng = random.Random(seed)
+    latencies, errors = [], 0
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                list(Item.objects.order_by('pk')[:20])
+                Order.items.through.objects.filter(
+                    order__user_id=rng.choice(user_pks), order__ordered=False).count()
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        connections.close_all()
+        results.put((latencies, errors))
+
+
+def sqlite_write_benchmark(writers=8, writes=50, readers=4, items=20, log=print):
+    """
+    Concurrent cart writers and storefront readers on the configured SQLite
+    database: ``writers`` processes each add ``writes`` random items to
+    their user's cart while ``readers`` processes read the catalog and those
+    carts, once with Django's default SQLite setup and once with
+    SQLITE_PRAGMAS and busy retries. Returns {configuration: results}.
+    Point it at a scratch copy.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from django.conf import settings
+    from django.db import connections
+    from django.test.utils import override_settings
+
+    User = get_user_model()
+    context = multiprocessing.get_context('fork')
+    run = f"{SEED_PREFIX}{int(time.time())}"
+    with transaction.atomic():
+        item_pks = bulk_insert(Item, [
+            Item(title=f"Writer item {n}", price=Decimal('5.00'), category=CATEGORY_CHOICES[0][0],
+                 label=LABEL_CHOICES[0][0], slug=f"{run}-writer-item-{n}", description="Bench",
+                 image='12.jpg')
+            for n in range(items)], 1000)
+
+    configurations = [
+        ('baseline', {'SQLITE_PRAGMAS': SQLITE_BASELINE, 'SQLITE_BUSY_RETRIES': 0}),
+        ('tuned', {'SQLITE_PRAGMAS': settings.SQLITE_PRAGMAS,
+                   'SQLITE_BUSY_RETRIES': settings.SQLITE_BUSY_RETRIES}),
+    ]
+    results = {}
+    for name, overrides in configurations:
+        with transaction.atomic():
+            user_pks = bulk_insert(User, [
+                User(username=f"{run}-{name}-writer{n}", password='!') for n in range(writers)], 1000)
+        with override_settings(**overrides):
+            # reconnect so the pragmas (and the persistent journal mode) are applied
+            connections.close_all()
+            journal = journal_mode()
+            connections.close_all()
+            # forked workers inherit the overridden settings
+            stop, read_results = context.Event(), context.Queue()
+            reader_processes = [
+                context.Process(target=sqlite_reader, args=(user_pks, stop, read_results, n))
+                for n in range(readers)]
+            for process in reader_processes:
+                process.start()
+            with ProcessPoolExecutor(writers, mp_context=context) as pool:
+                start = time.perf_counter()
+                outcomes = list(pool.map(sqlite_writer, user_pks, [item_pks] * writers,
+                                         [writes] * writers, range(writers)))
+                elapsed = time.perf_counter() - start
+            stop.set()
+            reads = [read_results.get() for _ in reader_processes]
+            for process in reader_processes:
+                process.join()
+
+        latencies = [ms for done, _ in outcomes for ms in done]
+        read_latencies = [ms for done, _ in reads for ms in done]
+        results[name] = {
+            'journal': journal,
+            'writes_per_s': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) if latencies else 0,
+            'p95_ms': percentile(latencies, 95) if latencies else 0,
+            'errors': sum(failed for _, failed in outcomes),
+            'reads_per_s': len(read_latencies) / elapsed,
+            'read_p95_ms': percentile(read_latencies, 95) if read_latencies else 0,
+            'read_errors': sum(failed for _, failed in reads),
+        }
+        log(f"{name}: {results[name]['writes_per_s']:.1f} writes/s, "
+            f"{results[name]['reads_per_s']:.1f} reads/s ({journal})")
+    return results
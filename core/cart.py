@@ -0,0 +1,251 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Max, Value, When
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .inventory import OutOfStock
+from .models import Item, Order, OrderItem
+from .payments import PENDING, FAILED
+from .pricing import OrderTotals, line_total_expression, unit_price, update_order_totals
+from .sqlite import retry_on_busy
+
+
+# Every mutation opens with a write so that SQLite takes the write lock up
+# front (waiting on busy_timeout) instead of failing a read->write upgrade,
+# and so that concurrent increments are applied by the database with F().
+# The line and order price snapshots are updated in the same transaction.
+
+
+class CartLocked(Exception):
+    # the open order has a charge in flight, or a failed one Stripe didn't answer (its
+    # payment_key is kept until core.payments resolves it), so its lines are frozen
+    pass
+
+
+def check_in_stock(item):
+    # sold out items can't go into a cart, whichever way they're added
+    if item.stock == 0:
+        raise OutOfStock(f"Sorry, {item.title} is out of stock")
+
+
+def cart_lines(user, item):
+    # the open cart line for this item, if any
+    return OrderItem.objects.filter(
+        user=user, item=item, ordered=False, order__user=user, order__ordered=False,
+        order__payment_status__in=('', FAILED), order__payment_key='')
+
+
+def get_open_order(user, create=False):
+    order = Order.objects.select_for_update().filter(user=user, ordered=False).first()
+    if order is None and create:
+        try:
+            with transaction.atomic():
+                order = Order.objects.create(user=user, ordered_date=timezone.now())
+        except IntegrityError:
+            # a concurrent request opened the cart first (unique_open_order_per_user)
+            order = Order.objects.select_for_update().get(user=user, ordered=False)
+    if order is not None and create and (order.payment_status == PENDING or order.payment_key):
+        raise CartLocked()
+    return order
+
+
+def new_line(order, user, item, quantity):
+    price = unit_price(item)
+    order_item = OrderItem.objects.create(
+        user=user, item=item, ordered=False, quantity=quantity,
+        unit_price=price, line_total=price * quantity)
+    Order.items.through.objects.create(order=order, orderitem=order_item)
+    return order_item
+
+
+def refresh_totals(user):
+    update_order_totals(Order.objects.filter(user=user, ordered=False))
+
+
+@retry_on_busy
+def add_item(user, item, quantity=1):
+    """
+    Add ``quantity`` of ``item`` to the user's open order; return the new
+    line quantity. Raises OutOfStock for a sold out item.
+    """
+    check_in_stock(item)
+    increment = {
+        'quantity': F('quantity') + quantity,
+        'line_total': line_total_expression(F('quantity') + quantity),
+    }
+    with transaction.atomic():
+        if not cart_lines(user, item).update(**increment):
+            order = get_open_order(user, create=True)
+            # re-check under the order lock in case a concurrent request added the line
+            if not cart_lines(user, item).update(**increment):
+                new_line(order, user, item, quantity)
+                refresh_totals(user)
+                return quantity
+        refresh_totals(user)
+        return cart_lines(user, item).values_list('quantity', flat=True).first()
+
+
+@retry_on_busy
+def set_quantity(user, item, quantity):
+    """
+    Set the line quantity for ``item``; zero or less removes the line.
+    Raises OutOfStock for a sold out item.
+    """
+    if quantity <= 0:
+        remove_item(user, item)
+        return 0
+    check_in_stock(item)
+    values = {'quantity': quantity, 'line_total': line_total_expression(quantity)}
+    with transaction.atomic():
+        if not cart_lines(user, item).update(**values):
+            order = get_open_order(user, create=True)
+            if not cart_lines(user, item).update(**values):
+                new_line(order, user, item, quantity)
+        refresh_totals(user)
+    return quantity
+
+
+@retry_on_busy
+def decrement_item(user, item):
+    """
+    Take one ``item`` off the user's cart, removing the line when it reaches
+    zero. Return the new quantity, or None if the item wasn't in the cart.
+    """
+    with transaction.atomic():
+        if cart_lines(user, item).filter(quantity__gt=1).update(
+                quantity=F('quantity') - 1,
+                line_total=line_total_expression(F('quantity') - 1)):
+            refresh_totals(user)
+            return cart_lines(user, item).values_list('quantity', flat=True).first()
+        return 0 if remove_item(user, item) else None
+
+
+@retry_on_busy
+def remove_item(user, item):
+    """Drop the ``item`` line from the user's cart; return whether there was one."""
+    with transaction.atomic():
+        deleted, _ = cart_lines(user, item).delete()
+        if deleted:
+            refresh_totals(user)
+    return bool(deleted)
+
+
+# Guest carts. Anonymous visitors keep their cart in a signed cookie (see
+# core.middleware.GuestCartMiddleware), so browsing and cart churn cost no
+# database writes. The cart is merged into the open order on login.
+
+GUEST_CART_COOKIE = 'cart'
+GUEST_CART_SALT = 'core.cart'
+GUEST_CART_MAX_AGE = 60 * 60 * 24 * 14
+# keeps the cookie well under the 4KB browsers accept
+GUEST_CART_MAX_LINES = 50
+
+
+class GuestCartFull(Exception):
+    pass
+
+
+class GuestCart:
+    """Item pk -> quantity, with the parts of an Order the cart page uses."""
+
+    coupon = None
+
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+        self.modified = False
+
+    @classmethod
+    def from_cookie(cls, value):
+        lines = {}
+        for part in (value or '').split(','):
+            pk, _, quantity = part.partition(':')
+            if pk.isdigit() and quantity.isdigit() and int(quantity) > 0:
+                lines[int(pk)] = int(quantity)
+        return cls(list(lines.items())[:GUEST_CART_MAX_LINES])
+
+    def to_cookie(self):
+        return ','.join(f'{pk}:{quantity}' for pk, quantity in self.lines.items())
+
+    def __len__(self):
+        return len(self.lines)
+
+    def changed(self):
+        self.modified = True
+        self.__dict__.pop('totals', None)
+
+    def add(self, item, quantity=1):
+        check_in_stock(item)
+        if item.pk not in self.lines and len(self.lines) >= GUEST_CART_MAX_LINES:
+            raise GuestCartFull()
+        self.lines[item.pk] = self.lines.get(item.pk, 0) + quantity
+        self.changed()
+        return self.lines[item.pk]
+
+    def decrement(self, item):
+        quantity = self.lines.get(item.pk)
+        if quantity is None:
+            return None
+        if quantity > 1:
+            self.lines[item.pk] = quantity - 1
+        else:
+            del self.lines[item.pk]
+        self.changed()
+        return quantity - 1
+
+    def remove(self, item):
+        if self.lines.pop(item.pk, None) is None:
+            return False
+        self.changed()
+        return True
+
+    def clear(self):
+        if self.lines:
+            self.lines = {}
+            self.changed()
+
+    @cached_property
+    def totals(self):
+        # unsaved lines priced like an open order's, items that are gone drop out
+        items = Item.objects.in_bulk(list(self.lines))
+        return OrderTotals([
+            OrderItem(item=items[pk], quantity=quantity, unit_price=unit_price(items[pk]))
+            for pk, quantity in self.lines.items() if pk in items
+        ])
+
+
+@retry_on_busy
+def merge_guest_cart(user, lines):
+    """
+    Move a guest cart (item pk -> quantity) into the user's open order:
+    one UPDATE adds to the lines the order already has, the rest are
+    inserted with bulk_create, whatever the size of the cart.
+    """
+    if not lines:
+        return
+    with transaction.atomic():
+        order = get_open_order(user, create=True)
+        existing = set(OrderItem.objects.filter(
+            user=user, ordered=False, order=order, item__in=list(lines)).values_list('item', flat=True))
+
+        if existing:
+            added = Case(*[When(item=pk, then=Value(lines[pk])) for pk in existing],
+                         default=Value(0), output_field=IntegerField())
+            OrderItem.objects.filter(user=user, ordered=False, order=order, item__in=existing).update(
+                quantity=F('quantity') + added,
+                line_total=line_total_expression(F('quantity') + added))
+
+        items = Item.objects.in_bulk([pk for pk in lines if pk not in existing])
+        if items:
+            OrderItem.objects.bulk_create([
+                OrderItem(user=user, item=item, ordered=False, quantity=lines[pk],
+                          unit_price=unit_price(item), line_total=unit_price(item) * lines[pk])
+                for pk, item in items.items()
+            ])
+            # SQLite doesn't return the new pks: read back the newest line per item no order holds
+            created = OrderItem.objects.filter(
+                user=user, ordered=False, order=None, item__in=list(items)).order_by().values(
+                    'item').annotate(last=Max('pk')).values_list('last', flat=True)
+            Order.items.through.objects.bulk_create([
+                Order.items.through(order=order, orderitem_id=pk) for pk in created
+            ])
+        refresh_totals(user)
@@ -0,0 +1,162 @@
+import time
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.functional import cached_property
+
+from .routers import pin_catalog_reads
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_COUNT_TIMEOUT = 60 * 15
+ITEM_VERSION_KEY = 'catalog:item:{}:version'
+ITEM_SLUG_KEY = 'catalog:slug:{}'
+
+
+def cache_is_shared():
+    # locmem lives in one process, a version bump there isn't seen by the other workers
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+def fragment_timeout(timeout=None):
+    """
+    Lifetime of a versioned fragment: ``timeout`` (FRAGMENT_CACHE_TIMEOUT by
+    default), capped at FRAGMENT_CACHE_LOCAL_TIMEOUT with a process-local
+    cache, where version stamps don't invalidate across workers.
+    """
+    timeout = settings.FRAGMENT_CACHE_TIMEOUT if timeout is None else timeout
+    if cache_is_shared():
+        return timeout
+    return min(timeout, settings.FRAGMENT_CACHE_LOCAL_TIMEOUT)
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = time.time_ns()
+        cache.add(CATALOG_VERSION_KEY, version, None)
+        version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    # every cached catalog fragment and count is keyed on this version
+    pin_catalog_reads()
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, time.time_ns(), None)
+
+
+def get_catalog_count(queryset):
+    key = f'catalog:count:{get_catalog_version()}'
+    return cache.get_or_set(key, queryset.count, CATALOG_COUNT_TIMEOUT)
+
+
+def get_item_versions(pks):
+    """
+    Version stamps for the given item pks in one cache round trip. Product
+    card and detail fragments are keyed on these, so a save only
+    invalidates the fragments of the item that changed.
+    """
+    keys = {ITEM_VERSION_KEY.format(pk): pk for pk in pks}
+    found = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return {pk: found[key] for key, pk in keys.items()}
+
+
+def bump_item_version(pk):
+    pin_catalog_reads()
+    try:
+        cache.incr(ITEM_VERSION_KEY.format(pk))
+    except ValueError:
+        cache.set(ITEM_VERSION_KEY.format(pk), time.time_ns(), None)
+
+
+def attach_item_versions(items):
+    # saves Item.cache_version a cache lookup per card
+    versions = get_item_versions([item.pk for item in items])
+    for item in items:
+        item.__dict__['cache_version'] = versions[item.pk]
+    return items
+
+
+def get_item_pk(slug):
+    return cache.get(ITEM_SLUG_KEY.format(slug))
+
+
+def remember_item_slug(item):
+    # without a shared cache, only the worker that renamed an item forgets its old slug
+    timeout = None if cache_is_shared() else fragment_timeout()
+    cache.set(ITEM_SLUG_KEY.format(item.slug), item.pk, timeout)
+
+
+def forget_item_slug(slug):
+    cache.delete(ITEM_SLUG_KEY.format(slug))
+
+
+def parse_cursor(value):
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        return None
+    return cursor if cursor > 0 else None
+
+
+class KeysetPage:
+    """
+    One page of a queryset walked by primary key instead of OFFSET.
+    Rows are only fetched when the page is first used, so a cached
+    template fragment can skip the query entirely.
+    """
+
+    def __init__(self, queryset, per_page, after=None, before=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.after = after
+        self.before = None if after else before
+
+    @cached_property
+    def _rows(self):
+        if self.before:
+            qs = self.queryset.filter(pk__lt=self.before).order_by('-pk')
+        else:
+            qs = self.queryset.order_by('pk')
+            if self.after:
+                qs = qs.filter(pk__gt=self.after)
+        rows = list(qs[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if self.before:
+            rows.reverse()
+        return attach_item_versions(rows), has_more
+
+    @property
+    def object_list(self):
+        return self._rows[0]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return bool(self.object_list) and (bool(self.before) or self._rows[1])
+
+    def has_previous(self):
+        if self.before:
+            return self._rows[1]
+        return bool(self.after)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_cursor(self):
+        return self.object_list[-1].pk if self.object_list else None
+
+    def previous_cursor(self):
+        return self.object_list[0].pk if self.object_list else None
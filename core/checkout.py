@@ -0,0 +1,115 @@
+from django.db import transaction
+
+from .addresses import save_address_book
+from .models import Address, Order
+from .sqlite import retry_on_busy
+
+PAYMENT_OPTIONS = {
+    'S': 'stripe',
+    'P': 'paypal',
+}
+
+
+class CheckoutError(Exception):
+    # the message is shown to the customer as is
+    pass
+
+
+def load_default_addresses(user, address_types=('S', 'B')):
+    """The user's default address per type, in one query."""
+    if not address_types:
+        return {}
+    defaults = {}
+    for address in Address.objects.filter(
+            user=user, default=True, address_type__in=address_types).order_by('pk'):
+        defaults.setdefault(address.address_type, address)
+    return defaults
+
+
+def new_address(user, data, prefix, address_type):
+    street_address = data.get(f'{prefix}_address')
+    country = data.get(f'{prefix}_country')
+    zip_code = data.get(f'{prefix}_zip')
+    if not (street_address and country and zip_code):
+        raise CheckoutError("Please fill out the required field")
+    return Address(
+        user=user,
+        street_address=street_address,
+        apartment_address=data.get(f'{prefix}_address2') or '',
+        country=country,
+        zip=zip_code,
+        address_type=address_type,
+        default=bool(data.get(f'set_default_{prefix}')),
+    )
+
+
+def copy_address(address, address_type, default):
+    return Address(
+        user_id=address.user_id,
+        street_address=address.street_address,
+        apartment_address=address.apartment_address,
+        country=address.country,
+        zip=address.zip,
+        address_type=address_type,
+        default=default,
+    )
+
+
+def resolve_addresses(user, data):
+    """
+    Work out the shipping and billing addresses from the checkout form's
+    cleaned data without writing anything. Returns the two addresses and
+    the ones that still have to be created.
+    """
+    wanted_defaults = []
+    if data.get('use_default_shipping'):
+        wanted_defaults.append('S')
+    if data.get('use_default_billing') and not data.get('same_billing_address'):
+        wanted_defaults.append('B')
+    defaults = load_default_addresses(user, wanted_defaults)
+
+    new = []
+    if data.get('use_default_shipping'):
+        shipping = defaults.get('S')
+        if shipping is None:
+            raise CheckoutError("No default shipping address available")
+    else:
+        shipping = new_address(user, data, 'shipping', 'S')
+        new.append(shipping)
+
+    if data.get('same_billing_address'):
+        # a new shipping address marked default makes its billing copy the default too
+        billing = copy_address(shipping, 'B', default=shipping.default and shipping.pk is None)
+        new.append(billing)
+    elif data.get('use_default_billing'):
+        billing = defaults.get('B')
+        if billing is None:
+            raise CheckoutError("No default billing address available")
+    else:
+        billing = new_address(user, data, 'billing', 'B')
+        new.append(billing)
+    return shipping, billing, new
+
+
+@retry_on_busy
+def checkout(user, data):
+    """
+    Attach the shipping and billing addresses to the user's open order as
+    one transaction: a single read for default addresses, entered addresses
+    saved to the address book together and one UPDATE of the order. Raises
+    CheckoutError for bad input and Order.DoesNotExist without an open
+    order; nothing is written in either case.
+    """
+    shipping, billing, new = resolve_addresses(user, data)
+    with transaction.atomic():
+        if new:
+            # entered addresses are swapped for their address book rows
+            stored = {id(address): row for address, row in zip(new, save_address_book(user, new))}
+            shipping = stored.get(id(shipping), shipping)
+            billing = stored.get(id(billing), billing)
+        updated = Order.objects.filter(user=user, ordered=False).update(
+            shipping_address=shipping, billing_address=billing)
+        if not updated:
+            # rolls back the addresses created above
+            raise Order.DoesNotExist()
+    return shipping, billing
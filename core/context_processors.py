@@ -0,0 +1,39 @@
+from django.utils.functional import SimpleLazyObject
+
+from .catalog import fragment_timeout
+from .models import Order
+
+CART_SESSION_KEY = 'cart_item_count'
+
+
+def get_cart_item_count(request):
+    user = request.user
+    if not user.is_authenticated:
+        guest_cart = getattr(request, 'guest_cart', None)
+        return len(guest_cart) if guest_cart is not None else 0
+
+    # the session is loaded on every request anyway, so a cached count is free
+    cached = request.session.get(CART_SESSION_KEY)
+    if cached and cached.get('user') == user.pk:
+        return cached['count']
+
+    count = Order.items.through.objects.filter(
+        order__user=user, order__ordered=False).count()
+    request.session[CART_SESSION_KEY] = {'user': user.pk, 'count': count}
+    return count
+
+
+def invalidate_cart(request):
+    # call from every view that changes the contents of the open order
+    request.session.pop(CART_SESSION_KEY, None)
+
+
+def cart(request):
+    return {
+        'cart_item_count': SimpleLazyObject(lambda: get_cart_item_count(request)),
+    }
+
+
+def fragments(request):
+    # the {% cache %} timeout of the product card and detail fragments
+    return {'fragment_cache_timeout': fragment_timeout()}
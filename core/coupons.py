@@ -0,0 +1,125 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db.models import F, Q
+
+from .models import Coupon, Order
+from .pricing import set_order_coupon
+
+COUPON_VERSION_KEY = 'coupons:version'
+COUPON_CACHE_SIZE = 1024
+
+# Coupon lookups are served from a per-process LRU, including misses, so
+# a flash sale hammering one code (or junk codes) doesn't reach the database.
+# Saving or deleting any coupon bumps COUPON_VERSION_KEY in the shared cache,
+# and each process drops its LRU when it sees a new version.
+_lock = threading.Lock()
+_coupons = OrderedDict()
+_version = None
+
+
+class CouponError(Exception):
+    # the message is shown to the customer as is
+    pass
+
+
+def get_coupon_version():
+    version = cache.get(COUPON_VERSION_KEY)
+    if version is None:
+        cache.add(COUPON_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(COUPON_VERSION_KEY)
+    return version
+
+
+def bump_coupon_version():
+    try:
+        cache.incr(COUPON_VERSION_KEY)
+    except ValueError:
+        cache.set(COUPON_VERSION_KEY, time.time_ns(), None)
+    clear_coupon_cache()
+
+
+def clear_coupon_cache():
+    global _version
+    with _lock:
+        _coupons.clear()
+        _version = None
+
+
+def get_active_coupon(code):
+    """The active coupon for ``code`` or None."""
+    global _version
+    code = code.strip()
+    version = get_coupon_version()
+    with _lock:
+        if version != _version:
+            _coupons.clear()
+            _version = version
+        if code in _coupons:
+            _coupons.move_to_end(code)
+            coupon = _coupons[code]
+            return copy.copy(coupon) if coupon else None
+
+    coupon = Coupon.objects.filter(code=code, active=True).first()
+    with _lock:
+        if version == _version:
+            _coupons[code] = coupon
+            if len(_coupons) > COUPON_CACHE_SIZE:
+                _coupons.popitem(last=False)
+    return copy.copy(coupon) if coupon else None
+
+
+def validate_coupon(coupon, subtotal):
+    if coupon.is_used_up():
+        raise CouponError("This coupon has been fully redeemed")
+    if subtotal < coupon.min_spend:
+        raise CouponError(f"This coupon needs a cart of at least ${coupon.min_spend}")
+    if coupon.kind == 'F' and coupon.amount > subtotal:
+        raise CouponError("You can't add this coupon to your cart")
+
+
+def apply_coupon(order, code):
+    """
+    Validate ``code`` against the open ``order`` and attach it. Refused while
+    a payment is pending, or failed without Stripe's answer: its total is
+    frozen for the charge that may still have been made.
+    """
+    from .payments import PENDING
+
+    if order.payment_status == PENDING or order.payment_key:
+        raise CouponError("Your payment is being processed, the coupon can't change right now")
+    coupon = get_active_coupon(code)
+    if coupon is None:
+        raise CouponError("This Coupon does not exist!")
+    validate_coupon(coupon, order.subtotal)
+    set_order_coupon(order, coupon)
+    # conditional, a payment may have started since the order was loaded
+    if not Order.objects.filter(pk=order.pk, payment_key='').exclude(payment_status=PENDING).update(
+            coupon=coupon, discount=order.discount, total=order.total):
+        raise CouponError("Your payment is being processed, the coupon can't change right now")
+    return coupon
+
+
+def redeem_coupon(order):
+    """
+    Count a redemption of the order's coupon when its payment starts. One
+    conditional UPDATE, so the cap holds however many orders race for the
+    last redemption. Returns False when the coupon is used up or inactive.
+    The lookup cache isn't bumped here, so validate_coupon's cap check is
+    only a hint and this is the check that counts.
+    """
+    if order.coupon_id is None:
+        return True
+    return bool(Coupon.objects.filter(pk=order.coupon_id, active=True).filter(
+        Q(max_redemptions__isnull=True) | Q(redemptions__lt=F('max_redemptions'))).update(
+            redemptions=F('redemptions') + 1))
+
+
+def release_coupon(order):
+    # hand the redemption back when the payment fails
+    if order.coupon_id is not None:
+        Coupon.objects.filter(pk=order.coupon_id, redemptions__gt=0).update(
+            redemptions=F('redemptions') - 1)
@@ -0,0 +1,149 @@
+import csv
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Order, Payment, Refund
+
+EXPORT_CHUNK_SIZE = 2000
+# spreadsheets run a cell starting with one of these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Finance exports. Every dataset is a values() queryset read with
+# iterator(), so rows are fetched EXPORT_CHUNK_SIZE at a time and written
+# out as they come: memory stays flat however many orders there are.
+# Only placed orders are exported, open carts aren't orders yet.
+
+
+def order_rows():
+    # the totals are the snapshot columns frozen at checkout, nothing is recomputed
+    return Order.objects.filter(ordered=True).values(
+        'id', 'ref_code', 'ordered_date', 'subtotal', 'discount', 'total', 'payment_status',
+        'being_delivered', 'received', 'refund_requested', 'refund_granted',
+        username=F('user__username'),
+        coupon_code=F('coupon__code'),
+        charge_id=F('payment__stripe_charge_id'),
+        shipping_country=F('shipping_address__country'),
+        shipping_zip=F('shipping_address__zip'),
+    ).annotate(
+        lines=Count('items'),
+        quantity=Coalesce(Sum('items__quantity'), Value(0)),
+    ), 'ordered_date'
+
+
+def order_item_rows():
+    return Order.items.through.objects.filter(order__ordered=True).values(
+        'order_id',
+        ref_code=F('order__ref_code'),
+        item_slug=F('orderitem__item__slug'),
+        item_title=F('orderitem__item__title'),
+        quantity=F('orderitem__quantity'),
+        unit_price=F('orderitem__unit_price'),
+        line_total=F('orderitem__line_total'),
+    ), 'order__ordered_date'
+
+
+def payment_rows():
+    return Payment.objects.values(
+        'id', 'stripe_charge_id', 'amount', 'timestamp', username=F('user__username'),
+    ), 'timestamp'
+
+
+def refund_rows():
+    return Refund.objects.values(
+        'id', 'order_id', 'accepted', 'reason',
+        ref_code=F('order__ref_code'),
+        username=F('order__user__username'),
+    ), 'order__ordered_date'
+
+
+DATASETS = {
+    'orders': order_rows,
+    'order-items': order_item_rows,
+    'payments': payment_rows,
+    'refunds': refund_rows,
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+def parse_day(value):
+    # a YYYY-MM-DD day as the aware datetime it starts at
+    if not value:
+        return None
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise ExportError(f"Invalid date {value!r}, expected YYYY-MM-DD")
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def export_queryset(dataset, since=None, until=None):
+    """
+    The values() queryset for ``dataset``, limited to rows dated from the
+    day ``since`` up to and including the day ``until``.
+    """
+    if dataset not in DATASETS:
+        raise ExportError(f"Unknown dataset {dataset!r}, choose from {', '.join(DATASETS)}")
+    queryset, date_field = DATASETS[dataset]()
+    since, until = parse_day(since), parse_day(until)
+    if since is not None:
+        queryset = queryset.filter(**{f'{date_field}__gte': since})
+    if until is not None:
+        queryset = queryset.filter(**{f'{date_field}__lt': until + datetime.timedelta(days=1)})
+    return queryset.order_by('pk')
+
+
+class Echo:
+    # csv.writer only needs write(), which hands the line straight back
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        # free text like refund reasons comes from customers
+        return "'" + value
+    return value
+
+
+def render_csv(queryset, chunk_size):
+    writer = csv.writer(Echo())
+    # the column order values() builds its rows in
+    query = queryset.query
+    fields = [*query.extra_select, *query.values_select, *query.annotation_select]
+    yield writer.writerow(fields)
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield writer.writerow([csv_value(row[field]) for field in fields])
+
+
+def render_jsonl(queryset, chunk_size):
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(dataset, export_format='csv', since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Lines of ``dataset`` in ``export_format``, generated lazily."""
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown format {export_format!r}, choose from {', '.join(EXPORT_FORMATS)}")
+    queryset = export_queryset(dataset, since, until)
+    if export_format == 'csv':
+        return render_csv(queryset, chunk_size)
+    return render_jsonl(queryset, chunk_size)
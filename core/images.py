@@ -0,0 +1,107 @@
+import hashlib
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# derivative widths in pixels; images are never upscaled
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+# (format, extension, save options)
+DERIVATIVE_FORMATS = (
+    ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+)
+DERIVATIVE_ROOT = 'derivatives'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def derivative_name(digest, width, ext):
+    # keyed by content, so duplicate uploads of the same picture share files
+    return f"{DERIVATIVE_ROOT}/{digest[:2]}/{digest}/{width}.{ext}"
+
+
+def derivative_url(digest, width, ext):
+    return default_storage.url(derivative_name(digest, width, ext))
+
+
+def derivative_widths(original_width):
+    # the smallest size always exists so every image gets a thumbnail
+    return [w for w in DERIVATIVE_WIDTHS if w <= original_width] or [DERIVATIVE_WIDTHS[0]]
+
+
+def render_derivative(image, width, fmt, options):
+    copy = image.copy()
+    if copy.width > width:
+        copy.thumbnail((width, round(copy.height * width / copy.width)), Image.LANCZOS)
+    if copy.mode not in ('RGB', 'L'):
+        copy = copy.convert('RGB')
+    buffer = io.BytesIO()
+    copy.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def generate_derivatives(data):
+    """
+    Write every missing derivative of the image bytes ``data`` to the default
+    storage. Returns ``(content hash, original width)``.
+    """
+    digest = content_hash(data)
+    # Image.open only parses the header, pixels are decoded on first use
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    for width in derivative_widths(image.width):
+        for fmt, ext, options in DERIVATIVE_FORMATS:
+            name = derivative_name(digest, width, ext)
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(render_derivative(image, width, fmt, options)))
+    return digest, image.width
+
+
+def read_image(name):
+    with default_storage.open(name, 'rb') as f:
+        return f.read()
+
+
+def process_image(name):
+    # process pool entry point: works on storage names only, never the database
+    return (name, *generate_derivatives(read_image(name)))
+
+
+def process_item_image(item):
+    """Generate derivatives for ``item.image`` and store the hash on the row."""
+    from .models import Item
+    if not item.image:
+        return None
+    digest, width = generate_derivatives(read_image(item.image.name))
+    Item.objects.filter(pk=item.pk).update(image_hash=digest, image_width=width)
+    item.image_hash, item.image_width = digest, width
+    return digest
+
+
+def backfill(items, workers=None, log=print):
+    """
+    Generate derivatives for ``items`` (a queryset) across a process pool.
+    Items sharing an image file are processed once. Returns the item count.
+    """
+    from .catalog import bump_catalog_version, bump_item_version
+    from .models import Item
+    names = {}
+    for pk, name in items.exclude(image='').values_list('pk', 'image'):
+        names.setdefault(name, []).append(pk)
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers or settings.IMAGE_WORKERS) as pool:
+        for name, digest, width in pool.map(process_image, names, chunksize=4):
+            Item.objects.filter(pk__in=names[name]).update(image_hash=digest, image_width=width)
+            for pk in names[name]:
+                bump_item_version(pk)
+            done += len(names[name])
+            log(f"{name}: {digest[:12]} ({done} items)")
+    # cached product cards still point at the original uploads
+    bump_catalog_version()
+    return done
@@ -0,0 +1,46 @@
+from django.db.models import F, OuterRef, Subquery, Sum
+
+from .models import Item, OrderItem
+
+# Stock. Item.stock counts the units on hand (NULL: not tracked). Stock is
+# reserved when a payment starts, with one conditional UPDATE per item that
+# only matches while enough units are left, so concurrent checkouts of a hot
+# item can't oversell it. A failed or expired payment hands the units back,
+# a completed one keeps them.
+
+
+class OutOfStock(Exception):
+    # the message is shown to the customer as is
+    pass
+
+
+def reserve_stock(lines):
+    """
+    Take the quantities of the order ``lines`` off their items' stock. Call
+    inside a transaction: OutOfStock leaves the items already reserved for
+    the caller's rollback.
+    """
+    wanted = {}
+    items = {}
+    for line in lines:
+        if line.item.stock is not None:
+            wanted[line.item_id] = wanted.get(line.item_id, 0) + line.quantity
+            items[line.item_id] = line.item
+    # a fixed order, so two carts with the same items can't deadlock on PostgreSQL
+    for pk in sorted(wanted):
+        quantity = wanted[pk]
+        if not Item.objects.filter(pk=pk, stock__gte=quantity).update(stock=F('stock') - quantity):
+            left = Item.objects.filter(pk=pk).values_list('stock', flat=True).first() or 0
+            title = items[pk].title
+            if left:
+                raise OutOfStock(f"Sorry, only {left} of {title} left in stock")
+            raise OutOfStock(f"Sorry, {title} is out of stock")
+
+
+def restock(order):
+    # one UPDATE: every tracked item of the order gets its line quantities back
+    quantity = OrderItem.objects.filter(order=order, item=OuterRef('pk')).order_by().values(
+        'item').annotate(total=Sum('quantity')).values('total')
+    Item.objects.filter(
+        stock__isnull=False, pk__in=OrderItem.objects.filter(order=order).values('item')).update(
+            stock=F('stock') + Subquery(quantity))
@@ -0,0 +1,43 @@
+import re
+from urllib.parse import quote
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import get_script_prefix, get_urlconf, reverse
+from django.utils.http import RFC3986_SUBDELIMS
+
+# reverse() walks the resolver for every call. URLs that only vary by slug
+# are reversed once with a placeholder and split into a (head, tail) pair, so
+# later calls are a string concatenation. Keyed on script prefix and urlconf,
+# which are the two inputs besides the arguments that reverse() depends on.
+SLUG_PLACEHOLDER = 'slug-placeholder'
+_slug_urls = {}
+# SlugField values never need quoting
+plain_slug = re.compile(r'[-\w]+', re.ASCII).fullmatch
+
+
+def slug_url(viewname, slug):
+    """``reverse(viewname, kwargs={'slug': slug})`` without the resolver walk."""
+    slug = str(slug)
+    if not slug or '/' in slug:
+        # can't match <slug>, let reverse() raise NoReverseMatch
+        return reverse(viewname, kwargs={'slug': slug})
+    key = (viewname, get_script_prefix(), get_urlconf())
+    parts = _slug_urls.get(key)
+    if parts is None:
+        head, tail = reverse(viewname, kwargs={'slug': SLUG_PLACEHOLDER}).split(SLUG_PLACEHOLDER)
+        parts = _slug_urls[key] = (head, tail)
+    if not plain_slug(slug):
+        # the same quoting reverse() applies to the whole path
+        slug = quote(slug, safe=RFC3986_SUBDELIMS + '/~:@')
+    return parts[0] + slug + parts[1]
+
+
+def clear_slug_urls():
+    _slug_urls.clear()
+
+
+@receiver(setting_changed)
+def urlconf_changed(setting, **kwargs):
+    if setting == 'ROOT_URLCONF':
+        clear_slug_urls()
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from core.benchmark import seed, hot_queries, time_query, explain
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the query plan and timing of the hot lookup paths. To compare "
+        "before and after the index migration, run it once after "
+        "`migrate core 0005` and again after `migrate core`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, metavar='ORDER_ITEMS',
+                            help="first bulk-generate this many order items, e.g. 1000000")
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--items', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            seed(order_items=options['seed'], users=options['users'], items=options['items'],
+                 log=lambda line: self.stdout.write(line))
+
+        queries = hot_queries()
+        if not queries:
+            self.stderr.write("No data to query, run with --seed first")
+            return
+
+        for name, factory in queries:
+            median, worst = time_query(factory, options['repeat'])
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{name}: {median:.3f} ms median, {worst:.3f} ms max"))
+            self.stdout.write(explain(factory()))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.benchmark import sqlite_write_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent cart writer and storefront reader processes against SQLite with "
+        "Django's default setup and with SQLITE_PRAGMAS plus busy retries. Writes carts, "
+        "so run it against a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help="writer processes")
+        parser.add_argument('--writes', type=int, default=50, help="cart writes per writer")
+        parser.add_argument('--readers', type=int, default=4, help="reader processes")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The configured database isn't SQLite")
+        results = sqlite_write_benchmark(options['writers'], options['writes'], options['readers'],
+                                         log=lambda message: None)
+        self.stdout.write(
+            f"{'setup':<10} {'journal':<16} {'writes/s':>9} {'p95 ms':>8} {'errors':>7} "
+            f"{'reads/s':>9} {'p95 ms':>8} {'errors':>7}")
+        for name, row in results.items():
+            self.stdout.write(
+                f"{name:<10} {row['journal']:<16} {row['writes_per_s']:>9.1f} {row['p95_ms']:>8.2f} "
+                f"{row['errors']:>7} {row['reads_per_s']:>9.1f} {row['read_p95_ms']:>8.2f} "
+                f"{row['read_errors']:>7}")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.benchmark import stock_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Flash-sale contention benchmark: many threads start payments for carts "
+        "holding one hot item. Writes carts and orders, so run it against a "
+        "scratch database (SQLite or PostgreSQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=400)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--stock', type=int, default=100)
+        parser.add_argument('--wal', action='store_true', help="switch the SQLite database to WAL first")
+
+    def handle(self, *args, **options):
+        if options['wal'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode=WAL")
+        result = stock_benchmark(options['buyers'], options['threads'], options['stock'],
+                                 log=self.stdout.write)
+        for key, value in result.items():
+            if isinstance(value, float):
+                value = f"{value:.2f}"
+            self.stdout.write(f"{key:<16} {value}")
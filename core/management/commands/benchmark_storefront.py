@@ -0,0 +1,40 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import SEED_PREFIX, StorefrontBenchmark
+from core.models import Address, Item
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the storefront views through the test client with Stripe stubbed "
+        "out and report p50/p95 latency and query counts per endpoint. Carts "
+        "are filled and paid for, so run it against a seeded scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--json', action='store_true', help="print the report as JSON")
+
+    def handle(self, *args, **options):
+        # seeded users come with default shipping and billing addresses
+        users = list(get_user_model().objects.filter(
+            username__startswith=SEED_PREFIX,
+            pk__in=Address.objects.filter(default=True, address_type='B').values('user'),
+        ).order_by('pk')[:options['iterations']])
+        items = list(Item.objects.order_by('pk')[:options['iterations']])
+        if not users or not items:
+            raise CommandError("No seeded users or items, run seed_benchmark first")
+
+        rows = StorefrontBenchmark(users, items).run(options['iterations'])
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+
+        self.stdout.write(f"{'endpoint':<20} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8} {'max q':>6}")
+        for row in rows:
+            self.stdout.write(
+                f"{row['endpoint']:<20} {row['requests']:>8} {row['p50_ms']:>8.2f} "
+                f"{row['p95_ms']:>8.2f} {row['queries_p50']:>8} {row['queries_max']:>6}")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core.benchmark import url_benchmark
+
+
+class Command(BaseCommand):
+    help = "Compare reverse() with the memoized item URL helpers on a listing page"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        results = url_benchmark(options['items'], options['repeat'])
+        baseline = results['reverse']
+        self.stdout.write(f"{'strategy':<16} {'ms/page':>8} {'speedup':>8}")
+        for name, ms in results.items():
+            self.stdout.write(f"{name:<16} {ms:>8.3f} {baseline / ms:>7.1f}x")
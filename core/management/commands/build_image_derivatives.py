@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.images import backfill
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnails and WebP derivatives for existing item images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Worker processes, defaults to IMAGE_WORKERS")
+        parser.add_argument('--missing', action='store_true',
+                            help="Only items that have no derivatives yet")
+
+    def handle(self, *args, **options):
+        items = Item.objects.all()
+        if options['missing']:
+            items = items.filter(image_hash='')
+        count = backfill(items, workers=options['workers'],
+                         log=lambda line: self.stdout.write(line))
+        self.stdout.write(self.style.SUCCESS(f"Processed images for {count} items"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.recommendations import SETTLE_SECONDS, RecommendationError, build_recommendations, sparse
+
+
+class Command(BaseCommand):
+    help = "Count the items bought together in the orders paid since the last run and re-rank them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="recount every paid order")
+        parser.add_argument('--per-item', type=int, help="RECOMMENDATIONS_PER_ITEM by default")
+        parser.add_argument('--settle', type=int, default=SETTLE_SECONDS,
+                            help="leave payments younger than this many seconds for the next run")
+
+    def handle(self, *args, **options):
+        try:
+            run = build_recommendations(full=options['full'], per_item=options['per_item'],
+                                       settle=options['settle'])
+        except RecommendationError as e:
+            raise CommandError(e)
+        counter = 'python' if sparse is None else 'scipy.sparse'
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Rebuilt' if run.full else 'Updated'} recommendations from {run.orders} orders, "
+            f"re-ranked {run.items} items ({counter})"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.payments import expire_reservations
+
+
+class Command(BaseCommand):
+    help = "Fail pending payments whose stock reservation timed out and put the stock back"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int, help="seconds, STOCK_RESERVATION_TIMEOUT by default")
+
+    def handle(self, *args, **options):
+        expired = expire_reservations(options['timeout'])
+        self.stdout.write(self.style.SUCCESS(f"Expired {expired} reservations"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exports import DATASETS, EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportError, export_lines
+
+
+class Command(BaseCommand):
+    help = "Stream placed orders, their lines, payments or refunds as CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', nargs='?', default='orders', choices=list(DATASETS))
+        parser.add_argument('--format', dest='export_format', default='csv', choices=list(EXPORT_FORMATS))
+        parser.add_argument('--since', help="first day to export, YYYY-MM-DD")
+        parser.add_argument('--until', help="last day to export, YYYY-MM-DD")
+        parser.add_argument('--output', '-o', help="file to write instead of standard output")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            lines = export_lines(options['dataset'], options['export_format'], options['since'],
+                                 options['until'], options['chunk_size'])
+        except ExportError as e:
+            raise CommandError(e)
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        count = 0
+        with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+            for line in lines:
+                f.write(line)
+                count += 1
+        if options['export_format'] == 'csv':
+            count -= 1  # the header
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} rows to {options['output']}"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Item
+from core.search import get_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product search index from every Item"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        index = get_search_index()
+        count = index.rebuild(Item.objects.all(), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {count} items with {type(index).__name__}"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.payments import recover_payments
+
+
+class Command(BaseCommand):
+    help = ("Send pending charges lost with a restarted worker to Stripe again, and settle "
+            "the failed ones Stripe didn't answer")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age', type=int, help="seconds, PAYMENT_RECOVERY_AFTER by default")
+
+    def handle(self, *args, **options):
+        recovered = recover_payments(options['age'])
+        self.stdout.write(self.style.SUCCESS(f"Retried {recovered} charges"))
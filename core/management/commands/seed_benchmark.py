@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.benchmark import seed
+
+
+class Command(BaseCommand):
+    help = "Bulk-generate items, users, addresses, orders, order items, coupons and payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order-items', type=int, default=100000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--items', type=int, default=1000)
+        parser.add_argument('--coupons', type=int, default=100)
+        parser.add_argument('--lines-per-order', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        result = seed(
+            order_items=options['order_items'],
+            users=options['users'],
+            items=options['items'],
+            coupons=options['coupons'],
+            lines_per_order=options['lines_per_order'],
+            batch_size=options['batch_size'],
+            log=lambda line: self.stdout.write(line),
+        )
+        self.stdout.write(self.style.SUCCESS(f"Seeded run {result['run']}"))
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the SQLite primary onto the SQLite replicas in DATABASE_REPLICAS, "
+        "standing in for replication when trying the read replica router locally"
+    )
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError("Only SQLite replicas can be synced, other databases replicate themselves")
+        primary.ensure_connection()
+        for alias in settings.DATABASE_REPLICAS:
+            replica = connections[alias]
+            if replica.vendor != 'sqlite':
+                continue
+            replica.ensure_connection()
+            # the online backup API copies a consistent snapshot page by page
+            primary.connection.backup(replica.connection)
+            self.stdout.write(self.style.SUCCESS(f"Synced {alias}"))
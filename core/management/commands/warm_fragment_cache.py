@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import get_template
+
+from core.catalog import attach_item_versions, cache_is_shared, fragment_timeout, remember_item_slug
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = "Render every item's card and detail fragments into the cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not cache_is_shared():
+            raise CommandError("The cache backend is local to each process, so fragments warmed "
+                               "here are never seen by the web workers. Configure a shared cache.")
+        timeout = fragment_timeout()
+        card = get_template('core/item_card.html')
+        detail = get_template('core/item_detail.html')
+        batch_size = options['batch_size']
+        count, last_pk = 0, 0
+        while True:
+            items = attach_item_versions(list(
+                Item.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size]))
+            if not items:
+                break
+            for item in items:
+                # the {% cache %} keys only depend on these values, so this fills
+                # the same entries the home, search and product pages read
+                card.render({'item': item, 'fragment_cache_timeout': timeout})
+                detail.render({'item': item, 'object': item, 'item_pk': item.pk,
+                               'item_version': item.cache_version, 'fragment_cache_timeout': timeout})
+                remember_item_slug(item)
+            count += len(items)
+            last_pk = items[-1].pk
+            self.stdout.write(f"warmed {count} items")
+        self.stdout.write(self.style.SUCCESS(f"Warmed fragments for {count} items"))
@@ -0,0 +1,201 @@
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+# transaction bookkeeping is timed but not counted against query budgets
+TRANSACTION_SQL = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE SAVEPOINT)\b', re.I)
+
+
+class RequestStats:
+    """Timings collected for one request; durations are in milliseconds."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.total_ms = 0.0
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.template_ms = 0.0
+        self.external_ms = 0.0
+        self.queries = []
+        self.rendering = False
+
+    def sql(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_ms += (time.perf_counter() - start) * 1000
+            if not TRANSACTION_SQL.match(sql):
+                self.sql_count += 1
+                self.queries.append(sql)
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self):
+        return (f"sql;dur={self.sql_ms:.2f};desc=\"{self.sql_count} queries\", "
+                f"tpl;dur={self.template_ms:.2f}, ext;dur={self.external_ms:.2f}, "
+                f"total;dur={self.total_ms:.2f}")
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def record_external():
+    # wrap calls to outside services (Stripe) so they show up in the request stats
+    stats = current_stats()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.external_ms += (time.perf_counter() - start) * 1000
+
+
+def instrument_templates():
+    from django.template.backends.django import Template
+    if getattr(Template.render, 'profiled', False):
+        return
+    original = Template.render
+
+    def render(self, context=None, request=None):
+        stats = current_stats()
+        # only time the outermost render, templates rendered inside it are included
+        if stats is None or stats.rendering:
+            return original(self, context, request)
+        stats.rendering = True
+        start = time.perf_counter()
+        try:
+            return original(self, context, request)
+        finally:
+            stats.template_ms += (time.perf_counter() - start) * 1000
+            stats.rendering = False
+
+    render.profiled = True
+    Template.render = render
+
+
+def record_metrics(view_name, stats):
+    with _metrics_lock:
+        entry = _metrics.setdefault(view_name, {
+            'requests': 0, 'sql_count': 0, 'sql_ms': 0.0, 'template_ms': 0.0,
+            'external_ms': 0.0, 'total_ms': 0.0, 'max_sql_count': 0, 'max_total_ms': 0.0,
+        })
+        entry['requests'] += 1
+        entry['sql_count'] += stats.sql_count
+        entry['sql_ms'] += stats.sql_ms
+        entry['template_ms'] += stats.template_ms
+        entry['external_ms'] += stats.external_ms
+        entry['total_ms'] += stats.total_ms
+        entry['max_sql_count'] = max(entry['max_sql_count'], stats.sql_count)
+        entry['max_total_ms'] = max(entry['max_total_ms'], stats.total_ms)
+
+
+def get_metrics():
+    with _metrics_lock:
+        metrics = {}
+        for view_name, entry in _metrics.items():
+            n = entry['requests']
+            metrics[view_name] = {
+                'requests': n,
+                'avg_sql_count': entry['sql_count'] / n,
+                'max_sql_count': entry['max_sql_count'],
+                'avg_sql_ms': entry['sql_ms'] / n,
+                'avg_template_ms': entry['template_ms'] / n,
+                'avg_external_ms': entry['external_ms'] / n,
+                'avg_total_ms': entry['total_ms'] / n,
+                'max_total_ms': entry['max_total_ms'],
+                'query_budget': settings.QUERY_BUDGETS.get(view_name),
+            }
+        return metrics
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+class ProfilingMiddleware:
+    """
+    Counts SQL queries and times SQL, template rendering and external calls
+    for every request. The numbers are attached to the response as
+    ``response.profile``, aggregated per view for the metrics endpoint, sent
+    as headers when PROFILING_HEADERS is on, and checked against
+    QUERY_BUDGETS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        stats = RequestStats()
+        _local.stats = stats
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.sql))
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        stats.finish()
+
+        response.profile = stats
+        if settings.PROFILING_HEADERS:
+            response['X-SQL-Count'] = str(stats.sql_count)
+            response['X-SQL-Time-Ms'] = f"{stats.sql_ms:.2f}"
+            response['X-Template-Time-Ms'] = f"{stats.template_ms:.2f}"
+            response['X-External-Time-Ms'] = f"{stats.external_ms:.2f}"
+            response['Server-Timing'] = stats.server_timing()
+
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            record_metrics(match.view_name, stats)
+            budget = settings.QUERY_BUDGETS.get(match.view_name)
+            if budget is not None and stats.sql_count > budget:
+                logger.warning("%s ran %d queries, over its budget of %d",
+                               match.view_name, stats.sql_count, budget)
+        return response
+
+
+class GuestCartMiddleware:
+    """
+    Loads an anonymous visitor's cart from its signed cookie into
+    ``request.guest_cart`` and writes the cookie back only when the cart
+    changed. A cart emptied by the login merge deletes the cookie.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # core.cart imports core.payments, which imports this module
+        from .cart import GUEST_CART_COOKIE, GUEST_CART_MAX_AGE, GUEST_CART_SALT, GuestCart
+
+        request.guest_cart = GuestCart.from_cookie(request.get_signed_cookie(
+            GUEST_CART_COOKIE, default=None, salt=GUEST_CART_SALT, max_age=GUEST_CART_MAX_AGE))
+        response = self.get_response(request)
+
+        guest_cart = request.guest_cart
+        if guest_cart.modified:
+            if guest_cart:
+                response.set_signed_cookie(
+                    GUEST_CART_COOKIE, guest_cart.to_cookie(), salt=GUEST_CART_SALT,
+                    max_age=GUEST_CART_MAX_AGE, secure=settings.SESSION_COOKIE_SECURE,
+                    httponly=True, samesite='Lax')
+            else:
+                response.delete_cookie(GUEST_CART_COOKIE, samesite='Lax')
+        return response
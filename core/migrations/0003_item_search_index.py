@@ -0,0 +1,47 @@
+from django.db import migrations
+
+CATEGORY_LABELS = {'S': 'Shirt', 'SW': 'Sports wear', 'OW': 'Outwear'}
+
+
+def fts5_available(connection):
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts5_probe")
+        except Exception:
+            return False
+    return True
+
+
+def create_search_index(apps, schema_editor):
+    # other backends use the in-process fallback index in core.search
+    if not fts5_available(schema_editor.connection):
+        return
+    Item = apps.get_model('core', 'Item')
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts "
+        "USING fts5(title, description, category, tokenize='porter unicode61')")
+    for item in Item.objects.all().iterator():
+        schema_editor.execute(
+            "INSERT INTO core_item_fts (rowid, title, description, category) "
+            "VALUES (%s, %s, %s, %s)",
+            [item.pk, item.title, item.description,
+             f"{item.category} {CATEGORY_LABELS.get(item.category, '')}"])
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS core_item_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20210206_2001'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1.7 on 2026-10-18 20:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_item_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='coupon',
+            options={},
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='charge_amount',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='payment_error',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='payment_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='payment_status',
+            field=models.CharField(blank=True, choices=[('', 'Not started'), ('P', 'Pending'), ('C', 'Completed'), ('F', 'Failed')], default='', max_length=1),
+        ),
+    ]
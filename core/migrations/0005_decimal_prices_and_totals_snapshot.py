@@ -0,0 +1,92 @@
+# Generated by Django 3.1.7 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 500
+
+
+def pk_batches(queryset):
+    # walk the table by pk so memory stays flat however many rows there are
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def backfill_snapshots(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+
+    for lines in pk_batches(OrderItem.objects.select_related('item')):
+        for line in lines:
+            line.unit_price = line.item.discount_price or line.item.price
+            line.line_total = line.unit_price * line.quantity
+        OrderItem.objects.bulk_update(lines, ['unit_price', 'line_total'])
+
+    for orders in pk_batches(Order.objects.select_related('coupon').prefetch_related('items')):
+        for order in orders:
+            order.subtotal = sum((line.line_total for line in order.items.all()), 0)
+            # Coupon.discount_for for the fixed coupons of this schema: never more than the cart
+            order.discount = min(order.coupon.amount, order.subtotal) if order.coupon else 0
+            order.total = order.subtotal - order.discount
+        Order.objects.bulk_update(orders, ['subtotal', 'discount', 'total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_order_payment_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='discount_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=12),
+        ),
+        migrations.RunPython(backfill_snapshots, migrations.RunPython.noop),
+    ]
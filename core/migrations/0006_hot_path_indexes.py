@@ -0,0 +1,77 @@
+# Generated by Django 3.1.7 on 2026-10-18 20:11
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe_before_constraints(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    Coupon = apps.get_model('core', 'Coupon')
+    Order = apps.get_model('core', 'Order')
+    Through = Order.items.through
+
+    # duplicate slugs/codes: the oldest row keeps the value, later rows get a suffix
+    for model, field in ((Item, 'slug'), (Coupon, 'code')):
+        dupes = model.objects.values(field).annotate(n=Count('pk')).filter(n__gt=1)
+        for value in dupes.values_list(field, flat=True):
+            for row in model.objects.filter(**{field: value}).order_by('pk')[1:]:
+                setattr(row, field, f"{value[:model._meta.get_field(field).max_length - 8]}-{row.pk}")
+                row.save(update_fields=[field])
+
+    # several open carts per user: fold the later ones into the oldest
+    users = Order.objects.filter(ordered=False).values('user').annotate(n=Count('pk')).filter(n__gt=1)
+    for user_id in users.values_list('user', flat=True):
+        keep, *extra = Order.objects.filter(user_id=user_id, ordered=False).order_by('pk')
+        Through.objects.filter(order__in=extra).update(order=keep)
+        Order.objects.filter(pk__in=[order.pk for order in extra]).delete()
+
+    dupes = Order.objects.exclude(ref_code='').values('ref_code').annotate(n=Count('pk')).filter(n__gt=1)
+    for ref_code in dupes.values_list('ref_code', flat=True):
+        for order in Order.objects.filter(ref_code=ref_code).order_by('pk')[1:]:
+            order.ref_code = f"{ref_code[:12]}{order.pk:08d}"[:20]
+            order.save(update_fields=['ref_code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_decimal_prices_and_totals_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_before_constraints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'default'], name='address_user_type_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['ref_code'], name='order_ref_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['user', 'item', 'ordered'], name='orderitem_cart_line_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='unique_open_order_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, ref_code=''), fields=('ref_code',), name='unique_order_ref_code'),
+        ),
+    ]
@@ -0,0 +1,91 @@
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count
+
+BATCH_SIZE = 1000
+
+
+def normalize(value):
+    return ' '.join(str(value or '').split())
+
+
+def address_fingerprint(address):
+    # frozen copy of core.addresses.address_fingerprint
+    parts = [
+        str(address.user_id),
+        normalize(address.street_address).casefold(),
+        normalize(address.apartment_address).casefold(),
+        str(address.country).upper(),
+        normalize(address.zip).replace(' ', '').upper(),
+        address.address_type,
+    ]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def compact_addresses(apps, schema_editor):
+    Address = apps.get_model('core', 'Address')
+    Order = apps.get_model('core', 'Order')
+
+    last_pk = 0
+    while True:
+        batch = list(Address.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            break
+        for address in batch:
+            address.street_address = normalize(address.street_address)
+            address.apartment_address = normalize(address.apartment_address)
+            address.zip = normalize(address.zip)
+            address.fingerprint = address_fingerprint(address)
+        Address.objects.bulk_update(batch, ['street_address', 'apartment_address', 'zip', 'fingerprint'])
+        last_pk = batch[-1].pk
+
+    # the oldest copy of an address stays, orders pointing at later copies move to it
+    dupes = list(Address.objects.values('fingerprint').annotate(n=Count('pk')).filter(
+        n__gt=1).order_by().values_list('fingerprint', flat=True))
+    for start in range(0, len(dupes), BATCH_SIZE):
+        copies = {}
+        for address in Address.objects.filter(
+                fingerprint__in=dupes[start:start + BATCH_SIZE]).order_by('pk'):
+            copies.setdefault(address.fingerprint, []).append(address)
+        for keep, *extra in copies.values():
+            extra_pks = [address.pk for address in extra]
+            Order.objects.filter(shipping_address__in=extra_pks).update(shipping_address=keep)
+            Order.objects.filter(billing_address__in=extra_pks).update(billing_address=keep)
+            if not keep.default and any(address.default for address in extra):
+                Address.objects.filter(pk=keep.pk).update(default=True)
+            Address.objects.filter(pk__in=extra_pks).delete()
+
+    # one default per user and type: the newest default wins
+    users = Address.objects.filter(default=True).values('user', 'address_type').annotate(
+        n=Count('pk')).filter(n__gt=1).order_by()
+    for row in list(users):
+        defaults = Address.objects.filter(
+            user=row['user'], address_type=row['address_type'], default=True).order_by('-pk')
+        Address.objects.filter(pk__in=list(defaults.values_list('pk', flat=True)[1:])).update(default=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_item_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='fingerprint',
+            field=models.CharField(default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(compact_addresses, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='address',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(condition=models.Q(default=True), fields=('user', 'address_type'), name='unique_default_address'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.7 on 2026-10-18 20:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_address_book'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='kind',
+            field=models.CharField(choices=[('F', 'Fixed amount'), ('P', 'Percentage')], default='F', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='min_spend',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='redemptions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_coupon_rules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 21:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='coupon',
+            constraint=models.CheckConstraint(check=models.Q(('kind', 'F'), ('amount__lte', 100), _connector='OR'), name='coupon_percentage_max_100'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_coupon_percentage_max'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='payment_token',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -1,8 +1,13 @@
-from django.db import models
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import models, transaction
 from django.conf import settings
-from django.shortcuts import reverse
+from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 from django_countries.fields import CountryField
 
+from .links import slug_url
+
 CATEGORY_CHOICES = (
     ('S', 'Shirt'),
     ('SW', 'Sports wear'),
@@ -20,28 +25,68 @@ ADDRESS_CHOICES = (
     ('S', 'Shipping'),
 )
 
+COUPON_KIND_CHOICES = (
+    ('F', 'Fixed amount'),
+    ('P', 'Percentage'),
+)
+
+PAYMENT_STATUS_CHOICES = (
+    ('', 'Not started'),
+    ('P', 'Pending'),
+    ('C', 'Completed'),
+    ('F', 'Failed'),
+)
+
 
 class Item(models.Model):
     title = models.CharField(max_length=100)
-    price = models.FloatField()
-    discount_price = models.FloatField(blank=True, null=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    discount_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     description = models.TextField()
     image = models.ImageField()
+    # set by core.images once thumbnails and WebP derivatives exist
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+    image_width = models.PositiveIntegerField(null=True, editable=False)
+    # units on hand, reserved by core.inventory when a payment starts; blank is not tracked
+    stock = models.PositiveIntegerField(blank=True, null=True)
 
     def __str__(self):
         return self.title
 
+    # URLs are memoized per instance, core.signals drops them when an item is saved
+    @cached_property
+    def absolute_url(self):
+        return slug_url("core:product", self.slug)
+
+    @cached_property
+    def add_to_cart_url(self):
+        return slug_url("core:add-to-cart", self.slug)
+
+    @cached_property
+    def remove_from_cart_url(self):
+        return slug_url("core:remove-from-cart", self.slug)
+
+    @cached_property
+    def remove_single_from_cart_url(self):
+        return slug_url("core:remove-single-item-from-cart", self.slug)
+
     def get_absolute_url(self):
-        return reverse("core:product", kwargs={"slug": self.slug})
+        return self.absolute_url
     
     def get_add_to_cart_url(self):
-        return reverse("core:add-to-cart", kwargs={'slug': self.slug})
+        return self.add_to_cart_url
     
     def get_remove_from_cart_url(self):
-            return reverse("core:remove-from-cart", kwargs={'slug': self.slug})
+            return self.remove_from_cart_url
+
+    @cached_property
+    def cache_version(self):
+        # version stamp the card and detail fragments are cached under, bumped on save
+        from .catalog import get_item_versions
+        return get_item_versions([self.pk])[self.pk]
 
 
 
@@ -50,6 +95,9 @@ class OrderItem(models.Model):
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # price snapshot, kept current by core.cart and frozen at checkout
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    line_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
 
     def __str__(self):
         return f"{self.quantity} of {self.item.title}"
@@ -68,6 +116,12 @@ class OrderItem(models.Model):
             return self.get_total_item_discount_price()
         return self.get_total_item_price()    
 
+    class Meta:
+        indexes = [
+            # cart line lookups by (item, user, ordered)
+            models.Index(fields=['user', 'item', 'ordered'], name='orderitem_cart_line_idx'),
+        ]
+
 
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -94,17 +148,50 @@ class Order(models.Model):
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
 
+    # totals snapshot: sum of line totals, coupon deduction and what is charged
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    # charge state, set by core.payments while the Stripe charge is in flight
+    payment_status = models.CharField(max_length=1, choices=PAYMENT_STATUS_CHOICES, blank=True, default='')
+    payment_key = models.CharField(max_length=64, blank=True)
+    # the Stripe token the key was first sent with, sent again with it on retries
+    payment_token = models.CharField(max_length=255, blank=True)
+    charge_amount = models.IntegerField(blank=True, null=True)
+    payment_error = models.CharField(max_length=255, blank=True)
+    # set while the order holds stock for a charge in flight
+    reserved_at = models.DateTimeField(blank=True, null=True)
+
     def __str__(self):
         return self.user.username
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'ordered'], name='order_user_ordered_idx'),
+            # refund lookups; SQLite can't use the partial unique index below for them
+            models.Index(fields=['ref_code'], name='order_ref_code_idx'),
+        ]
+        constraints = [
+            # at most one open cart per user
+            models.UniqueConstraint(
+                fields=['user'], condition=models.Q(ordered=False), name='unique_open_order_per_user'),
+            # ref codes are only assigned once an order is paid
+            models.UniqueConstraint(
+                fields=['ref_code'], condition=~models.Q(ref_code=''), name='unique_order_ref_code'),
+        ]
+
+    @cached_property
+    def totals(self):
+        from .pricing import price_order
+        return price_order(self)
+
+    def invalidate_totals(self):
+        # call after changing the cart lines or the coupon on this instance
+        self.__dict__.pop('totals', None)
+
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.coupon:
-            total -= self.coupon.amount
-        
-        return total
+        return self.totals.total
 
 class Address(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -114,19 +201,49 @@ class Address(models.Model):
     zip = models.CharField(max_length=100)
     address_type = models.CharField(max_length=1, choices=ADDRESS_CHOICES)
     default = models.BooleanField(default=False)
+    # hash of user, type and the normalized address, see core.addresses
+    fingerprint = models.CharField(max_length=64, unique=True, editable=False)
 
     def __str__(self):
         return self.user.username
+
+    def clean(self):
+        # fingerprint isn't editable, so validate_unique leaves it to the database
+        from .addresses import prepare_address
+        if self.user_id is None or not self.address_type:
+            return
+        prepare_address(self)
+        if Address.objects.filter(fingerprint=self.fingerprint).exclude(pk=self.pk).exists():
+            raise ValidationError("This address is already in the address book")
+
+    def save(self, *args, **kwargs):
+        from .addresses import prepare_address
+        prepare_address(self)
+        # the old default is only cleared if this row is saved too
+        with transaction.atomic():
+            if self.default:
+                Address.objects.filter(
+                    user_id=self.user_id, address_type=self.address_type, default=True).exclude(
+                        pk=self.pk).update(default=False)
+            super().save(*args, **kwargs)
     
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type', 'default'], name='address_user_type_default_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'address_type'], condition=models.Q(default=True),
+                name='unique_default_address'),
+        ]
 
 
 
 class Payment(models.Model):
     stripe_charge_id = models.CharField(max_length=50)
     user = models.ForeignKey(settings.AUTH_USER_MODEL , on_delete=models.SET_NULL, blank=True, null=True)
-    amount = models.FloatField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
     timestamp = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -134,12 +251,41 @@ class Payment(models.Model):
 
 
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
-    amount = models.FloatField()
+    code = models.CharField(max_length=15, unique=True)
+    kind = models.CharField(choices=COUPON_KIND_CHOICES, max_length=1, default='F')
+    # dollars off for fixed coupons, percent off for percentage coupons
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    min_spend = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # blank for no limit; redemptions is counted by core.coupons when a payment starts
+    max_redemptions = models.PositiveIntegerField(blank=True, null=True)
+    redemptions = models.PositiveIntegerField(default=0)
+    active = models.BooleanField(default=True)
+
+    class Meta:
+        constraints = [
+            # more than 100% off would make the total negative
+            models.CheckConstraint(
+                check=models.Q(kind='F') | models.Q(amount__lte=100), name='coupon_percentage_max_100'),
+        ]
 
     def __str__(self):
         return self.code
 
+    def clean(self):
+        if self.kind == 'P' and self.amount is not None and self.amount > 100:
+            raise ValidationError({'amount': "A percentage coupon can't take off more than 100%"})
+
+    def discount_for(self, subtotal):
+        # same rules as pricing.coupon_discount_expression
+        if subtotal < self.min_spend:
+            return Decimal('0.00')
+        if self.kind == 'P':
+            return (subtotal * self.amount / 100).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        return min(self.amount, subtotal)
+
+    def is_used_up(self):
+        return self.max_redemptions is not None and self.redemptions >= self.max_redemptions
+
 
 class Refund(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
@@ -147,4 +293,37 @@ class Refund(models.Model):
     accepted = models.BooleanField(default=False)
     email = models.EmailField
     def __str__(self):
-        return f"{self.pk}"
\ No newline at end of file
+        return f"{self.pk}"
+
+class CoPurchase(models.Model):
+    # how many paid orders contained both items, kept for both directions by core.recommendations
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='+')
+    orders = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'other'], name='unique_copurchase_pair'),
+        ]
+
+
+class Recommendation(models.Model):
+    # the top RECOMMENDATIONS_PER_ITEM co-purchases of each item, read by the product page
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='recommended_for')
+    rank = models.PositiveSmallIntegerField()
+    orders = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'rank'], name='unique_recommendation_rank'),
+        ]
+
+
+class RecommendationRun(models.Model):
+    # orders paid with a payment up to last_payment_id are counted in CoPurchase
+    last_payment_id = models.PositiveIntegerField()
+    orders = models.PositiveIntegerField()
+    items = models.PositiveIntegerField()
+    full = models.BooleanField()
+    finished = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,299 @@
+import logging
+import random
+import string
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+import stripe
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .coupons import CouponError, redeem_coupon, release_coupon
+from .inventory import reserve_stock, restock
+from .middleware import record_external
+from .models import Order, OrderItem, Payment
+from .pricing import freeze_order, get_order_lines, to_cents
+from .sqlite import retry_on_busy
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'P'
+COMPLETED = 'C'
+FAILED = 'F'
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.api_base = settings.STRIPE_API_BASE
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.PAYMENT_WORKERS, thread_name_prefix='stripe-charge')
+    return _executor
+
+
+def create_ref_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+@retry_on_busy
+def begin_payment(order, token=''):
+    """
+    Freeze the order's line prices and totals, redeem its coupon, reserve
+    its stock and mark it pending, to be charged with the Stripe ``token``.
+    Returns False when a charge is already in flight, so a double submit is
+    a no-op. Raises CouponError when the coupon ran out and OutOfStock when
+    an item did.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order.pk, ordered=False).exclude(
+                payment_status=PENDING).update(payment_status=PENDING, payment_error='', reserved_at=now):
+            return False
+        order.refresh_from_db(fields=['coupon', 'payment_key', 'payment_token', 'charge_amount'])
+        if order.payment_key:
+            # the last attempt failed without an answer from Stripe and the cart has been locked
+            # since (fail_payment clears the key after a decline): send the same request again, with
+            # the amount it was sent with, and Stripe returns its charge if it made one
+            key, token, amount = order.payment_key, order.payment_token or token, order.charge_amount
+        else:
+            # the lines are locked from here on: charge and reserve what they hold now, not what the
+            # caller loaded before (another tab may have changed the cart in between)
+            freeze_order(order)
+            order.refresh_from_db(fields=['subtotal', 'discount', 'total'])
+            key, amount = uuid.uuid4().hex, to_cents(order.total)
+        getattr(order, '_prefetched_objects_cache', {}).pop('items', None)
+        order.invalidate_totals()
+        if not redeem_coupon(order):
+            # rolls back the status change
+            raise CouponError("This coupon has been fully redeemed")
+        Order.objects.filter(pk=order.pk).update(payment_key=key, payment_token=token, charge_amount=amount)
+        # raises OutOfStock, which rolls back the coupon too
+        reserve_stock(get_order_lines(order))
+    order.payment_status = PENDING
+    order.payment_key = key
+    order.payment_token = token
+    order.charge_amount = amount
+    order.payment_error = ''
+    order.reserved_at = now
+    return True
+
+
+@retry_on_busy
+def complete_payment(order, charge_id):
+    """
+    Place the order paid by ``charge_id``. Returns the Payment, or None when
+    the order stopped waiting for this charge in the meantime (its
+    reservation expired and the stock went back) and the charge was refunded.
+    """
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            stripe_charge_id=charge_id, user=order.user, amount=Decimal(order.charge_amount) / 100)
+        # the reserved stock is sold, unless expire_reservations handed it back mid-charge
+        placed = Order.objects.filter(
+            pk=order.pk, payment_status=PENDING, reserved_at__isnull=False,
+            payment_key=order.payment_key).update(
+                ordered=True, payment=payment, ref_code=create_ref_code(), payment_status=COMPLETED,
+                reserved_at=None)
+        if placed:
+            OrderItem.objects.filter(order=order).update(ordered=True)
+        else:
+            transaction.set_rollback(True)
+    if placed:
+        return payment
+    return refund_late_charge(order, charge_id)
+
+
+def refund_late_charge(order, charge_id):
+    payment = Payment.objects.filter(stripe_charge_id=charge_id, order=order.pk).first()
+    if payment is not None:
+        # a replay of the same charge placed the order already
+        return payment
+    logger.warning("Order %s stopped waiting for charge %s, refunding it", order.pk, charge_id)
+    try:
+        with record_external():
+            stripe.Refund.create(charge=charge_id, idempotency_key=f'refund-{charge_id}')
+    except stripe.error.StripeError:
+        # the key stays, so a retry gets this charge back and places the order with it
+        logger.exception("Refunding charge %s of order %s failed", charge_id, order.pk)
+        changes = {'payment_error': "Your reservation expired while you were charged. "
+                                    "Please try again, you won't be charged twice"}
+    else:
+        # a retry with the same key would get the refunded charge back
+        changes = {'payment_error': "Your reservation expired while you were charged, "
+                                    "the charge was refunded",
+                   'payment_key': '', 'payment_token': ''}
+    Order.objects.filter(pk=order.pk, payment_status=FAILED, payment_key=order.payment_key).update(
+        **changes)
+    return None
+
+
+@retry_on_busy
+def fail_payment(order, message, declined=False):
+    """
+    Fail the pending payment of ``order`` and hand its stock and coupon back.
+    Only a ``declined`` charge, one Stripe answered without charging, gets
+    a new idempotency key on the next attempt: after any other failure the
+    charge may have gone through, so the cart stays locked and the retry
+    sends the same request, until resolve_payment_key settles it.
+    """
+    changes = {'payment_status': FAILED, 'payment_error': message[:255]}
+    if declined:
+        changes.update(payment_key='', payment_token='')
+    with transaction.atomic():
+        pending = Order.objects.filter(pk=order.pk, payment_status=PENDING)
+        # payments started before stock was tracked hold no reservation
+        reserved = pending.filter(reserved_at__isnull=False).update(reserved_at=None, **changes)
+        if reserved:
+            restock(order)
+        if reserved or pending.update(**changes):
+            release_coupon(order)
+
+
+def expire_reservations(timeout=None):
+    """
+    Fail the pending payments that have held their stock for more than
+    ``timeout`` seconds (STOCK_RESERVATION_TIMEOUT by default), handing the
+    stock and coupons back. Returns the number of payments expired.
+    """
+    if timeout is None:
+        timeout = settings.STOCK_RESERVATION_TIMEOUT
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    # read up front: an open SQLite cursor over rows fail_payment writes to can skip some of them
+    stale = list(Order.objects.filter(payment_status=PENDING, reserved_at__lt=cutoff).only('pk', 'coupon'))
+    for order in stale:
+        fail_payment(order, "Your reservation expired. Please try again, you won't be charged twice")
+    return len(stale)
+
+
+def resolve_payment_key(order):
+    """
+    Settle the key a failed payment kept because Stripe didn't answer, which
+    locks the customer's cart. The same request is sent again: a charge is
+    refunded (the customer was told the payment failed), a decline means
+    nothing was charged. Returns whether the key was dropped; after another
+    unanswered request, or once the customer retried with it, it stays.
+    """
+    key = order.payment_key
+    try:
+        with record_external():
+            charge = stripe.Charge.create(
+                amount=order.charge_amount,
+                currency="usd",
+                source=order.payment_token,
+                idempotency_key=key,
+            )
+    except (stripe.error.CardError, stripe.error.InvalidRequestError):
+        charge = None
+    except stripe.error.StripeError:
+        logger.warning("Charge %s of order %s is still unanswered", key, order.pk, exc_info=True)
+        return False
+    # the key is dropped first: a retry that took it in the meantime places the order with this charge
+    if not Order.objects.filter(pk=order.pk, payment_status=FAILED, payment_key=key).update(
+            payment_key='', payment_token=''):
+        return False
+    if charge is None:
+        return True
+    logger.warning("Order %s failed with charge %s unanswered, refunding it", order.pk, charge['id'])
+    try:
+        with record_external():
+            stripe.Refund.create(charge=charge['id'], idempotency_key=f"refund-{charge['id']}")
+    except stripe.error.StripeError:
+        logger.exception("Refunding charge %s of order %s failed", charge['id'], order.pk)
+        # locked again, so the next run refunds it
+        if not Order.objects.filter(pk=order.pk, payment_status=FAILED, payment_key='').update(
+                payment_key=key, payment_token=order.payment_token):
+            logger.error("Charge %s of order %s needs a manual refund", charge['id'], order.pk)
+        return False
+    return True
+
+
+def recover_payments(age=None):
+    """
+    Charge again the pending payments older than ``age`` seconds
+    (PAYMENT_RECOVERY_AFTER by default), whose charge was lost with the
+    worker that ran it. The same key and token go to Stripe, which returns
+    the charge if the first request made one. Failed payments still holding
+    their key are resolved, unlocking their carts. Returns the number retried.
+    """
+    if age is None:
+        age = settings.PAYMENT_RECOVERY_AFTER
+    cutoff = timezone.now() - timedelta(seconds=age)
+    # both read up front, settling a charge writes to these rows (see expire_reservations)
+    lost = list(Order.objects.filter(payment_status=PENDING, reserved_at__lt=cutoff).values_list(
+        'pk', flat=True))
+    unresolved = list(Order.objects.filter(payment_status=FAILED).exclude(payment_key='').only(
+        'pk', 'payment_key', 'payment_token', 'charge_amount'))
+    for pk in lost:
+        settle_charge(pk)
+    for order in unresolved:
+        resolve_payment_key(order)
+    return len(lost) + len(unresolved)
+
+
+def charge_order(order_id):
+    order = Order.objects.select_related('user').get(pk=order_id)
+    if order.payment_status != PENDING:
+        return None
+
+    try:
+        with record_external():
+            charge = stripe.Charge.create(
+                amount=order.charge_amount,
+                currency="usd",
+                source=order.payment_token,
+                idempotency_key=order.payment_key,
+            )
+    except stripe.error.CardError as e:
+        # Since it's a decline, stripe.error.CardError will be caught
+        err = (e.json_body or {}).get("error", {})
+        fail_payment(order, f"{err.get('message')}", declined=True)
+    except stripe.error.RateLimitError:
+        # Too many requests made to the API too quickly
+        fail_payment(order, "Rate Limit Error", declined=True)
+    except stripe.error.IdempotencyError:
+        # a request with this key is still running (see recover_payments), it settles the order
+        logger.warning("Charge of order %s is already in flight", order_id)
+    except stripe.error.InvalidRequestError:
+        # Invalid parameters were supplied to Stripe's API
+        fail_payment(order, "Invalid Parameters", declined=True)
+    except stripe.error.AuthenticationError:
+        # Authentication with Stripe's API failed
+        fail_payment(order, "Not Authenticated", declined=True)
+    except stripe.error.APIConnectionError:
+        # Network communication with Stripe failed, the charge may or may not have been made
+        fail_payment(order, "Network Error. Please try again, you won't be charged twice")
+    except stripe.error.StripeError:
+        fail_payment(order, "Something went wrong. Please try again, you won't be charged twice")
+    else:
+        return complete_payment(order, charge['id'])
+    return None
+
+
+def settle_charge(order_id):
+    try:
+        return charge_order(order_id)
+    except Exception:
+        logger.exception("Charging order %s failed", order_id)
+        fail_payment(Order.objects.get(pk=order_id), "A serious error occurred. We have been notified")
+
+
+def run_charge(order_id):
+    try:
+        return settle_charge(order_id)
+    finally:
+        connections.close_all()
+
+
+def enqueue_charge(order_id):
+    # with PAYMENT_CHARGE_ASYNC off the charge runs inline, which tests rely on
+    if not settings.PAYMENT_CHARGE_ASYNC:
+        return charge_order(order_id)
+    # the pool lives in this process: charges lost to a restart are picked up by recover_payments
+    transaction.on_commit(lambda: get_executor().submit(run_charge, order_id))
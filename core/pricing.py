@@ -0,0 +1,140 @@
+from decimal import Decimal
+
+from django.db import models
+from django.db.models import Case, ExpressionWrapper, F, OuterRef, Prefetch, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Least, Round
+
+ZERO = Decimal('0.00')
+MONEY = models.DecimalField(max_digits=12, decimal_places=2)
+
+
+def order_lines_prefetch():
+    # use with Order querysets so the cart lines come back with their items
+    from .models import OrderItem
+    return Prefetch('items', queryset=OrderItem.objects.select_related('item'))
+
+
+def unit_price(item):
+    # what one unit costs right now, the same rule as OrderItem.get_final_price
+    return item.discount_price or item.price
+
+
+def to_cents(amount):
+    return int((Decimal(amount) * 100).quantize(Decimal('1')))
+
+
+class OrderTotals:
+    """
+    Priced view of an order: every line with its item loaded, plus the
+    subtotal, savings, coupon deduction and grand total, computed in one pass.
+    """
+
+    def __init__(self, lines, coupon=None):
+        self.lines = lines
+        self.item_count = len(lines)
+        self.quantity = 0
+        self.subtotal = ZERO
+        self.savings = ZERO
+        self.discounted_total = ZERO
+
+        for line in lines:
+            self.quantity += line.quantity
+            self.subtotal += line.get_total_item_price()
+            if line.item.discount_price:
+                self.savings += line.get_amount_saved()
+            self.discounted_total += line.get_final_price()
+
+        self.coupon = coupon
+        self.coupon_amount = coupon.discount_for(self.discounted_total) if coupon else ZERO
+        self.total = self.discounted_total - self.coupon_amount
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return self.item_count
+
+
+def get_order_lines(order):
+    # reuse lines loaded by order_lines_prefetch(), otherwise fetch them once
+    prefetched = getattr(order, '_prefetched_objects_cache', {})
+    if 'items' in prefetched:
+        return list(order.items.all())
+    return list(order.items.select_related('item'))
+
+
+def price_order(order):
+    return OrderTotals(get_order_lines(order), order.coupon)
+
+
+# Snapshot columns. Order.subtotal/discount/total and OrderItem.unit_price/
+# line_total are stored so that history, admin and refunds can read an
+# order's price without joining items. Each helper is a single UPDATE.
+
+def line_total_expression(quantity):
+    return ExpressionWrapper(F('unit_price') * quantity, output_field=MONEY)
+
+
+def reprice_lines(lines):
+    """Copy the current item prices into the snapshot of ``lines`` (a queryset)."""
+    from .models import Item
+    current = Subquery(Item.objects.filter(pk=OuterRef('item_id')).annotate(
+        unit=Case(When(discount_price__gt=0, then=F('discount_price')), default=F('price'),
+                  output_field=MONEY)).values('unit')[:1], output_field=MONEY)
+    return lines.update(
+        unit_price=current,
+        line_total=ExpressionWrapper(current * F('quantity'), output_field=MONEY))
+
+
+def order_subtotal(order_ref):
+    from .models import OrderItem
+    return Coalesce(
+        Subquery(OrderItem.objects.filter(order=order_ref).values('order').annotate(
+            subtotal=Sum('line_total')).values('subtotal'), output_field=MONEY),
+        Value(ZERO), output_field=MONEY)
+
+
+def cents_expression(amount):
+    return Cast(Round(amount * 100), models.IntegerField())
+
+
+def coupon_discount_expression():
+    """SQL for Coupon.discount_for(subtotal) of the row's coupon, zero without one."""
+    from .models import Coupon
+    subtotal = order_subtotal(OuterRef(OuterRef('pk')))
+    # percentages in whole cents with integer division, rounding half up like discount_for does:
+    # SQLite's floating point decimals would round 4.02 * 25% to 1.00 instead of 1.01
+    percent_off = (cents_expression(subtotal) * cents_expression(F('amount')) + 5000) / 10000
+    discount = Coupon.objects.filter(pk=OuterRef('coupon_id')).annotate(discount=Case(
+        When(min_spend__gt=subtotal, then=Value(ZERO)),
+        When(kind='P', then=ExpressionWrapper(percent_off * Value(Decimal('0.01')), output_field=MONEY)),
+        default=Least(F('amount'), subtotal),
+        output_field=MONEY)).values('discount')[:1]
+    return Coalesce(Subquery(discount, output_field=MONEY), Value(ZERO), output_field=MONEY)
+
+
+def update_order_totals(orders):
+    """
+    Recompute subtotal, coupon discount and total of ``orders`` (a
+    queryset) from their line snapshots.
+    """
+    subtotal = order_subtotal(OuterRef('pk'))
+    discount = coupon_discount_expression()
+    return orders.update(
+        subtotal=subtotal,
+        discount=discount,
+        total=ExpressionWrapper(subtotal - discount, output_field=MONEY))
+
+
+def set_order_coupon(order, coupon):
+    order.coupon = coupon
+    order.discount = coupon.discount_for(order.subtotal) if coupon else ZERO
+    order.total = order.subtotal - order.discount
+    order.invalidate_totals()
+
+
+def freeze_order(order):
+    """Reprice every line at current prices and store the order totals."""
+    from .models import Order, OrderItem
+    reprice_lines(OrderItem.objects.filter(order=order))
+    update_order_totals(Order.objects.filter(pk=order.pk))
@@ -0,0 +1,168 @@
+import datetime
+from collections import Counter
+from itertools import combinations, groupby, islice
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from .catalog import get_item_versions
+from .models import CoPurchase, Item, Order, Payment, Recommendation, RecommendationRun
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:  # numpy/scipy are optional, baskets are counted in plain Python without them
+    sparse = None
+
+# "Frequently bought together". build_recommendations counts, for every pair
+# of items, the paid orders that contained both (CoPurchase, both directions),
+# then keeps the top RECOMMENDATIONS_PER_ITEM of each item in Recommendation,
+# which the product page reads with one query on its (item, rank) index.
+# Each run records the last payment it counted, so the next one only reads
+# the orders paid since and only re-ranks the items those orders touched.
+
+BASKET_CHUNK_SIZE = 5000
+RANK_CHUNK_SIZE = 500
+# a payment younger than this may be in a transaction that hasn't committed,
+# and one committing later with a lower pk would fall behind the watermark
+SETTLE_SECONDS = 60
+
+
+class RecommendationError(Exception):
+    pass
+
+
+class RecommendedItem:
+    """
+    A product card for a recommended item. The card fragment is keyed on
+    the pk and cache_version it's built with, anything else loads the
+    recommended items, all of them in one query.
+    """
+
+    def __init__(self, pk, cache_version, items):
+        self.pk = pk
+        self.cache_version = cache_version
+        self._items = items
+
+    def __getattr__(self, name):
+        return getattr(self._items[self.pk], name)
+
+
+def recommended_items(pk):
+    """The items bought together with item ``pk``, best first."""
+    pks = list(Recommendation.objects.filter(item=pk).order_by('rank').values_list(
+        'recommended_id', flat=True))
+    versions = get_item_versions(pks)
+    # only queried when a card fragment has to be rendered
+    items = SimpleLazyObject(lambda: Item.objects.in_bulk(pks))
+    return [RecommendedItem(item_pk, versions[item_pk], items) for item_pk in pks]
+
+
+def baskets(after, until):
+    # the set of item pks of each order paid with a payment pk in (after, until]
+    lines = Order.items.through.objects.filter(
+        order__ordered=True, order__payment_id__gt=after, order__payment_id__lte=until,
+    ).order_by('order_id').values_list('order_id', 'orderitem__item_id')
+    for _, rows in groupby(lines.iterator(chunk_size=BASKET_CHUNK_SIZE), key=itemgetter(0)):
+        yield {item_pk for _, item_pk in rows}
+
+
+def count_pairs_python(chunk):
+    pairs = Counter()
+    for basket in chunk:
+        pairs.update(combinations(sorted(basket), 2))
+    return pairs
+
+
+def count_pairs_sparse(chunk):
+    # the upper triangle of B.T @ B, B being the order x item incidence matrix
+    columns = sorted(set().union(*chunk))
+    index = {pk: n for n, pk in enumerate(columns)}
+    rows = [n for n, basket in enumerate(chunk) for _ in basket]
+    cols = [index[pk] for basket in chunk for pk in basket]
+    incidence = sparse.csr_matrix(
+        (numpy.ones(len(cols), dtype=numpy.int32), (rows, cols)), shape=(len(chunk), len(columns)))
+    pairs = sparse.triu(incidence.T @ incidence, k=1).tocoo()
+    return Counter({(columns[i], columns[j]): int(n) for i, j, n in zip(pairs.row, pairs.col, pairs.data)})
+
+
+def count_pairs(chunk):
+    """{(item pk, higher item pk): orders} for a list of baskets."""
+    if not chunk:
+        return Counter()
+    if sparse is None:
+        return count_pairs_python(chunk)
+    return count_pairs_sparse(chunk)
+
+
+def count_new_pairs(after, until):
+    # baskets are counted BASKET_CHUNK_SIZE at a time, so memory goes with the pairs, not the orders
+    pairs, orders, chunk = Counter(), 0, []
+    for basket in baskets(after, until):
+        orders += 1
+        if len(basket) > 1:
+            chunk.append(basket)
+        if len(chunk) >= BASKET_CHUNK_SIZE:
+            pairs.update(count_pairs(chunk))
+            chunk = []
+    pairs.update(count_pairs(chunk))
+    return pairs, orders
+
+
+def add_copurchases(pairs):
+    table = connection.ops.quote_name(CoPurchase._meta.db_table)
+    rows = [(a, b, n) for (a, b), n in pairs.items()]
+    rows += [(b, a, n) for a, b, n in rows]
+    with connection.cursor() as cursor:
+        # upsert (SQLite 3.24+, PostgreSQL): new pairs are inserted, known ones add to their count
+        cursor.executemany(
+            f"INSERT INTO {table} (item_id, other_id, orders) VALUES (%s, %s, %s) "
+            f"ON CONFLICT (item_id, other_id) DO UPDATE SET orders = {table}.orders + excluded.orders",
+            rows)
+
+
+def rank_items(item_pks, per_item):
+    item_pks = sorted(item_pks)
+    for start in range(0, len(item_pks), RANK_CHUNK_SIZE):
+        chunk = item_pks[start:start + RANK_CHUNK_SIZE]
+        Recommendation.objects.filter(item__in=chunk).delete()
+        rows = CoPurchase.objects.filter(item__in=chunk).order_by(
+            'item', '-orders', 'other').values_list('item_id', 'other_id', 'orders')
+        Recommendation.objects.bulk_create([
+            Recommendation(item_id=item_pk, recommended_id=other_pk, rank=rank, orders=orders)
+            for item_pk, group in groupby(rows, key=itemgetter(0))
+            for rank, (_, other_pk, orders) in enumerate(islice(group, per_item))
+        ])
+
+
+def build_recommendations(full=False, per_item=None, settle=SETTLE_SECONDS):
+    """
+    Count the co-purchases of the orders paid since the last run (of every
+    paid order when ``full``, or on the first run) and re-rank the items
+    they touched. Returns the RecommendationRun recorded.
+    """
+    per_item = per_item or settings.RECOMMENDATIONS_PER_ITEM
+    last = RecommendationRun.objects.order_by('-pk').first()
+    full = full or last is None
+    after = 0 if full else last.last_payment_id
+    settled = timezone.now() - datetime.timedelta(seconds=settle)
+    until = Payment.objects.filter(timestamp__lte=settled).aggregate(last=Max('pk'))['last'] or 0
+    until = max(until, after)
+
+    pairs, orders = count_new_pairs(after, until)
+    items = {pk for pair in pairs for pk in pair}
+    with transaction.atomic():
+        # the counts and the watermark commit together, so no order is ever counted twice
+        if RecommendationRun.objects.select_for_update().order_by('-pk').first() != last:
+            raise RecommendationError("Another run finished in the meantime, run again")
+        if full:
+            CoPurchase.objects.all().delete()
+            Recommendation.objects.all().delete()
+        add_copurchases(pairs)
+        rank_items(items, per_item)
+        return RecommendationRun.objects.create(
+            last_payment_id=until, orders=orders, items=len(items), full=full)
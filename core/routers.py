@@ -0,0 +1,97 @@
+import random
+import threading
+from contextlib import ContextDecorator, nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Catalog reads go to the read replicas in DATABASE_REPLICAS, everything else
+# (carts, orders, checkout, payments) stays on the primary. A client that just
+# wrote is pinned to the primary for REPLICA_PIN_SECONDS through a cookie, so
+# it reads its own writes while the replicas catch up. Catalog edits pin every
+# catalog read for as long, so the fragments cached under the new catalog and
+# item versions aren't rendered from a replica that hasn't seen the edit yet.
+
+PIN_COOKIE = 'db_primary'
+CATALOG_PIN_KEY = 'db:catalog-pinned'
+REPLICA_MODELS = {'core.item', 'core.recommendation'}
+# session saves don't change anything a replica serves
+UNPINNED_WRITES = {'sessions.session'}
+
+_local = threading.local()
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', 0) > 0
+
+
+def note_write():
+    _local.wrote = True
+
+
+def pin_catalog_reads():
+    # called by core.catalog whenever cached catalog content goes stale
+    if settings.DATABASE_REPLICAS:
+        cache.set(CATALOG_PIN_KEY, True, settings.REPLICA_PIN_SECONDS)
+
+
+class use_primary(ContextDecorator):
+    """Send every read inside the block (or the decorated view) to the primary."""
+
+    def __enter__(self):
+        _local.pinned = getattr(_local, 'pinned', 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        _local.pinned -= 1
+        return False
+
+
+def replica_for_read():
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas or is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        # a transaction must see its own writes
+        return DEFAULT_DB_ALIAS
+    if cache.get(CATALOG_PIN_KEY):
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower in REPLICA_MODELS:
+            return replica_for_read()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower not in UNPINNED_WRITES:
+            note_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema from the primary
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinMiddleware:
+    """
+    Pins a request to the primary while its client carries the pin cookie,
+    and sets the cookie on responses to requests that wrote to the database.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.wrote = False
+        with use_primary() if PIN_COOKIE in request.COOKIES else nullcontext():
+            response = self.get_response(request)
+        if _local.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
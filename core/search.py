@@ -0,0 +1,198 @@
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.db import connection, connections, router
+
+from .models import Item, CATEGORY_CHOICES
+
+FTS_TABLE = 'core_item_fts'
+
+# relative weight of a match in each indexed field
+FIELD_WEIGHTS = {'title': 10.0, 'description': 1.0, 'category': 2.0}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+CATEGORY_LABELS = dict(CATEGORY_CHOICES)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def item_document(item):
+    return {
+        'title': item.title,
+        'description': item.description,
+        'category': f"{item.category} {CATEGORY_LABELS.get(item.category, '')}",
+    }
+
+
+def fts5_available(conn):
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts5_probe")
+        except Exception:
+            return False
+    return True
+
+
+class SqliteSearchIndex:
+    """Ranked search over the core_item_fts FTS5 table (see migration 0003)."""
+
+    def index_item(self, item):
+        doc = item_document(item)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [item.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, description, category) "
+                "VALUES (%s, %s, %s, %s)",
+                [item.pk, doc['title'], doc['description'], doc['category']])
+
+    def remove_item(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [pk])
+
+    def rebuild(self, queryset, batch_size=1000):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            rows = []
+            count = 0
+            for item in queryset.iterator(chunk_size=batch_size):
+                doc = item_document(item)
+                rows.append((item.pk, doc['title'], doc['description'], doc['category']))
+                if len(rows) >= batch_size:
+                    count += self._insert(cursor, rows)
+                    rows = []
+            count += self._insert(cursor, rows)
+        return count
+
+    def _insert(self, cursor, rows):
+        if rows:
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, description, category) "
+                "VALUES (%s, %s, %s, %s)", rows)
+        return len(rows)
+
+    def search(self, query, limit=50):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        # quote every term so user input can't inject FTS5 syntax; prefix-match the last one
+        match = ' '.join(f'"{term}"' for term in terms) + '*'
+        weights = ', '.join(str(FIELD_WEIGHTS[f]) for f in ('title', 'description', 'category'))
+        # the index is read where the items are, a replica if there is one
+        with connections[router.db_for_read(Item)].cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                f"ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s",
+                [match, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+
+class MemorySearchIndex:
+    """
+    In-process inverted index for databases without FTS5. It is built on
+    first use and kept current by the Item save/delete signals of this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.postings = defaultdict(dict)  # token -> {item pk: weighted tf}
+        self.documents = {}  # item pk -> set of tokens
+
+    def _add(self, item):
+        weights = defaultdict(float)
+        for field, text in item_document(item).items():
+            for token in tokenize(text):
+                weights[token] += FIELD_WEIGHTS[field]
+        for token, weight in weights.items():
+            self.postings[token][item.pk] = weight
+        self.documents[item.pk] = set(weights)
+
+    def _remove(self, pk):
+        for token in self.documents.pop(pk, ()):
+            postings = self.postings.get(token)
+            if postings is not None:
+                postings.pop(pk, None)
+                if not postings:
+                    del self.postings[token]
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.rebuild(Item.objects.all())
+
+    def index_item(self, item):
+        with self.lock:
+            if self.loaded:
+                self._remove(item.pk)
+                self._add(item)
+
+    def remove_item(self, pk):
+        with self.lock:
+            self._remove(pk)
+
+    def rebuild(self, queryset, batch_size=1000):
+        with self.lock:
+            self.postings.clear()
+            self.documents.clear()
+            for item in queryset.only('pk', 'title', 'description', 'category').iterator(chunk_size=batch_size):
+                self._add(item)
+            self.loaded = True
+            return len(self.documents)
+
+    def _matching(self, term, prefix):
+        if term in self.postings:
+            yield self.postings[term]
+        if prefix:
+            for token, postings in self.postings.items():
+                if token != term and token.startswith(term):
+                    yield postings
+
+    def search(self, query, limit=50):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        self._ensure_loaded()
+        with self.lock:
+            total = len(self.documents) or 1
+            scores = None
+            for i, term in enumerate(terms):
+                term_scores = defaultdict(float)
+                for postings in self._matching(term, prefix=i == len(terms) - 1):
+                    idf = math.log(1 + total / len(postings))
+                    for pk, weight in postings.items():
+                        term_scores[pk] += weight * idf
+                # every term has to match, like the FTS5 query
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pk: score + term_scores[pk]
+                              for pk, score in scores.items() if pk in term_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))
+        return [pk for pk, score in ranked[:limit]]
+
+
+_index = None
+
+
+def get_search_index():
+    global _index
+    if _index is None:
+        _index = SqliteSearchIndex() if fts5_available(connection) else MemorySearchIndex()
+    return _index
+
+
+def search_items(query, limit=50):
+    pks = get_search_index().search(query, limit)
+    items = Item.objects.in_bulk(pks)
+    return [items[pk] for pk in pks if pk in items]
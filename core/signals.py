@@ -0,0 +1,67 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import cart
+from .catalog import bump_catalog_version, bump_item_version, forget_item_slug, remember_item_slug
+from .context_processors import invalidate_cart
+from .coupons import bump_coupon_version
+from .images import process_item_image
+from .models import Coupon, Item
+from .search import get_search_index
+
+
+@receiver(pre_save, sender=Item)
+def item_saving(sender, instance, **kwargs):
+    # the upload is only written to storage by Model.save(), note it for post_save
+    instance._image_uploaded = bool(instance.image) and not instance.image._committed
+    if not instance.image:
+        instance.image_hash, instance.image_width = '', None
+    if instance.pk:
+        # the old slug must stop resolving to this item's cached page
+        old_slug = Item.objects.filter(pk=instance.pk).exclude(
+            slug=instance.slug).values_list('slug', flat=True).first()
+        if old_slug:
+            forget_item_slug(old_slug)
+    for name in ('absolute_url', 'add_to_cart_url', 'remove_from_cart_url', 'remove_single_from_cart_url'):
+        instance.__dict__.pop(name, None)
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, **kwargs):
+    if getattr(instance, '_image_uploaded', False):
+        instance._image_uploaded = False
+        process_item_image(instance)
+    bump_item_version(instance.pk)
+    instance.__dict__.pop('cache_version', None)
+    remember_item_slug(instance)
+    bump_catalog_version()
+    get_search_index().index_item(instance)
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    bump_item_version(instance.pk)
+    forget_item_slug(instance.slug)
+    bump_catalog_version()
+    get_search_index().remove_item(instance.pk)
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def coupon_changed(sender, instance, **kwargs):
+    bump_coupon_version()
+
+
+@receiver(user_logged_in)
+def merge_guest_cart(sender, request, user, **kwargs):
+    guest_cart = getattr(request, 'guest_cart', None)
+    if not guest_cart:
+        return
+    try:
+        cart.merge_guest_cart(user, guest_cart.lines)
+    except cart.CartLocked:
+        # a charge is in flight, the guest cart waits for the next login
+        return
+    guest_cart.clear()
+    invalidate_cart(request)
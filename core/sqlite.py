@@ -0,0 +1,58 @@
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# SQLite tuning for single-node deployments. Every new SQLite connection gets
+# the SQLITE_PRAGMAS (WAL, synchronous=NORMAL, busy timeout, mmap and page
+# cache size), and connections are kept open between requests through
+# CONN_MAX_AGE so that happens once per worker thread. Writes that still
+# come back with SQLITE_BUSY are retried by retry_on_busy with backoff.
+
+# busy_timeout goes first so switching the journal mode waits for other writers
+PRAGMA_ORDER = ('busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size')
+BUSY_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = settings.SQLITE_PRAGMAS
+    names = [name for name in PRAGMA_ORDER if name in pragmas]
+    names += [name for name in pragmas if name not in PRAGMA_ORDER]
+    for name in names:
+        # on the raw connection: this isn't the application's SQL and shouldn't be profiled
+        connection.connection.execute(f"PRAGMA {name} = {pragmas[name]}")
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return any(text in message for text in BUSY_MESSAGES)
+
+
+def retry_on_busy(func):
+    """
+    Run ``func`` again with exponential backoff when SQLite reports the
+    database as locked, up to SQLITE_BUSY_RETRIES times. Busy errors can't
+    be retried inside an enclosing transaction, that one has to restart,
+    so they propagate from there.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if (not is_busy_error(e) or attempt >= settings.SQLITE_BUSY_RETRIES
+                        or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+                    raise
+            # jitter keeps the writers that collided from retrying in lockstep
+            time.sleep(settings.SQLITE_BUSY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+    return wrapper
@@ -0,0 +1,21 @@
+from django import template
+from django.templatetags.static import static
+from django.utils.html import format_html_join
+
+from core.assets import BUNDLES, bundle_is_built
+
+register = template.Library()
+
+
+@register.simple_tag
+def asset_bundle(bundle):
+    """
+    Link a bundle from core.assets.BUNDLES: the single fingerprinted file once
+    collectstatic has built it, otherwise each source file in order.
+    """
+    names = [bundle] if bundle_is_built(bundle) else BUNDLES[bundle]
+    if bundle.endswith('.css'):
+        tag = '<link href="{}" rel="stylesheet">\n'
+    else:
+        tag = '<script type="text/javascript" src="{}"></script>\n'
+    return format_html_join('', tag, ((static(name),) for name in names))
@@ -0,0 +1,31 @@
+from django import template
+from django.utils.html import format_html
+
+from core.images import DERIVATIVE_FORMATS, derivative_url, derivative_widths
+
+register = template.Library()
+
+
+def srcset(digest, widths, ext):
+    return ', '.join(f"{derivative_url(digest, w, ext)} {w}w" for w in widths)
+
+
+@register.simple_tag
+def item_image(item, sizes='100vw', css_class='', alt='', lazy=True):
+    """
+    Render ``item.image`` as a <picture> with WebP and JPEG srcsets. Items
+    without derivatives yet fall back to the original upload.
+    """
+    if not item.image:
+        return ''
+    if not item.image_hash:
+        return format_html('<img src="{}" class="{}" alt="{}">', item.image.url, css_class, alt)
+
+    widths = derivative_widths(item.image_width or 0)
+    sources = {ext: srcset(item.image_hash, widths, ext) for _, ext, _ in DERIVATIVE_FORMATS}
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" loading="{}"></picture>',
+        sources['webp'], sizes,
+        derivative_url(item.image_hash, widths[0], 'jpg'), sources['jpg'], sizes, css_class, alt,
+        'lazy' if lazy else 'eager')
@@ -0,0 +1,20 @@
+from django.conf import settings
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin that fails a test when a response ran more SQL queries
+    than its view's entry in QUERY_BUDGETS. Relies on ProfilingMiddleware.
+    """
+
+    def assertWithinQueryBudget(self, response, budget=None):
+        view_name = response.resolver_match.view_name
+        if budget is None:
+            budget = settings.QUERY_BUDGETS.get(view_name)
+        if budget is None:
+            self.fail(f"{view_name} has no entry in QUERY_BUDGETS")
+
+        profile = response.profile
+        if profile.sql_count > budget:
+            queries = '\n'.join(f"{n}. {sql}" for n, sql in enumerate(profile.queries, 1))
+            self.fail(f"{view_name} ran {profile.sql_count} queries, its budget is {budget}:\n{queries}")
@@ -1,3 +1,1477 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+import threading
+import time
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import stripe
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import NoReverseMatch, reverse, set_script_prefix
+from django.utils import timezone
+
+from PIL import Image
+
+from . import cart, coupons, images, payments, recommendations, views
+from .admin import EstimatedCountPaginator, estimated_count
+from .assets import minify_css
+from .benchmark import (StorefrontBenchmark, seed, sqlite_write_benchmark, stock_benchmark,
+                        url_benchmark)
+from .catalog import fragment_timeout
+from .exports import ExportError, export_lines
+from .links import slug_url
+from .middleware import reset_metrics
+from .models import (Item, OrderItem, Order, Coupon, Payment, Address, Refund, CoPurchase,
+                     Recommendation)
+from .pricing import freeze_order, to_cents
+from .recommendations import build_recommendations, recommended_items
+from .routers import PIN_COOKIE, PrimaryReplicaRouter, use_primary
+from .search import MemorySearchIndex, search_items
+from .sqlite import retry_on_busy
+from .testing import QueryBudgetMixin
+
+
+def make_item(n, price=10.0, discount_price=None):
+    return Item.objects.create(
+        title=f"Item {n}",
+        price=price,
+        discount_price=discount_price,
+        category='S',
+        label='P',
+        slug=f"item-{n}",
+        description="A test item",
+        image="12.jpg",
+    )
+
+
+def make_order(user, items, quantity=1, coupon=None):
+    order = Order.objects.create(user=user, ordered_date=timezone.now(), coupon=coupon)
+    for item in items:
+        order.items.add(OrderItem.objects.create(user=user, item=item, quantity=quantity))
+    return order
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+
+    def test_totals(self):
+        coupon = Coupon.objects.create(code='TEN', amount=10)
+        order = make_order(self.user, [
+            make_item(1, price=20.0),
+            make_item(2, price=30.0, discount_price=25.0),
+        ], quantity=2, coupon=coupon)
+
+        totals = Order.objects.get(pk=order.pk).totals
+        self.assertEqual(totals.item_count, 2)
+        self.assertEqual(totals.quantity, 4)
+        self.assertEqual(totals.subtotal, 100)
+        self.assertEqual(totals.savings, 10)
+        self.assertEqual(totals.coupon_amount, 10)
+        self.assertEqual(totals.total, 80)
+
+    def test_totals_are_computed_once(self):
+        order = make_order(self.user, [make_item(n) for n in range(5)])
+        order = Order.objects.get(pk=order.pk)
+        with self.assertNumQueries(1):
+            for _ in range(5):
+                order.get_total()
+
+    def test_order_summary_queries_do_not_grow_with_cart(self):
+        self.client.force_login(self.user)
+        order = make_order(self.user, [make_item(0)])
+        self.client.get(reverse('core:order-summary'))
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('core:order-summary'))
+
+        for n in range(1, 30):
+            order.items.add(OrderItem.objects.create(user=self.user, item=make_item(n)))
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(reverse('core:order-summary'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(small), len(large))
+
+
+class CartContextProcessorTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.item = make_item(1)
+
+    def test_count_is_cached_and_invalidated(self):
+        make_order(self.user, [make_item(2)])
+        response = self.client.get(reverse('core:home'))
+        self.assertEqual(response.context['cart_item_count'], 1)
+        self.assertEqual(self.client.session['cart_item_count']['count'], 1)
+
+        self.client.get(reverse('core:add-to-cart', kwargs={'slug': self.item.slug}))
+        self.assertNotIn('cart_item_count', self.client.session)
+        response = self.client.get(reverse('core:home'))
+        self.assertEqual(response.context['cart_item_count'], 2)
+
+
+class CatalogListingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.items = [make_item(n) for n in range(25)]
+
+    def item_queries(self, queries):
+        return [q for q in queries if 'core_item' in q['sql']]
+
+    def test_keyset_pages(self):
+        response = self.client.get(reverse('core:home'))
+        page = response.context['page_obj']
+        self.assertEqual([i.pk for i in page], [i.pk for i in self.items[:10]])
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+
+        response = self.client.get(reverse('core:home'), {'after': page.next_cursor()})
+        page = response.context['page_obj']
+        self.assertEqual([i.pk for i in page], [i.pk for i in self.items[10:20]])
+
+        response = self.client.get(reverse('core:home'), {'before': page.previous_cursor()})
+        page = response.context['page_obj']
+        self.assertEqual([i.pk for i in page], [i.pk for i in self.items[:10]])
+        self.assertFalse(page.has_previous())
+
+    def test_cached_page_skips_item_queries(self):
+        self.client.get(reverse('core:home'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('core:home'))
+        self.assertEqual(self.item_queries(queries), [])
+
+        self.items[0].title = "Renamed"
+        self.items[0].save()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:home'))
+        self.assertNotEqual(self.item_queries(queries), [])
+        self.assertContains(response, "Renamed")
+
+    def test_product_page_renders_from_cache(self):
+        item = self.items[0]
+        url = reverse('core:product', kwargs={'slug': item.slug})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(self.item_queries(queries), [])
+        self.assertContains(response, item.get_add_to_cart_url())
+
+        item.description = "Now with pockets"
+        item.save()
+        self.assertContains(self.client.get(url), "Now with pockets")
+
+        old_url, item.slug = url, 'renamed-item'
+        item.save()
+        self.assertEqual(self.client.get(old_url).status_code, 404)
+        self.assertContains(self.client.get(item.get_absolute_url()), "Now with pockets")
+
+    def test_item_save_only_rerenders_its_own_card(self):
+        self.client.get(reverse('core:home'))
+        self.items[1].title = "Renamed"
+        self.items[1].save()
+        with mock.patch.object(Item, 'get_absolute_url', autospec=True,
+                               side_effect=Item.get_absolute_url) as rendered:
+            response = self.client.get(reverse('core:home'))
+        self.assertContains(response, "Renamed")
+        self.assertEqual({call.args[0].pk for call in rendered.call_args_list}, {self.items[1].pk})
+
+    def test_warmup_command_fills_fragments(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}):
+            call_command('warm_fragment_cache', stdout=io.StringIO())
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('core:product', kwargs={'slug': self.items[3].slug}))
+            self.assertEqual(self.item_queries(queries), [])
+
+    def test_process_local_cache_keeps_fragments_briefly(self):
+        # other workers never see a version bump in locmem
+        self.assertEqual(fragment_timeout(), settings.FRAGMENT_CACHE_LOCAL_TIMEOUT)
+        self.assertEqual(self.client.get(reverse('core:home')).context['catalog_cache_timeout'],
+                         settings.FRAGMENT_CACHE_LOCAL_TIMEOUT)
+        with self.assertRaises(CommandError):
+            call_command('warm_fragment_cache', stdout=io.StringIO())
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.shirt = make_item(1)
+        self.shirt.title = "Blue linen shirt"
+        self.shirt.save()
+        self.jacket = make_item(2)
+        self.jacket.title = "Rain jacket"
+        self.jacket.description = "Goes well with a shirt"
+        self.jacket.category = 'OW'
+        self.jacket.save()
+
+    def test_search_view_ranks_title_matches_first(self):
+        response = self.client.get(reverse('core:search'), {'q': 'shirt'})
+        self.assertEqual(list(response.context['object_list']), [self.shirt, self.jacket])
+
+        response = self.client.get(reverse('core:search'), {'q': 'outwear'})
+        self.assertEqual(list(response.context['object_list']), [self.jacket])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.jacket.title = "Waxed parka"
+        self.jacket.save()
+        self.assertEqual(search_items('parka'), [self.jacket])
+        self.jacket.delete()
+        self.assertEqual(search_items('parka'), [])
+
+    def test_memory_index(self):
+        index = MemorySearchIndex()
+        self.assertEqual(index.search('shirt'), [self.shirt.pk, self.jacket.pk])
+        self.assertEqual(index.search('lin'), [self.shirt.pk])
+        self.assertEqual(index.search('rain shirt'), [self.jacket.pk])
+        index.remove_item(self.shirt.pk)
+        self.assertEqual(index.search('linen'), [])
+
+
+class CartServiceTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.item = make_item(1)
+
+    def test_add_decrement_remove(self):
+        self.assertEqual(cart.add_item(self.user, self.item), 1)
+        self.assertEqual(cart.add_item(self.user, self.item, 2), 3)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, 3)
+
+        self.assertEqual(cart.decrement_item(self.user, self.item), 2)
+        self.assertEqual(cart.set_quantity(self.user, self.item, 1), 1)
+        self.assertEqual(cart.decrement_item(self.user, self.item), 0)
+        self.assertIsNone(cart.decrement_item(self.user, self.item))
+        self.assertFalse(cart.remove_item(self.user, self.item))
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_increment_is_a_single_write(self):
+        cart.add_item(self.user, self.item)
+        with CaptureQueriesContext(connection) as queries:
+            cart.add_item(self.user, self.item)
+        statements = [q for q in queries if 'SAVEPOINT' not in q['sql']]
+        # line UPDATE, order totals UPDATE, quantity read
+        self.assertEqual(len(statements), 3)
+
+    def test_snapshots_follow_cart_changes(self):
+        discounted = make_item(2, price=30, discount_price=Decimal('24.99'))
+        cart.add_item(self.user, self.item, 2)
+        cart.add_item(self.user, discounted)
+        cart.add_item(self.user, discounted)
+        cart.decrement_item(self.user, self.item)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.subtotal, Decimal('59.98'))
+        self.assertEqual(order.total, order.get_total())
+        line = cart.cart_lines(self.user, discounted).get()
+        self.assertEqual((line.unit_price, line.line_total), (Decimal('24.99'), Decimal('49.98')))
+
+        cart.remove_item(self.user, discounted)
+        order.refresh_from_db()
+        self.assertEqual(order.total, Decimal('10.00'))
+
+    def test_add_to_cart_view_adds_one(self):
+        self.client.force_login(self.user)
+        make_order(self.user, [make_item(2)])
+        self.client.get(reverse('core:add-to-cart', kwargs={'slug': self.item.slug}))
+        self.assertEqual(cart.cart_lines(self.user, self.item).get().quantity, 1)
+
+
+class CartConcurrencyTest(TransactionTestCase):
+    threads = 8
+    clicks = 25
+
+    def test_concurrent_adds_are_not_lost(self):
+        user = get_user_model().objects.create_user('shopper', password='secret')
+        item = make_item(1)
+        errors = []
+
+        def hammer():
+            try:
+                for _ in range(self.clicks):
+                    cart.add_item(user, item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=hammer) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Order.objects.filter(user=user, ordered=False).count(), 1)
+        self.assertEqual(cart.cart_lines(user, item).get().quantity, self.threads * self.clicks)
+
+
+class CouponTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        coupons.clear_coupon_cache()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.item = make_item(1, price=40)
+        cart.add_item(self.user, self.item)
+        self.order = Order.objects.get(user=self.user, ordered=False)
+
+    def test_percentage_coupon_follows_cart_changes(self):
+        Coupon.objects.create(code='SALE15', kind='P', amount=15, min_spend=50)
+        with self.assertRaisesMessage(coupons.CouponError, "at least $50"):
+            coupons.apply_coupon(self.order, 'SALE15')
+
+        cart.add_item(self.user, self.item)
+        self.order.refresh_from_db()
+        coupons.apply_coupon(self.order, ' SALE15 ')
+        self.assertEqual((self.order.discount, self.order.total), (Decimal('12.00'), Decimal('68.00')))
+
+        cart.add_item(self.user, self.item)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.discount, self.order.total), (Decimal('18.00'), Decimal('102.00')))
+        self.assertEqual(self.order.get_total(), self.order.total)
+
+        # below the minimum spend the coupon stays attached but gives nothing
+        cart.set_quantity(self.user, self.item, 1)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.discount, self.order.total), (Decimal('0.00'), Decimal('40.00')))
+
+    def test_percentage_discount_rounds_the_same_everywhere(self):
+        cart.remove_item(self.user, self.item)
+        cheap = make_item(2, price=4.02)
+        cart.add_item(self.user, cheap)
+        Coupon.objects.create(code='QUARTER', kind='P', amount=25)
+        self.order.refresh_from_db()
+        coupons.apply_coupon(self.order, 'QUARTER')
+        self.assertEqual((self.order.discount, self.order.total), (Decimal('1.01'), Decimal('3.01')))
+
+        # the SQL refresh after a cart change agrees with discount_for
+        cart.add_item(self.user, cheap)
+        cart.decrement_item(self.user, cheap)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.discount, self.order.total), (Decimal('1.01'), Decimal('3.01')))
+        self.assertEqual(self.order.totals.total, self.order.total)
+
+        self.assertTrue(payments.begin_payment(self.order))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total, Decimal('3.01'))
+        self.assertEqual(self.order.charge_amount, to_cents(self.order.total))
+
+    def test_missing_coupon_leaves_order_alone(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('core:add-coupon'), {'code': 'NOPE'})
+        self.assertRedirects(response, reverse('core:checkout'), fetch_redirect_response=False)
+        self.order.refresh_from_db()
+        self.assertIsNone(self.order.coupon)
+
+    def test_coupon_cant_change_while_a_payment_is_pending(self):
+        ten = Coupon.objects.create(code='TEN', amount=10)
+        Coupon.objects.create(code='FIVE', amount=5)
+        coupons.apply_coupon(self.order, 'TEN')
+        self.assertTrue(payments.begin_payment(self.order))
+
+        self.client.force_login(self.user)
+        self.client.post(reverse('core:add-coupon'), {'code': 'FIVE'})
+        stale = Order.objects.get(pk=self.order.pk)
+        stale.payment_status = ''
+        with self.assertRaisesMessage(coupons.CouponError, "being processed"):
+            coupons.apply_coupon(stale, 'FIVE')
+
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.coupon, self.order.total, self.order.charge_amount),
+                         (ten, Decimal('30.00'), 3000))
+
+    def test_percentage_coupon_shows_its_discount(self):
+        Coupon.objects.create(code='TENPC', kind='P', amount=10)
+        coupons.apply_coupon(self.order, 'TENPC')
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertContains(response, "-$4.00")
+        self.assertContains(response, "$36.00")
+
+    def test_percentages_are_capped_at_100(self):
+        coupon = Coupon(code='FREE', kind='P', amount=150)
+        with self.assertRaises(ValidationError):
+            coupon.full_clean()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            coupon.save()
+        Coupon(code='BIG', kind='F', amount=150).full_clean()
+
+    def test_lookups_are_cached_until_a_coupon_is_saved(self):
+        coupon = Coupon.objects.create(code='TEN', amount=10)
+        coupons.get_active_coupon('TEN')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(coupons.get_active_coupon('TEN').amount, 10)
+            self.assertIsNone(coupons.get_active_coupon('JUNK'))
+            self.assertIsNone(coupons.get_active_coupon('JUNK'))
+        self.assertEqual(len(queries), 1)
+
+        coupon.active = False
+        coupon.save()
+        self.assertIsNone(coupons.get_active_coupon('TEN'))
+
+    def test_usage_cap_is_enforced_when_payment_starts(self):
+        coupon = Coupon.objects.create(code='ONCE', amount=5, max_redemptions=1)
+        coupons.apply_coupon(self.order, 'ONCE')
+        self.assertTrue(payments.begin_payment(self.order))
+
+        other = get_user_model().objects.create_user('other', password='secret')
+        cart.add_item(other, self.item)
+        other_order = Order.objects.get(user=other, ordered=False)
+        coupons.apply_coupon(other_order, 'ONCE')
+        with self.assertRaises(coupons.CouponError):
+            payments.begin_payment(other_order)
+        other_order.refresh_from_db()
+        self.assertEqual(other_order.payment_status, '')
+
+        payments.fail_payment(self.order, "declined")
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.redemptions, 0)
+        self.assertTrue(payments.begin_payment(other_order))
+
+
+class CouponRedemptionConcurrencyTest(TransactionTestCase):
+    threads = 8
+    attempts = 25
+    cap = 60
+
+    def test_cap_holds_under_concurrent_redemptions(self):
+        coupon = Coupon.objects.create(code='FLASH', amount=5, max_redemptions=self.cap)
+        order = Order(coupon=coupon)
+        redeemed = []
+
+        def hammer():
+            try:
+                for _ in range(self.attempts):
+                    with transaction.atomic():
+                        redeemed.append(coupons.redeem_coupon(order))
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=hammer) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(redeemed.count(True), self.cap)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.redemptions, self.cap)
+
+
+class GuestCartTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.items = [make_item(n, price=10) for n in range(12)]
+        self.user = get_user_model().objects.create_user('shopper', 'shopper@example.com', 'secret')
+
+    def add(self, item):
+        return self.client.get(item.add_to_cart_url)
+
+    def test_browsing_as_a_guest_writes_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.add(self.items[0])
+            self.add(self.items[0])
+            self.add(self.items[1])
+            self.client.get(self.items[1].remove_single_from_cart_url)
+        self.assertFalse([q['sql'] for q in queries if not q['sql'].startswith('SELECT')])
+        self.assertFalse(Order.objects.exists() or OrderItem.objects.exists())
+
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertEqual(response.context['object'].totals.total, Decimal('20.00'))
+        self.assertContains(response, 'Log in To Checkout')
+        self.assertEqual(response.context['cart_item_count'], 1)
+        self.assertContains(self.client.get('/'), f'href="{reverse("core:order-summary")}"')
+
+    def test_guests_are_sent_to_log_in_to_check_out(self):
+        self.add(self.items[0])
+        for url, method in [(reverse('core:checkout'), 'get'), (reverse('core:add-coupon'), 'post'),
+                            (reverse('core:payment', kwargs={'payment_option': 'stripe'}), 'post')]:
+            response = getattr(self.client, method)(url)
+            self.assertRedirects(response, f"{reverse('account_login')}?next={url}",
+                                 fetch_redirect_response=False)
+
+    def test_tampered_cookie_is_ignored(self):
+        self.add(self.items[0])
+        self.client.cookies['cart'] = self.client.cookies['cart'].value.replace('1:', '2:', 1)
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    def test_login_merges_the_guest_cart(self):
+        cart.add_item(self.user, self.items[0])
+        self.add(self.items[0])
+        self.add(self.items[0])
+        self.add(self.items[1])
+
+        response = self.client.post(reverse('account_login'), {'login': 'shopper', 'password': 'secret'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.cookies['cart'].value, '')
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            dict(order.items.values_list('item__slug', 'quantity')), {'item-0': 3, 'item-1': 1})
+        self.assertEqual(order.total, Decimal('40.00'))
+
+    def test_merge_runs_a_fixed_number_of_queries(self):
+        other = get_user_model().objects.create_user('other')
+        cart.add_item(self.user, self.items[0])
+        cart.add_item(other, self.items[0])
+
+        with CaptureQueriesContext(connection) as small:
+            cart.merge_guest_cart(self.user, {self.items[0].pk: 1, self.items[1].pk: 1})
+        with CaptureQueriesContext(connection) as large:
+            cart.merge_guest_cart(other, {item.pk: 2 for item in self.items})
+        self.assertEqual(len(large), len(small))
+
+        order = Order.objects.get(user=other, ordered=False)
+        self.assertEqual(order.items.count(), 12)
+        self.assertEqual(order.items.get(item=self.items[0]).quantity, 3)
+        self.assertEqual(order.total, Decimal('250.00'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTest(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # a second SQLite file standing in for a replica, refreshed by sync_replicas.
+        # it is added after the test case has set up its database access checks
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections.databases['replica']
+        if hasattr(connections._connections, 'replica'):
+            delattr(connections._connections, 'replica')
+        shutil.rmtree(cls.replica_dir)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.synced = make_item(1)
+        call_command('sync_replicas', stdout=io.StringIO())
+        cache.clear()
+
+    def test_routing(self):
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_read(Item), 'replica')
+        self.assertEqual(router.db_for_read(Order), 'default')
+        self.assertEqual(router.db_for_write(Item), 'default')
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Item), 'default')
+        with use_primary():
+            self.assertEqual(router.db_for_read(Item), 'default')
+        self.assertEqual(Item.objects.get(pk=self.synced.pk)._state.db, 'replica')
+
+    def test_catalog_reads_replica_unless_pinned(self):
+        make_item(2)
+        # right after a catalog edit every catalog read goes to the primary
+        self.assertContains(self.client.get(reverse('core:home')), 'Item 2')
+
+        cache.clear()  # the pin ran out, but this replica is far behind
+        product = reverse('core:product', kwargs={'slug': 'item-2'})
+        response = self.client.get(product)
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        # a cart write pins this client to the primary
+        self.client.force_login(self.user)
+        response = self.client.get(self.synced.add_to_cart_url)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.client.get(product).status_code, 200)
+
+        self.client.cookies.pop(PIN_COOKIE)
+        cache.clear()  # the page rendered from the primary is cached too
+        self.assertEqual(self.client.get(product).status_code, 404)
+        call_command('sync_replicas', stdout=io.StringIO())
+        self.assertEqual(self.client.get(product).status_code, 200)
+
+
+class CartAPITest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.a, self.b, self.c = make_item(1), make_item(2, discount_price=8.0), make_item(3)
+        Coupon.objects.create(code='FIVE', amount=5)
+
+    def post(self, operations):
+        return self.client.post(reverse('core:api-cart'), json.dumps({'operations': operations}),
+                                content_type='application/json')
+
+    def test_batch(self):
+        cart.add_item(self.user, self.c)
+        response = self.post([
+            {'op': 'add', 'slug': self.a.slug, 'quantity': 2},
+            {'op': 'set', 'slug': self.b.slug, 'quantity': 3},
+            {'op': 'remove', 'slug': self.c.slug},
+            {'op': 'coupon', 'code': 'FIVE'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([(i['slug'], i['quantity']) for i in data['items']],
+                         [(self.a.slug, 2), (self.b.slug, 3)])
+        self.assertEqual(data['coupon'], 'FIVE')
+        self.assertEqual(data['total'], '39.00')
+
+    def test_failed_batch_rolls_back(self):
+        response = self.post([
+            {'op': 'add', 'slug': self.a.slug},
+            {'op': 'add', 'slug': 'missing'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('core:api-cart')).json()['items'], [])
+
+    def test_quantity_is_bounded(self):
+        for quantity in (10 ** 30, 1001):
+            response = self.post([{'op': 'set', 'slug': self.a.slug, 'quantity': quantity}])
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error'], "quantity must be at most 1000")
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('core:api-cart')).status_code, 401)
+
+    def test_sold_out_items_are_refused(self):
+        Item.objects.filter(pk=self.a.pk).update(stock=0)
+        for op in ({'op': 'add', 'slug': self.a.slug}, {'op': 'set', 'slug': self.a.slug, 'quantity': 2}):
+            response = self.post([op])
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error'], f"Sorry, {self.a.title} is out of stock")
+        self.assertFalse(OrderItem.objects.exists())
+        # taking it out still works
+        self.assertEqual(self.post([{'op': 'set', 'slug': self.a.slug, 'quantity': 0}]).status_code, 200)
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    requests = []
+    decline = False
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        FakeStripeHandler.requests.append({
+            'path': self.path,
+            'idempotency_key': self.headers.get('Idempotency-Key'),
+            'params': parse_qs(body.decode()),
+        })
+        if self.path == '/v1/refunds':
+            status, payload = 200, {'id': f"re_{len(self.requests)}", 'object': 'refund'}
+        elif self.decline:
+            status, payload = 402, {'error': {'type': 'card_error', 'message': "Your card was declined."}}
+        else:
+            status, payload = 200, {'id': f"ch_{len(self.requests)}", 'object': 'charge'}
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStripeMixin:
+    """Points the stripe client at a local HTTP server for the test's duration."""
+
+    def setUp(self):
+        super().setUp()
+        FakeStripeHandler.requests = []
+        FakeStripeHandler.decline = False
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeStripeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.stripe_settings = (stripe.api_base, stripe.api_key)
+        stripe.api_base = f"http://127.0.0.1:{self.server.server_port}"
+        stripe.api_key = 'sk_test_fake'
+
+    def tearDown(self):
+        stripe.api_base, stripe.api_key = self.stripe_settings
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+
+@override_settings(PAYMENT_CHARGE_ASYNC=False)
+class PaymentTest(FakeStripeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.order = make_order(self.user, [make_item(1, price=12.5), make_item(2)], quantity=2)
+
+    def test_successful_charge(self):
+        response = self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                                    {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, reverse('core:payment-status'), fetch_redirect_response=False)
+
+        charge, = FakeStripeHandler.requests
+        self.assertEqual(charge['params']['amount'], ['4500'])
+        self.order.refresh_from_db()
+        self.assertEqual(charge['idempotency_key'], self.order.payment_key)
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(self.order.payment.amount, 45)
+        self.assertEqual(self.order.total, Decimal('45.00'))
+        self.assertEqual(len(self.order.ref_code), 20)
+        self.assertFalse(OrderItem.objects.filter(ordered=False).exists())
+
+    def test_cart_count_is_dropped_once_the_order_is_paid(self):
+        self.assertEqual(self.client.get('/').context['cart_item_count'], 2)
+        self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                         {'stripeToken': 'tok_visa'})
+        self.client.get(reverse('core:payment-status'))
+        self.assertEqual(self.client.get('/').context['cart_item_count'], 0)
+
+    def test_declined_charge(self):
+        FakeStripeHandler.decline = True
+        self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                         {'stripeToken': 'tok_visa'})
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.ordered)
+        self.assertEqual(self.order.payment_error, "Your card was declined.")
+        # Stripe answered, the next attempt is a new charge
+        self.assertEqual((self.order.payment_key, self.order.payment_token), ('', ''))
+
+    def test_retry_after_a_network_error_sends_the_same_charge(self):
+        url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+        with mock.patch.object(stripe.Charge, 'create', side_effect=stripe.error.APIConnectionError("timeout")):
+            self.client.post(url, {'stripeToken': 'tok_visa'})
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, payments.FAILED)
+        key = self.order.payment_key
+        # the charge may have been made, so the cart can't change until the key is settled
+        with self.assertRaises(cart.CartLocked):
+            cart.add_item(self.user, make_item(3))
+        Item.objects.filter(slug='item-1').update(price=20)
+
+        self.client.post(url, {'stripeToken': 'tok_other'})
+        charge, = FakeStripeHandler.requests
+        self.assertEqual((charge['idempotency_key'], charge['params']['source'], charge['params']['amount']),
+                         (key, ['tok_visa'], ['4500']))
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(self.order.total, Decimal('45.00'))
+
+    def test_unanswered_charges_are_refunded_when_not_retried(self):
+        with mock.patch.object(stripe.Charge, 'create', side_effect=stripe.error.APIConnectionError("timeout")):
+            self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                             {'stripeToken': 'tok_visa'})
+        key = Order.objects.get(pk=self.order.pk).payment_key
+        self.assertEqual(payments.recover_payments(), 1)
+        charge, refund = FakeStripeHandler.requests
+        self.assertEqual((charge['idempotency_key'], charge['params']['amount']), (key, ['4500']))
+        self.assertEqual((refund['path'], refund['params']['charge']), ('/v1/refunds', ['ch_1']))
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.payment_key), (payments.FAILED, ''))
+        cart.add_item(self.user, make_item(3))
+
+        # a decline means nothing was charged: the key goes without a refund
+        Order.objects.filter(pk=self.order.pk).update(payment_key='k', charge_amount=100)
+        FakeStripeHandler.decline = True
+        self.assertEqual(payments.recover_payments(), 1)
+        self.assertEqual(len(FakeStripeHandler.requests), 3)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).payment_key, '')
+
+    def test_lost_charges_are_recovered(self):
+        self.assertTrue(payments.begin_payment(self.order, 'tok_visa'))
+        self.assertEqual(payments.recover_payments(), 0)
+        Order.objects.filter(pk=self.order.pk).update(
+            reserved_at=timezone.now() - timezone.timedelta(minutes=10))
+        out = io.StringIO()
+        call_command('recover_payments', stdout=out)
+        self.assertIn("Retried 1 charges", out.getvalue())
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(FakeStripeHandler.requests[0]['idempotency_key'], self.order.payment_key)
+
+    def test_pending_payment_is_not_started_twice(self):
+        self.assertTrue(payments.begin_payment(self.order))
+        self.assertFalse(payments.begin_payment(Order.objects.get(pk=self.order.pk)))
+        with self.assertRaises(cart.CartLocked):
+            cart.add_item(self.user, make_item(3))
+
+
+class BackgroundPaymentTest(FakeStripeMixin, TransactionTestCase):
+    def test_charge_runs_off_the_request(self):
+        user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(user)
+        order = make_order(user, [make_item(1)])
+        self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                         {'stripeToken': 'tok_visa'})
+
+        for _ in range(100):
+            order.refresh_from_db()
+            if order.payment_status != payments.PENDING:
+                break
+            time.sleep(0.05)
+        self.assertEqual(order.payment_status, payments.COMPLETED)
+        self.assertTrue(order.ordered)
+
+
+@override_settings(PAYMENT_CHARGE_ASYNC=False)
+class InventoryTest(FakeStripeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.hot = make_item(1)
+        self.hot.stock = 3
+        self.hot.save()
+        self.order = make_order(self.user, [self.hot, make_item(2)], quantity=2)
+        self.url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+
+    def stock(self):
+        return Item.objects.values_list('stock', flat=True).get(pk=self.hot.pk)
+
+    def test_sale_keeps_the_reserved_stock(self):
+        self.client.post(self.url, {'stripeToken': 'tok_visa'})
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.ordered)
+        self.assertIsNone(self.order.reserved_at)
+        self.assertEqual(self.stock(), 1)
+        self.assertIsNone(Item.objects.get(slug='item-2').stock)
+
+    def test_declined_charge_puts_the_stock_back(self):
+        FakeStripeHandler.decline = True
+        self.client.post(self.url, {'stripeToken': 'tok_visa'})
+        self.assertEqual(self.stock(), 3)
+        # a second failure doesn't restock twice
+        payments.fail_payment(self.order, "again")
+        self.assertEqual(self.stock(), 3)
+
+    def test_out_of_stock_rolls_back_the_payment(self):
+        Item.objects.filter(pk=self.hot.pk).update(stock=1)
+        coupon = Coupon.objects.create(code='ONE', amount=1, max_redemptions=5)
+        Order.objects.filter(pk=self.order.pk).update(coupon=coupon)
+
+        response = self.client.post(self.url, {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, reverse('core:order-summary'), fetch_redirect_response=False)
+        self.assertEqual(FakeStripeHandler.requests, [])
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.reserved_at), ('', None))
+        self.assertEqual(self.stock(), 1)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.redemptions, 0)
+
+        Item.objects.filter(pk=self.hot.pk).update(stock=0)
+        response = self.client.get(self.hot.add_to_cart_url)
+        self.assertRedirects(response, self.hot.absolute_url, fetch_redirect_response=False)
+
+    def test_payment_covers_the_lines_it_locked(self):
+        order = views.get_open_order(self.user)
+        self.assertEqual(order.totals.total, 40)
+        # another tab adds to the cart after PaymentView loaded it
+        cart.add_item(self.user, self.hot)
+        self.assertTrue(payments.begin_payment(order, 'tok_visa'))
+        order.refresh_from_db()
+        self.assertEqual(order.total, 50)
+        self.assertEqual(order.charge_amount, to_cents(order.total))
+        self.assertEqual(self.stock(), 0)
+
+    def test_stale_reservations_expire(self):
+        self.assertTrue(payments.begin_payment(self.order))
+        self.assertEqual(self.stock(), 1)
+        self.assertEqual(payments.expire_reservations(), 0)
+
+        Order.objects.filter(pk=self.order.pk).update(
+            reserved_at=timezone.now() - timezone.timedelta(hours=1))
+        out = io.StringIO()
+        call_command('expire_reservations', stdout=out)
+        self.assertIn("Expired 1 reservations", out.getvalue())
+        self.assertEqual(self.stock(), 3)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, payments.FAILED)
+
+    def test_every_stale_reservation_expires_in_one_run(self):
+        orders = [self.order] + [
+            make_order(get_user_model().objects.create_user(f'shopper{n}'), [make_item(10 + n)])
+            for n in range(4)]
+        for order in orders:
+            self.assertTrue(payments.begin_payment(order))
+        Order.objects.update(reserved_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertEqual(payments.expire_reservations(), 5)
+        self.assertFalse(Order.objects.filter(payment_status=payments.PENDING).exists())
+
+    def test_reservation_expiring_mid_charge_refunds_it(self):
+        create_charge = stripe.Charge.create
+
+        def expire_then_charge(**kwargs):
+            # the expiry job runs while the charge is in flight
+            self.assertEqual(payments.expire_reservations(timeout=0), 1)
+            return create_charge(**kwargs)
+
+        with mock.patch.object(stripe.Charge, 'create', side_effect=expire_then_charge):
+            self.client.post(self.url, {'stripeToken': 'tok_visa'})
+        charge, refund = FakeStripeHandler.requests
+        self.assertEqual(refund['path'], '/v1/refunds')
+        self.assertEqual(refund['params']['charge'], ['ch_1'])
+
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.ordered)
+        self.assertEqual(self.order.payment_status, payments.FAILED)
+        self.assertIn("the charge was refunded", self.order.payment_error)
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(self.stock(), 3)
+
+
+class FlashSaleTest(TransactionTestCase):
+    def test_hot_item_is_never_oversold(self):
+        result = stock_benchmark(buyers=40, threads=8, stock=10, log=lambda message: None)
+        self.assertEqual((result['sold'], result['out_of_stock'], result['errors']), (10, 30, 0))
+        self.assertEqual(result['stock_left'], 0)
+        self.assertFalse(result['oversold'])
+
+
+class SqliteTuningTest(TransactionTestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_connections_get_the_pragmas(self):
+        connection.close()
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -20000)
+
+    def test_concurrent_writers(self):
+        results = sqlite_write_benchmark(writers=2, writes=3, readers=2, items=2, log=lambda message: None)
+        self.assertEqual(results['baseline']['journal'], 'sqlite (delete)')
+        self.assertEqual(results['tuned']['journal'], 'sqlite (wal)')
+        self.assertEqual(results['tuned']['errors'], 0)
+        self.assertEqual(results['tuned']['read_errors'], 0)
+        self.assertGreater(results['tuned']['reads_per_s'], 0)
+
+
+@override_settings(SQLITE_BUSY_RETRIES=2, SQLITE_BUSY_BACKOFF=0)
+class RetryOnBusyTest(SimpleTestCase):
+    def flaky(self, *errors):
+        calls = mock.Mock(side_effect=[*errors, 'done'])
+        return calls, retry_on_busy(calls)
+
+    def test_busy_writes_are_retried(self):
+        calls, func = self.flaky(OperationalError('database is locked'),
+                                 OperationalError('database is locked'))
+        self.assertEqual(func(), 'done')
+        self.assertEqual(calls.call_count, 3)
+
+    def test_gives_up_after_the_retries(self):
+        calls, func = self.flaky(*[OperationalError('database is locked')] * 3)
+        with self.assertRaises(OperationalError):
+            func()
+        self.assertEqual(calls.call_count, 3)
+
+    def test_other_errors_and_transactions_are_not_retried(self):
+        calls, func = self.flaky(OperationalError('no such table: core_item'))
+        with self.assertRaises(OperationalError):
+            func()
+        calls, func = self.flaky(OperationalError('database is locked'))
+        with mock.patch.object(connections['default'], 'in_atomic_block', True):
+            with self.assertRaises(OperationalError):
+                func()
+        self.assertEqual(calls.call_count, 1)
+
+
+class RecommendationTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.items = [make_item(n) for n in range(6)]
+
+    def pay(self, *baskets):
+        for basket in baskets:
+            order = make_order(self.user, [self.items[n] for n in basket])
+            payment = Payment.objects.create(stripe_charge_id='ch_test', user=self.user, amount=10)
+            Order.objects.filter(pk=order.pk).update(ordered=True, payment=payment)
+
+    def recommended(self, n):
+        return [self.items.index(item._items[item.pk]) for item in recommended_items(self.items[n].pk)]
+
+    def snapshot(self):
+        return (sorted(CoPurchase.objects.values_list('item', 'other', 'orders')),
+                sorted(Recommendation.objects.values_list('item', 'recommended', 'rank', 'orders')))
+
+    def test_ranks_items_by_orders_bought_together(self):
+        self.pay([0, 1, 2], [0, 1], [0, 3], [1, 2], [4])
+        run = build_recommendations(settle=0)
+        self.assertEqual((run.orders, run.items, run.full), (5, 4, True))
+        self.assertEqual(self.recommended(0), [1, 2, 3])
+        self.assertEqual(self.recommended(2), [1, 0])
+        self.assertEqual(self.recommended(4), [])
+        self.assertEqual(CoPurchase.objects.get(item=self.items[1], other=self.items[0]).orders, 2)
+
+        build_recommendations(full=True, per_item=1, settle=0)
+        self.assertEqual(self.recommended(0), [1])
+
+    def test_incremental_runs_match_a_full_rebuild(self):
+        self.pay([0, 1], [0, 2, 3])
+        build_recommendations(settle=0)
+        self.pay([2, 3], [1, 3, 5])
+        # just paid, left for the next run
+        self.assertEqual(build_recommendations().orders, 0)
+        run = build_recommendations(settle=0)
+        self.assertEqual((run.orders, run.items, run.full), (2, 4, False))
+        incremental = self.snapshot()
+
+        build_recommendations(full=True, settle=0)
+        self.assertEqual(self.snapshot(), incremental)
+        self.assertEqual(self.recommended(3), [2, 0, 1, 5])
+
+    def test_python_and_sparse_counts_agree(self):
+        baskets = [{1, 2, 3}, {2, 3}, {3, 9}, {1, 9, 2}]
+        counts = recommendations.count_pairs_python(baskets)
+        self.assertEqual(counts[2, 3], 2)
+        self.assertEqual(counts[1, 2], 2)
+        if recommendations.sparse is None:
+            self.skipTest("scipy isn't installed")
+        self.assertEqual(recommendations.count_pairs_sparse(baskets), counts)
+
+    def test_product_page_reads_recommendations_in_one_query(self):
+        self.pay([0, 1], [0, 2])
+        call_command('build_recommendations', settle=0, stdout=io.StringIO())
+        url = reverse('core:product', kwargs={'slug': self.items[0].slug})
+        response = self.client.get(url)
+        self.assertContains(response, "Frequently bought together")
+        self.assertContains(response, self.items[2].get_absolute_url())
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        # the cards come from their cached fragments
+        self.assertEqual(len(queries), 1)
+        self.assertIn('core_recommendation', queries[0]['sql'])
+
+
+class CheckoutTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.order = make_order(self.user, [make_item(1)])
+        self.url = reverse('core:checkout')
+
+    def add_default(self, address_type):
+        return Address.objects.create(user=self.user, street_address="1 Main St", apartment_address='',
+                                      country='US', zip='10001', address_type=address_type, default=True)
+
+    def test_default_addresses(self):
+        shipping, billing = self.add_default('S'), self.add_default('B')
+        response = self.client.post(self.url, {
+            'use_default_shipping': 'on', 'use_default_billing': 'on', 'payment_option': 'S'})
+        self.assertRedirects(response, reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                             fetch_redirect_response=False)
+        # session, user, default addresses, order update
+        self.assertEqual(response.profile.sql_count, 4)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.shipping_address, self.order.billing_address), (shipping, billing))
+
+    def test_new_shipping_address_used_for_billing(self):
+        response = self.client.post(self.url, {
+            'shipping_address': "2 High St", 'shipping_country': 'GB', 'shipping_zip': 'N1',
+            'set_default_shipping': 'on', 'same_billing_address': 'on', 'payment_option': 'P'})
+        self.assertRedirects(response, reverse('core:payment', kwargs={'payment_option': 'paypal'}),
+                             fetch_redirect_response=False)
+        # session, user, old defaults cleared, addresses inserted and read back, order update
+        self.assertLessEqual(response.profile.sql_count, 6)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.shipping_address.address_type, 'S')
+        self.assertEqual(self.order.billing_address.address_type, 'B')
+        self.assertEqual(self.order.billing_address.street_address, "2 High St")
+        self.assertEqual(Address.objects.filter(default=True).count(), 2)
+
+    def test_addresses_are_deduplicated(self):
+        data = {'shipping_address': "2 High St", 'shipping_country': 'GB', 'shipping_zip': 'N1 9GU',
+                'same_billing_address': 'on', 'payment_option': 'S'}
+        response = self.client.post(self.url, data)
+        self.assertLessEqual(response.profile.sql_count, 5)
+        first = Order.objects.get(pk=self.order.pk)
+
+        data.update(shipping_address="  2  high st ", shipping_zip='n19gu', set_default_shipping='on')
+        self.client.post(self.url, data)
+        second = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(second.shipping_address_id, first.shipping_address_id)
+        self.assertTrue(second.shipping_address.default)
+
+        other = self.add_default('S')
+        self.assertEqual(list(Address.objects.filter(default=True, address_type='S')), [other])
+        self.assertEqual(Address.objects.get(pk=first.shipping_address_id).street_address, "2 High St")
+
+    def test_one_default_per_user_and_type(self):
+        self.add_default('S')
+        Address.objects.create(user=self.user, street_address="9 Side St", apartment_address='',
+                               country='US', zip='10002', address_type='S')
+        with self.assertRaises(IntegrityError):
+            Address.objects.filter(street_address="9 Side St").update(default=True)
+
+    def test_duplicate_address_keeps_the_old_default(self):
+        first = self.add_default('S')
+        duplicate = Address(user=self.user, street_address=" 1  main st", apartment_address='',
+                            country='US', zip='10001', address_type='S', default=True)
+        with self.assertRaises(ValidationError):
+            duplicate.full_clean()
+        with self.assertRaises(IntegrityError):
+            duplicate.save()
+        first.refresh_from_db()
+        self.assertTrue(first.default)
+
+    def test_failure_writes_nothing(self):
+        self.client.post(self.url, {
+            'shipping_address': "2 High St", 'shipping_country': 'GB', 'shipping_zip': 'N1',
+            'use_default_billing': 'on', 'payment_option': 'S'})
+        self.assertFalse(Address.objects.exists())
+
+        self.order.delete()
+        response = self.client.post(self.url, {
+            'shipping_address': "2 High St", 'shipping_country': 'GB', 'shipping_zip': 'N1',
+            'same_billing_address': 'on', 'payment_option': 'S'})
+        self.assertRedirects(response, reverse('core:order-summary'), fetch_redirect_response=False)
+        self.assertFalse(Address.objects.exists())
+
+
+class ConstraintTest(TestCase):
+    def test_one_open_order_per_user(self):
+        user = get_user_model().objects.create_user('shopper', password='secret')
+        make_order(user, [])
+        Order.objects.create(user=user, ordered=True, ordered_date=timezone.now(), ref_code='a' * 20)
+        with self.assertRaises(IntegrityError):
+            Order.objects.create(user=user, ordered_date=timezone.now())
+
+    def test_concurrent_first_add_shares_the_open_order(self):
+        user = get_user_model().objects.create_user('shopper', password='secret')
+        order = make_order(user, [])
+        select_for_update = Order.objects.select_for_update
+        lookups = []
+
+        def miss_once():
+            # the cart is created by another request just after this one looked for it
+            lookups.append(1)
+            return Order.objects.none() if len(lookups) == 1 else select_for_update()
+
+        with mock.patch.object(Order.objects, 'select_for_update', side_effect=miss_once):
+            cart.add_item(user, make_item(1))
+        self.assertEqual(list(Order.objects.filter(user=user, ordered=False)), [order])
+        self.assertEqual(order.items.count(), 1)
+
+
+class OrderAdminTest(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(self.admin)
+
+    def make_orders(self, count):
+        for n in range(count):
+            user = get_user_model().objects.create_user(f'customer{Order.objects.count()}')
+            address = Address.objects.create(user=user, street_address=f"{n} Main St", country='US',
+                                             zip='10001', address_type='S')
+            payment = Payment.objects.create(user=user, stripe_charge_id=f'ch_{user.pk}', amount=10)
+            Order.objects.create(user=user, ordered=True, ordered_date=timezone.now(),
+                                 ref_code=f'ref{user.pk:017d}', refund_requested=True,
+                                 shipping_address=address, billing_address=address, payment=payment)
+
+    def test_changelist_queries_do_not_grow_with_orders(self):
+        url = reverse('admin:core_order_changelist')
+        self.make_orders(2)
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.make_orders(20)
+        with CaptureQueriesContext(connection) as many:
+            self.assertContains(self.client.get(url), 'customer21')
+        self.assertEqual(len(many), len(few))
+
+    def test_granting_refunds_accepts_refund_requests(self):
+        self.make_orders(5)
+        orders = list(Order.objects.order_by('pk'))
+        for order in orders:
+            Refund.objects.create(order=order, reason="broken")
+
+        with mock.patch('core.admin.ACTION_CHUNK_SIZE', 2):
+            response = self.client.post(reverse('admin:core_order_changelist'), {
+                'action': 'make_refund_accepted',
+                '_selected_action': [order.pk for order in orders[:3]],
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Order.objects.filter(refund_granted=True, refund_requested=False).count(), 3)
+        self.assertEqual(set(Refund.objects.filter(accepted=True).values_list('order', flat=True)),
+                         {order.pk for order in orders[:3]})
+
+    def test_unfiltered_count_comes_from_statistics(self):
+        self.make_orders(3)
+        paginator = EstimatedCountPaginator(Order.objects.order_by('pk'), 100)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        with mock.patch('core.admin.ESTIMATE_THRESHOLD', 2):
+            self.assertEqual(estimated_count(Order, 'default'), 3)
+            self.assertEqual(paginator.count, 3)
+            Order.objects.filter(pk=Order.objects.first().pk).delete()
+            # still the statistics until the next ANALYZE, filtered lists are counted
+            self.assertEqual(EstimatedCountPaginator(Order.objects.order_by('pk'), 100).count, 3)
+            self.assertEqual(EstimatedCountPaginator(Order.objects.filter(ordered=True).order_by('pk'), 100).count, 2)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.items = [make_item(n, price=10) for n in range(3)]
+        coupon = Coupon.objects.create(code='FIVE', amount=5)
+        for n in range(4):
+            order = Order.objects.create(user=self.user, ordered=True, ordered_date=timezone.now(),
+                                         ref_code=f'ref{n:017d}', coupon=coupon if n == 0 else None)
+            for item in self.items[:n + 1]:
+                order.items.add(OrderItem.objects.create(user=self.user, item=item, quantity=2,
+                                                         ordered=True))
+            freeze_order(order)
+        make_order(self.user, self.items)  # the open cart isn't exported
+        Refund.objects.create(order=order, reason="late")
+
+    def test_orders_csv_with_totals(self):
+        rows = list(csv.DictReader(io.StringIO(''.join(export_lines('orders', chunk_size=3)))))
+        self.assertEqual([row['ref_code'] for row in rows], [f'ref{n:017d}' for n in range(4)])
+        self.assertEqual((rows[0]['subtotal'], rows[0]['discount'], rows[0]['total']),
+                         ('20.00', '5.00', '15.00'))
+        self.assertEqual((rows[0]['coupon_code'], rows[0]['lines'], rows[0]['quantity']), ('FIVE', '1', '2'))
+        self.assertEqual((rows[3]['total'], rows[3]['lines'], rows[3]['quantity']), ('60.00', '3', '6'))
+        self.assertEqual(rows[3]['coupon_code'], '')
+
+    def test_csv_cells_cant_hold_formulas(self):
+        Refund.objects.update(reason='=HYPERLINK("http://evil.example","refund")')
+        row, = csv.DictReader(io.StringIO(''.join(export_lines('refunds'))))
+        self.assertEqual(row['reason'], '\'=HYPERLINK("http://evil.example","refund")')
+        # the JSON export is data, not a spreadsheet
+        refund, = map(json.loads, export_lines('refunds', 'jsonl'))
+        self.assertTrue(refund['reason'].startswith('='))
+
+    def test_datasets_as_json_lines(self):
+        lines = list(export_lines('order-items', 'jsonl', chunk_size=4))
+        self.assertEqual(len(lines), 1 + 2 + 3 + 3)
+        self.assertEqual(json.loads(lines[0])['line_total'], '20.00')
+        refund, = map(json.loads, export_lines('refunds', 'jsonl'))
+        self.assertEqual((refund['ref_code'], refund['username']), (f'ref{3:017d}', 'shopper'))
+        tomorrow = (timezone.localdate() + timezone.timedelta(days=1)).isoformat()
+        self.assertEqual(list(export_lines('orders', 'jsonl', since=tomorrow)), [])
+        with self.assertRaises(ExportError):
+            export_lines('orders', since='last week')
+
+    def test_staff_streaming_endpoint(self):
+        url = reverse('core:export', kwargs={'dataset': 'orders'})
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url, {'format': 'jsonl'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 4)
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 400)
+
+    def test_export_command(self):
+        out = io.StringIO()
+        call_command('export_orders', 'payments', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'id,stripe_charge_id,amount,timestamp,username')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'orders.csv')
+            call_command('export_orders', output=path, chunk_size=1, stdout=out)
+            with open(path, newline='') as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 4)
+        self.assertIn("Wrote 4 rows", out.getvalue())
+
+
+class BenchmarkSuiteTest(TestCase):
+    def test_seed_and_storefront_run(self):
+        result = seed(order_items=60, users=4, items=6, coupons=2, log=lambda line: None)
+        self.assertEqual(OrderItem.objects.count(), 60)
+        self.assertEqual(Order.objects.filter(ordered=False).count(), 4)
+        self.assertEqual(Payment.objects.count(), len(result['orders']) - 4)
+
+        users = list(get_user_model().objects.filter(pk__in=result['users']))
+        items = list(Item.objects.filter(pk__in=result['items']))
+        rows = StorefrontBenchmark(users, items).run(2)
+        self.assertIn('payment_post', [row['endpoint'] for row in rows])
+        self.assertEqual(Order.objects.filter(ordered=False).count(), 2)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.items = [make_item(n) for n in range(30)]
+        self.order = make_order(self.user, self.items)
+        Address.objects.create(user=self.user, street_address="1 Main St", apartment_address='',
+                               country='US', zip='10001', address_type='B', default=True)
+        self.order.billing_address = Address.objects.get()
+        self.order.save()
+        # warm the session cart count like any returning visitor
+        self.client.get(reverse('core:home'))
+
+    def test_views_stay_within_budget(self):
+        slug = {'slug': self.items[0].slug}
+        for url in [
+            reverse('core:home'),
+            reverse('core:product', kwargs=slug),
+            reverse('core:search') + '?q=item',
+            reverse('core:order-summary'),
+            reverse('core:checkout'),
+            reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+            reverse('core:api-cart'),
+        ]:
+            with self.subTest(url=url):
+                self.assertWithinQueryBudget(self.client.get(url))
+
+        for url in [
+            reverse('core:add-to-cart', kwargs=slug),
+            reverse('core:remove-single-item-from-cart', kwargs=slug),
+        ]:
+            with self.subTest(url=url):
+                self.assertWithinQueryBudget(self.client.get(url))
+                self.client.get(reverse('core:home'))
+
+    def test_profile_headers_and_metrics(self):
+        reset_metrics()
+        with self.settings(PROFILING_HEADERS=True):
+            response = self.client.get(reverse('core:order-summary'))
+        self.assertEqual(response['X-SQL-Count'], str(response.profile.sql_count))
+        self.assertIn('sql;dur=', response['Server-Timing'])
+        self.assertGreater(response.profile.template_ms, 0)
+
+        self.assertEqual(self.client.get(reverse('core:metrics')).status_code, 404)
+        self.user.is_staff = True
+        self.user.save()
+        metrics = self.client.get(reverse('core:metrics')).json()
+        self.assertEqual(metrics['core:order-summary']['requests'], 1)
+
+
+def make_jpeg(width, height, color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class ImageDerivativeTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = self.settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def stored(self, digest):
+        return sorted(os.listdir(os.path.join(self.media_root, 'derivatives', digest[:2], digest)))
+
+    def test_upload_generates_derivatives(self):
+        item = make_item(1)
+        item.image = SimpleUploadedFile('shirt.jpg', make_jpeg(800, 600))
+        item.save()
+        item.refresh_from_db()
+        self.assertEqual(item.image_width, 800)
+        # no upscaling past the original width
+        self.assertEqual(self.stored(item.image_hash),
+                         ['320.jpg', '320.webp', '640.jpg', '640.webp'])
+        with Image.open(os.path.join(self.media_root, images.derivative_name(
+                item.image_hash, 320, 'webp'))) as thumb:
+            self.assertEqual((thumb.format, thumb.size), ('WEBP', (320, 240)))
+
+        html = Template("{% load item_images %}{% item_image item css_class='card-img-top' %}").render(
+            Context({'item': item}))
+        self.assertIn('<source type="image/webp" srcset="', html)
+        self.assertIn(f"/media/derivatives/{item.image_hash[:2]}/{item.image_hash}/640.jpg 640w", html)
+
+    def test_backfill_shares_derivatives_between_copies(self):
+        data = make_jpeg(1500, 500, 'blue')
+        for name in ('a.jpg', 'b.jpg'):
+            with open(os.path.join(self.media_root, name), 'wb') as f:
+                f.write(data)
+        first, second = make_item(1), make_item(2)
+        Item.objects.filter(pk=first.pk).update(image='a.jpg')
+        Item.objects.filter(pk=second.pk).update(image='b.jpg')
+
+        self.assertEqual(images.backfill(Item.objects.all(), workers=2, log=lambda line: None), 2)
+        digests = set(Item.objects.values_list('image_hash', flat=True))
+        self.assertEqual(digests, {images.content_hash(data)})
+        self.assertEqual(len(self.stored(digests.pop())), 6)
+
+    def test_items_without_derivatives_render_the_original(self):
+        html = Template("{% load item_images %}{% item_image item %}").render(
+            Context({'item': make_item(1)}))
+        self.assertEqual(html, '<img src="/media/12.jpg" class="" alt="">')
+
+
+class StaticAssetTest(TestCase):
+    def test_sources_are_linked_until_collectstatic_runs(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        with self.settings(STATIC_ROOT=static_root):
+            html = render_to_string('core/scripts.html')
+        self.assertIn('src="/static/core/js/jquery-3.4.1.min.js"', html)
+        self.assertIn('src="/static/core/js/site.js"', html)
+
+    def test_collectstatic_builds_hashed_compressed_bundles(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        with self.settings(STATIC_ROOT=static_root):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            with open(os.path.join(static_root, 'staticfiles.json')) as f:
+                manifest = json.load(f)['paths']
+            # the storage is rebuilt on settings changes, this one reads the new manifest
+            with self.settings(STATIC_URL='/static/'):
+                html = render_to_string('core/style.html')
+
+        bundle = manifest['core/css/site.bundle.css']
+        self.assertRegex(bundle, r'^core/css/site\.bundle\.[0-9a-f]{12}\.css$')
+        self.assertEqual(html.count('rel="stylesheet"'), 2)
+        self.assertIn(f'href="/static/{bundle}"', html)
+        self.assertTrue(os.path.exists(os.path.join(static_root, bundle + '.gz')))
+        with open(os.path.join(static_root, bundle)) as f:
+            self.assertIn('.carousel{height:60vh}', f.read())
+
+    def test_minify_css_keeps_descendant_pseudo_classes(self):
+        self.assertEqual(minify_css('/* x */\n.a :hover ,\n.b > p {\n  color: red;\n}\n'),
+                         '.a :hover,.b>p{color:red}')
+
+
+class ItemURLTest(TestCase):
+    def test_slug_url_matches_reverse(self):
+        for slug in ['shirt', 'item_2', 'caf\u00e9 au lait']:
+            for name in ['core:product', 'core:add-to-cart', 'core:remove-single-item-from-cart']:
+                with self.subTest(slug=slug, name=name):
+                    self.assertEqual(slug_url(name, slug), reverse(name, kwargs={'slug': slug}))
+        with self.assertRaises(NoReverseMatch):
+            slug_url('core:product', 'a/b')
+
+    def test_script_prefix_is_respected(self):
+        slug_url('core:product', 'shirt')
+        set_script_prefix('/shop/')
+        self.addCleanup(set_script_prefix, '/')
+        self.assertEqual(slug_url('core:product', 'shirt'), '/shop/product/shirt')
+
+    def test_item_urls_follow_slug_changes(self):
+        item = make_item(1)
+        self.assertEqual(item.get_absolute_url(), '/product/item-1')
+        item.slug = 'renamed'
+        item.save()
+        self.assertEqual(item.get_add_to_cart_url(), '/add-to-cart/renamed/')
+        self.assertEqual(item.get_absolute_url(), '/product/renamed')
+
+    def test_url_benchmark(self):
+        results = url_benchmark(items=10, repeat=3)
+        self.assertEqual(set(results), {'reverse', 'prefix cache', 'item properties'})
@@ -1,30 +1,37 @@
 from django.shortcuts import render, get_object_or_404
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund
-from django.views.generic import ListView, DetailView, View
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from .models import Item, Order, Refund
+from django.views.generic import ListView, View
 from django.shortcuts import redirect
-from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from .forms import CheckoutForm, CouponForm, RefundForm
+from .pricing import order_lines_prefetch
+from . import cart
+from .context_processors import invalidate_cart
+from .search import search_items
+from .catalog import (
+    KeysetPage, parse_cursor, get_catalog_version, get_catalog_count,
+    get_item_pk, get_item_versions, remember_item_slug, attach_item_versions, fragment_timeout,
+)
+from . import payments
+from .coupons import CouponError, apply_coupon
+from .inventory import OutOfStock
+from .checkout import PAYMENT_OPTIONS, CheckoutError, checkout, load_default_addresses
+from .middleware import get_metrics
+from .routers import use_primary
+from .exports import EXPORT_FORMATS, ExportError, export_lines
+from .recommendations import recommended_items
 from django.conf import settings
-import stripe
-import random
-import string
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
-def create_ref_code():
-    return ''.join(random.choice(string.ascii_lowercase + string.digits, k=20))
-
-
-def is_valid_form(values):
-    valid = True
-    for field in values:
-        if field == '':
-            valid = False
-    return valid        
+def get_open_order(user):
+    # the open cart with its lines and coupon, ready for order.totals
+    return Order.objects.select_related('coupon').prefetch_related(
+        order_lines_prefetch()).get(user=user, ordered=False)
 
 
 # in our template we say {% for item in objects_list %}
@@ -32,12 +39,82 @@ class HomeView(ListView):
     model = Item
     paginate_by = 10
     template_name = "core/home-page.html"
+    cache_timeout = 60 * 10
+
+    def paginate_queryset(self, queryset, page_size):
+        # keyset pagination on pk: no OFFSET scans and no COUNT(*) per page
+        page = KeysetPage(
+            queryset, page_size,
+            after=parse_cursor(self.request.GET.get('after')),
+            before=parse_cursor(self.request.GET.get('before')),
+        )
+        return (None, page, page, True)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context['page_obj']
+        queryset = self.object_list
+        context.update({
+            'catalog_version': get_catalog_version(),
+            'catalog_cursor': f"{page.after or ''}:{page.before or ''}",
+            'catalog_cache_timeout': fragment_timeout(self.cache_timeout),
+            'catalog_count': SimpleLazyObject(lambda: get_catalog_count(queryset)),
+        })
+        return context
+
+
+class SearchView(ListView):
+    template_name = "core/search.html"
+    max_results = 50
+
+    def get_queryset(self):
+        query = self.request.GET.get('q', '').strip()
+        if not query:
+            return []
+        return attach_item_versions(search_items(query, limit=self.max_results))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.request.GET.get('q', '').strip()
+        return context
+
+
+class MetricsView(View):
+    # per-view request metrics collected by core.middleware.ProfilingMiddleware
+    def get(self, *args, **kwargs):
+        if not (settings.DEBUG or self.request.user.is_staff):
+            raise Http404
+        return JsonResponse(get_metrics())
 
 
-class OrderSummary(LoginRequiredMixin, View):
+class ExportView(View):
+    # staff download of core.exports datasets, streamed as the rows are read
     def get(self, *args, **kwargs):
+        if not self.request.user.is_staff:
+            raise Http404
+        dataset = kwargs['dataset']
+        export_format = self.request.GET.get('format', 'csv')
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            lines = export_lines(dataset, export_format,
+                                 self.request.GET.get('since'), self.request.GET.get('until'))
+        except ExportError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        response = StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{export_format}"'
+        return response
+
+
+@method_decorator(use_primary(), name='dispatch')
+class OrderSummary(View):
+    def get(self, *args, **kwargs):
+        if not self.request.user.is_authenticated:
+            guest_cart = self.request.guest_cart
+            if not guest_cart:
+                messages.error(self.request, "You don't have an active order!")
+                return redirect("/")
+            return render(self.request, 'core/order_summary.html', {'object': guest_cart})
+        try:
+            order = get_open_order(self.request.user)
             context = {
                 'object': order
 
@@ -48,15 +125,34 @@ class OrderSummary(LoginRequiredMixin, View):
         return render(self.request, 'core/order_summary.html', context)
     
 
-class ProductDetailView(DetailView):
-    model = Item
+class ProductDetailView(View):
     template_name = "core/product-page.html"
 
+    def get(self, *args, **kwargs):
+        slug = kwargs['slug']
+        pk = get_item_pk(slug)
+        if pk is None:
+            item = get_object_or_404(Item, slug=slug)
+            remember_item_slug(item)
+            pk = item.pk
+        else:
+            # only loaded when the cached item_detail fragment has to be rendered
+            item = SimpleLazyObject(lambda: get_object_or_404(Item, pk=pk))
+        context = {
+            'object': item,
+            'item': item,
+            'item_pk': pk,
+            'item_version': get_item_versions([pk])[pk],
+            'recommendations': recommended_items(pk),
+        }
+        return render(self.request, self.template_name, context)
 
-class CheckoutView(View):
+
+@method_decorator(use_primary(), name='dispatch')
+class CheckoutView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = get_open_order(self.request.user)
             # form
             form = CheckoutForm()
 
@@ -68,23 +164,11 @@ class CheckoutView(View):
 
              }
 
-            shipping_address_qs = Address.objects.filter(
-                user = self.request.user,
-                address_type="S",
-                default=True
-            )
-            
-            if shipping_address_qs.exists():
-                context.update({'default_shipping_address': shipping_address_qs[0]})
-
-            billing_address_qs = Address.objects.filter(
-                user = self.request.user,
-                address_type="B",
-                default=True
-            )
-            
-            if billing_address_qs.exists():
-                context.update({'default_billing_address': billing_address_qs[0]})    
+            defaults = load_default_addresses(self.request.user)
+            if 'S' in defaults:
+                context.update({'default_shipping_address': defaults['S']})
+            if 'B' in defaults:
+                context.update({'default_billing_address': defaults['B']})
 
             return render(self.request, 'core/checkout-page.html', context)
         
@@ -95,130 +179,26 @@ class CheckoutView(View):
     
     def post(self, *args, **kwargs):
         form = CheckoutForm(self.request.POST or None)
+        if not form.is_valid():
+            messages.warning(self.request, "Invalid Payment option selected")
+            return redirect("core:checkout")
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            if form.is_valid():
-                use_default_shipping = form.cleaned_data.get('use_default_shipping')
-                if use_default_shipping:
-                    print("Using the default shipping address")
-                    address_qs = Address.objects.filter(
-                        user=self.request.user,
-                        address_type="S",
-                        default=True
-                    )
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(self.request, "No default shipping address available")
-                        return redirect("core:checkout")
-                else:
-                    print("user is entering a new shipping address")
-
-                    shipping_address1 = form.cleaned_data.get('shipping_address')
-                    shipping_address2 = form.cleaned_data.get('shipping_address2')
-                    shipping_country = form.cleaned_data.get('shipping_country')
-                    shipping_zip = form.cleaned_data.get('shipping_zip')
-
-                    if is_valid_form([shipping_address1, shipping_country, shipping_zip]):
-                        shipping_address = Address(
-                            user=self.request.user,
-                            street_address=shipping_address1,
-                            apartment_address=shipping_address2,
-                            country=shipping_country,
-                            zip=shipping_zip,
-                            address_type='S'
-                        )
-                        shipping_address.save()
-
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        set_default_shipping = form.cleaned_data.get('set_default_shipping')
-                    
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-                    else:
-                        messages.info(self.request, "Please fill out the required field")
-                        return redirect("core:checkout")
-
-                same_billing_address = form.cleaned_data.get('same_billing_address')
-                use_default_billing = form.cleaned_data.get('use_default_billing')
-
-                if same_billing_address:
-                    billing_address = shipping_address
-                    billing_address.pk = None
-                    billing_address.save()
-                    billing_address.address_type = "B"
-                    billing_address.save()
-                    order.billing_address = billing_address
-                    order.save()
-
-                elif use_default_billing:
-                    print("Using the default billing address")
-                    address_qs = Address.objects.filter(
-                        user=self.request.user,
-                        address_type="B",
-                        default=True
-                    )
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(self.request, "No default billing address available")
-                        return redirect("core:checkout")
-                else:
-                    print("user is entering a new shipping address")
-
-                    billing_address1 = form.cleaned_data.get('billing_address')
-                    billing_address2 = form.cleaned_data.get('billing_address2')
-                    billing_country = form.cleaned_data.get('billing_country')
-                    billing_zip = form.cleaned_data.get('billing_zip')
-
-                    if is_valid_form([billing_address1, billing_country, billing_zip]):
-                        billing_address = Address(
-                            user=self.request.user,
-                            street_address=billing_address1,
-                            apartment_address=billing_address2,
-                            country=billing_country,
-                            zip=billing_zip,
-                            address_type='B'
-                        )
-                        billing_address.save()
-
-                        order.billing_address = billing_address
-                        order.save()        
-
-                        set_default_billing = form.cleaned_data.get('set_default_billing')
-                    
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
-                    else:
-                        messages.info(self.request, "Please fill out the required field")
-                        return redirect("core:checkout")
-            
-                            
-                payment_option = form.cleaned_data.get("payment_option")
-                
-                if payment_option == 'S':
-                    return redirect("core:payment", payment_option='stripe')
-                elif payment_option == 'P':
-                    return redirect("core:payment", payment_option='paypal')
-                else:
-                    messages.warning(self.request, "Invalid Payment option selected")
-                    return redirect("core:checkout")
-        
+            checkout(self.request.user, form.cleaned_data)
+        except CheckoutError as e:
+            messages.info(self.request, str(e))
+            return redirect("core:checkout")
         except ObjectDoesNotExist:
             messages.error(self.request, "You don't have an active order!")
             return redirect("core:order-summary")
 
-class PaymentView(View):
+        payment_option = PAYMENT_OPTIONS[form.cleaned_data.get("payment_option")]
+        return redirect("core:payment", payment_option=payment_option)
+
+
+@method_decorator(use_primary(), name='dispatch')
+class PaymentView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        order = get_open_order(self.request.user)
         if order.billing_address:
             context = {
                 'order': order,
@@ -232,214 +212,122 @@ class PaymentView(View):
             return redirect("core:checkout")
 
     def post(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        order = get_open_order(self.request.user)
         token = self.request.POST.get('stripeToken')
-        amount=int(order.get_total() * 100) #cents
-        
-        try:
-            charge = stripe.Charge.create(
-            amount=int(order.get_total() * 100), #cents
-            currency="usd",
-            source=token,
-            )
-            # Create the Payment
-            payment = Payment()
-            payment.stripe_charge_id = charge['id']
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            # assign payment to the order
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            order.ordered = True
-            order.payment = payment
-            order.ref_code = create_ref_code()
-            order.save()
-
-            messages.success(self.request, "Your order was successful")
-            return redirect("/")
-
-        except stripe.error.CardError as e:
-            # Since it's a decline, stripe.error.CardError will be caught
-            body = e.json_body
-            err = body.get("error", {})
-            messages.error(self.request, f"{err.get('message')}")
-            return redirect("/")
 
+        # the charge runs in the background; the order total is frozen here
+        try:
+            started = payments.begin_payment(order, token)
+        except CouponError as e:
+            messages.warning(self.request, str(e))
+            return redirect("core:checkout")
+        except OutOfStock as e:
+            messages.warning(self.request, str(e))
+            return redirect("core:order-summary")
+        if not started:
+            messages.info(self.request, "Your payment is already being processed")
+            return redirect("core:payment-status")
 
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.error(self.request, "Rate Limit Error")
-            return redirect("/")
-            
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.error(self.request, "Invalid Parameters")
-            return redirect("/")
-
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.error(self.request, "Not Authenticated")
-            return redirect("/")
+        payments.enqueue_charge(order.pk)
+        return redirect("core:payment-status")
 
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.error(self.request, "Network Error")
-            return redirect("/")
 
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.error(self.request, "Something went wrong. You were not charged. Please Try Again")
+class PaymentStatusView(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        order = Order.objects.filter(user=self.request.user).exclude(
+            payment_status='').order_by('-start_date').first()
+        if order is None:
+            messages.info(self.request, "You don't have a payment in progress")
             return redirect("/")
 
-        except Exception as e:
-            # send email to ourselves
-            messages.error(self.request, "A serious error occurred. We have been notified")
+        # the cached cart count may predate the charge
+        if order.payment_status == payments.COMPLETED:
+            invalidate_cart(self.request)
+            messages.success(self.request, "Your order was successful")
             return redirect("/")
+        if order.payment_status == payments.FAILED:
+            invalidate_cart(self.request)
+            messages.error(self.request, order.payment_error)
+            return redirect("core:checkout")
+        return render(self.request, "core/payment_status.html", {'order': order})
 
         
-
-
-@login_required
+@use_primary()
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item = item, 
-        user=request.user, 
-        ordered=False
-        )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, f"You have {order_item.quantity} from this item in your cart!")
-            return redirect("core:order-summary") 
-    
+    try:
+        if request.user.is_authenticated:
+            quantity = cart.add_item(request.user, item)
         else:
-            order.items.add(order_item)
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item was added to your cart!")
-            return redirect("core:order-summary") 
-
-                
+            quantity = request.guest_cart.add(item)
+    except OutOfStock as e:
+        messages.warning(request, str(e))
+        return redirect("core:product", slug=slug)
+    except cart.CartLocked:
+        messages.warning(request, "Your payment is being processed, the cart can't change right now")
+        return redirect("core:payment-status")
+    except cart.GuestCartFull:
+        messages.warning(request, "Your cart is full, please log in to add more items")
+        return redirect("core:order-summary")
+    invalidate_cart(request)
+    if quantity > 1:
+        messages.info(request, f"You have {quantity} from this item in your cart!")
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
         messages.info(request, "This item was added to your cart!")
-        return redirect("core:order-summary") 
+    return redirect("core:order-summary") 
 
-@login_required
+@use_primary()
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                            item = item, 
-                            user=request.user, 
-                            ordered=False
-                            )[0]
-
-            order_item.quantity = 0
-            order.items.remove(order_item)    
-            order_item.save()
-            messages.success(request, f"Item successfully deleted from your cart")
-            return redirect("core:order-summary")               
-        else:
-            # add a message saying user doesn't have an order
-            messages.error(request, f"Item isn't in your cart")
-            return redirect("core:product", slug=slug)
-
+    if request.user.is_authenticated:
+        removed = cart.remove_item(request.user, item)
     else:
-        # add a message saying user doesn't have an order
-        messages.info(request, f"You don't have active order")
+        removed = request.guest_cart.remove(item)
+    if removed:
+        invalidate_cart(request)
+        messages.success(request, f"Item successfully deleted from your cart")
+        return redirect("core:order-summary")               
+    else:
+        messages.error(request, f"Item isn't in your cart")
         return redirect("core:product", slug=slug)
 
+@use_primary()
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    order_price = Order.objects.get(user=request.user, ordered=False)
-    print("******")
-    print(order_price.get_total())
-    print("*******")
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                            item = item, 
-                            user=request.user, 
-                            ordered=False
-                            )[0]      
-            if order_item.quantity > 1:        
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order_item.quantity = 0
-                order.items.remove(order_item)
-                order_item.save() 
-        
-            messages.success(request, f"Item quantity updated")
-            return redirect("core:order-summary")               
-        else:
-            # add a message saying user doesn't have an order
-            messages.error(request, "Item isn't in your cart")
-            return redirect("core:product", slug=slug)
-
+    if request.user.is_authenticated:
+        quantity = cart.decrement_item(request.user, item)
     else:
-        # add a message saying user doesn't have an order
-        messages.info(request, f"You don't have active order")
-        return redirect("core:product", slug=slug)    
-
-def get_coupon(request, code):
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except ObjectDoesNotExist:
-        messages.error(request, "This Coupon does not exist!")
-        return redirect("core:checkout")    
-    
+        quantity = request.guest_cart.decrement(item)
+    if quantity is not None:
+        invalidate_cart(request)
+        messages.success(request, f"Item quantity updated")
+        return redirect("core:order-summary")               
+    else:
+        messages.error(request, "Item isn't in your cart")
+        return redirect("core:product", slug=slug)
 
-class AddCouponView(View):
+@method_decorator(use_primary(), name='dispatch')
+class AddCouponView(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
             form = CouponForm(self.request.POST or None)
             if form.is_valid():
                 try:
                     code = form.cleaned_data.get('code')
                     order = Order.objects.get(user=self.request.user, ordered=False)
-                    order.coupon = get_coupon(self.request, code)
-                    if order.get_total() < 0:
-                        messages.warning(self.request, "You can't add this coupon to your cart")
-                        return redirect("core:checkout")
-                    else:                        
-                        order.save()
-                        messages.success(self.request, "Successfuly added coupon")
-                        return redirect("core:checkout")
-                    
+                    apply_coupon(order, code)
+                    messages.success(self.request, "Successfuly added coupon")
+                    return redirect("core:checkout")
+
                 except ObjectDoesNotExist:
                     messages.info(self.request, "You don't have active order")
                     return redirect("core:checkout")    
 
-                except ValueError:
-                    messages.error(self.request, "This Coupon does not exist!")
+                except CouponError as e:
+                    messages.error(self.request, str(e))
                     return redirect("core:checkout")    
-                
+            messages.error(self.request, "This Coupon does not exist!")
+            return redirect("core:checkout")
+
 class RequestRefundView(View):
     def get(self, *args, **kwargs):
         form = RefundForm()
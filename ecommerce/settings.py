@@ -39,12 +39,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.ProfilingMiddleware',
+    'core.routers.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'core.middleware.GuestCartMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -62,6 +65,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.cart',
+                'core.context_processors.fragments',
             ],
         },
     },
@@ -77,13 +82,89 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # a file (not in-memory) test database so threaded tests get real locking
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        # keep connections (and their pragmas) across requests
+        'CONN_MAX_AGE': 600,
     }
 }
 
+# applied to every new SQLite connection by core.sqlite
+SQLITE_PRAGMAS = {
+    'busy_timeout': 5000,  # ms
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,  # KiB
+}
+# writes that hit SQLITE_BUSY anyway are retried this many times, backing off from this many seconds
+SQLITE_BUSY_RETRIES = 5
+SQLITE_BUSY_BACKOFF = 0.02
+
+# Read replicas for catalog reads, see core.routers. DATABASE_REPLICA_FILES
+# lists SQLite files (space separated) that stand in for replicas locally,
+# refreshed by the sync_replicas command; any other DATABASES entry
+# (e.g. a PostgreSQL standby) added here is used as a replica as well.
+for n, name in enumerate(config('DATABASE_REPLICA_FILES', default='').split(), 1):
+    DATABASES[f'replica{n}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / name,
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['core.routers.PrimaryReplicaRouter']
+# how long a client that wrote keeps reading from the primary
+REPLICA_PIN_SECONDS = 5
+
+# per-request SQL/template/external call profiling, see core.middleware
+PROFILING_HEADERS = DEBUG
+
+# most SQL queries a view may run; going over is logged and fails the budget tests
+QUERY_BUDGETS = {
+    'core:home': 6,
+    'core:product': 4,
+    'core:search': 4,
+    'core:order-summary': 6,
+    'core:checkout': 9,
+    # a POST reserves stock with one UPDATE per tracked item in the cart
+    'core:payment': 13,
+    'core:add-to-cart': 10,
+    'core:remove-single-item-from-cart': 9,
+    # batch POSTs cost a few queries per operation
+    'core:api-cart': 30,
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ecommerce',
+    }
+}
+# Product card and detail fragments are invalidated through version stamps kept in the cache,
+# which other processes only see with a shared backend (file, Redis, Memcached). With a
+# process-local one like locmem, fragments expire after FRAGMENT_CACHE_LOCAL_TIMEOUT instead,
+# so a worker that didn't make the change serves it within that time.
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+FRAGMENT_CACHE_LOCAL_TIMEOUT = 60
+
 STRIPE_PUBLIC_KEY = config('STRIPE_TEST_PUBLIC_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_TEST_SECRET_KEY')
 STRIPE_PUBLIC_KEY = config('STRIPE_LIVE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_LIVE_SECRET_KEY')
+# point at a local fake Stripe server in tests and development
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='https://api.stripe.com')
+
+# charges run on a background thread pool so a slow Stripe call doesn't pin a request worker;
+# the pool is in-process, run recover_payments on a schedule for charges lost to a restart
+PAYMENT_CHARGE_ASYNC = True
+PAYMENT_WORKERS = 4
+# stock held by a pending payment is handed back after this many seconds
+# (see the expire_reservations command)
+STOCK_RESERVATION_TIMEOUT = 60 * 15
+# pending charges older than this are sent to Stripe again (see the recover_payments command)
+PAYMENT_RECOVERY_AFTER = 60 * 5
+# "frequently bought together" items kept per product (see the build_recommendations command)
+RECOMMENDATIONS_PER_ITEM = 4
 SITE_ID = 1
 
 LOGIN_REDIRECT_URL = "/"
@@ -128,9 +209,18 @@ MEDIA_URL = '/media/'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+# collectstatic bundles, fingerprints and pre-compresses the assets (see core.assets).
+# Hashed names never change content, so serve STATIC_ROOT with
+# "Cache-Control: public, max-age=31536000, immutable" and the .gz/.br siblings
+STATICFILES_STORAGE = 'core.assets.StaticAssetStorage'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# thumbnails and WebP copies of Item.image are made on upload; the
+# build_image_derivatives command backfills existing items with this many processes
+IMAGE_WORKERS = 4
+
 AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
     'allauth.account.auth_backends.AuthenticationBackend'
@@ -0,0 +1,2 @@
+// Animations initialization
+new WOW().init();